@@ -0,0 +1,376 @@
+"""Concurrent front-end to open3dhub for keeping many downloads in flight
+
+Python 2 has no event loop in the standard library, so requests are run
+on a pool of I/O threads and every call returns a Future immediately.
+Each host gets its own connection limit and identical requests that are
+already in flight are shared.
+
+COLLADA documents are parsed off the I/O threads so that slow parses never
+hold up downloads. path_to_bounds sends the downloaded bytes to a pool of
+worker processes, so parsing runs on other cores. A watchdog thread
+fails the futures of parses that outlive parse_timeout or that a dying
+worker may have taken with it. A pycollada instance can't be sent back
+from another process, so path_to_mesh parses on a thread pool instead,
+which keeps downloads flowing but is not parallel under the GIL.
+
+Example::
+
+    hub = AsyncHub()
+    futures = [hub.path_to_bounds(p) for p in paths]
+    bounds = gather(futures)
+    hub.close()
+"""
+
+import json
+import sys
+import cPickle
+import threading
+import time
+import traceback
+import urlparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import fastbounds
+import open3dhub
+import telemetry
+
+class Future(object):
+    """The pending result of an asynchronous call"""
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """Waits for and returns the result, re-raising the call's exception"""
+        if not self._event.wait(timeout):
+            raise RuntimeError('timed out waiting for result')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) once the future is done. If it is already done,
+        fn is called immediately from the calling thread."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            # the first outcome wins, e.g. over a late result after a timeout
+            if self._event.is_set():
+                return
+            self._result = result
+            self._exc_info = exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info=None):
+        """Fails the future with exc_info, defaulting to the exception
+        currently being handled"""
+        if exc_info is None:
+            exc_info = sys.exc_info()
+        self._finish(None, exc_info)
+
+def _copy_future(src, dst):
+    try:
+        dst.set_result(src.result())
+    except:
+        dst.set_exception()
+
+def gather(futures):
+    """Waits for all futures and returns their results in order"""
+    return [f.result() for f in futures]
+
+def parse_bounds(metadata, mesh_data):
+    """Returns the bounds info of downloaded mesh data, falling back to a
+    full pycollada load for documents fastbounds can't handle"""
+    try:
+        return fastbounds.get_bounds_info(mesh_data)
+    except fastbounds.UnsupportedError:
+        from meshtool.filters.print_filters.print_bounds import getBoundsInfo
+        return getBoundsInfo(open3dhub.parse_mesh(metadata, mesh_data))
+
+class WorkerError(Exception):
+    """A call on the parse pool raised, failed to pickle its result or was
+    lost with its worker"""
+    pass
+
+def _call(fn, args):
+    """Runs fn(*args) in a worker process. Returns (True, pickled result)
+    or (False, (exception type name, message, traceback)). A Python 2 pool
+    has no error callback and drops results that fail to pickle, and its
+    result thread dies on one that fails to unpickle, so only strings are
+    sent back."""
+    try:
+        return True, cPickle.dumps(fn(*args), cPickle.HIGHEST_PROTOCOL)
+    except Exception, ex:
+        return False, (type(ex).__name__, str(ex), traceback.format_exc())
+
+class AsyncHub(object):
+    """Asynchronous versions of the open3dhub fetch functions
+
+    max_requests bounds the total number of requests in flight and
+    per_host bounds the number of simultaneous connections to any one
+    host. parse_pool is the multiprocessing.Pool path_to_bounds parses on,
+    by default one of parse_workers processes; pass another to share one
+    between hubs. Parses still running after parse_timeout seconds fail.
+    path_to_mesh parses on a thread pool of mesh_workers threads."""
+
+    # seconds between the watchdog's checks of the parse pool
+    WATCH_INTERVAL = 1.0
+
+    def __init__(self, max_requests=128, per_host=16, parse_workers=None, parse_pool=None,
+                 mesh_workers=4, parse_timeout=None):
+        self.per_host = per_host
+        # forked before any of the hub's threads are started
+        self._own_parse_pool = parse_pool is None
+        self._parse_pool = multiprocessing.Pool(parse_workers) if parse_pool is None else parse_pool
+        self._io_pool = ThreadPool(max_requests)
+        self._mesh_pool = ThreadPool(mesh_workers)
+
+        self.session = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_requests,
+                                                pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._host_limits = {}
+        self._in_flight = {}
+
+        self.parse_timeout = parse_timeout
+        # future -> (AsyncResult, deadline) of each call on the parse pool
+        self._process_tasks = {}
+        self._lost_worker = False
+        self._closing = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def close(self):
+        """Waits for outstanding work and shuts down the pools"""
+        self._io_pool.close()
+        self._io_pool.join()
+        self._mesh_pool.close()
+        self._mesh_pool.join()
+        if self._own_parse_pool:
+            with self._lock:
+                pending = list(self._process_tasks)
+            for future in pending:
+                future._event.wait()
+            # a pool that lost a task to a dead worker never finishes joining
+            if self._lost_worker:
+                self._parse_pool.terminate()
+            else:
+                self._parse_pool.close()
+                self._parse_pool.join()
+        self._closing.set()
+        self._watchdog.join()
+
+    def _submit(self, pool, fn, *args):
+        future = Future()
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except:
+                future.set_exception()
+        pool.apply_async(telemetry.bind(run))
+        return future
+
+    def _submit_process(self, fn, *args):
+        """Like _submit, on the parse pool; fn and args must pickle"""
+        future = Future()
+        def done(outcome):
+            with self._lock:
+                self._process_tasks.pop(future, None)
+            ok, value = outcome
+            if not ok:
+                name, message, tb = value
+                ex = WorkerError('%s: %s\n%s' % (name, message, tb))
+                future.set_exception((WorkerError, ex, None))
+                return
+            try:
+                result = cPickle.loads(value)
+            except:
+                future.set_exception()
+                return
+            future.set_result(result)
+
+        deadline = None
+        if self.parse_timeout is not None:
+            deadline = time.time() + self.parse_timeout
+        with self._lock:
+            # held so a quick callback can't pop the task before it's added
+            result = self._parse_pool.apply_async(_call, (fn, args), callback=telemetry.bind(done))
+            self._process_tasks[future] = (result, deadline)
+        return future
+
+    def _watch(self):
+        """Fails parse pool futures whose call timed out, or that were in
+        flight when a worker died. The pool replaces a dead worker but
+        silently loses its task, and can't say which task that was."""
+        pids = set(p.pid for p in self._parse_pool._pool)
+        while not self._closing.wait(self.WATCH_INTERVAL):
+            now = time.time()
+            current = set(p.pid for p in self._parse_pool._pool)
+            lost = len(pids - current) > 0
+            pids = current
+            if lost:
+                self._lost_worker = True
+            failed = []
+            with self._lock:
+                for future, (result, deadline) in self._process_tasks.items():
+                    if result.ready():
+                        continue
+                    if lost:
+                        failed.append((future, 'a parse worker died with the call in flight'))
+                    elif deadline is not None and now > deadline:
+                        failed.append((future, 'call timed out after %s s' % self.parse_timeout))
+                for future, reason in failed:
+                    del self._process_tasks[future]
+            for future, reason in failed:
+                future.set_exception((WorkerError, WorkerError(reason), None))
+
+    def _then(self, future, fn):
+        """Returns a future for fn(result of future). fn may return another
+        Future, in which case the returned future follows that one."""
+        out = Future()
+        def done(f):
+            try:
+                value = fn(f.result())
+            except:
+                out.set_exception()
+                return
+            if isinstance(value, Future):
+                value.add_done_callback(lambda g: _copy_future(g, out))
+            else:
+                out.set_result(value)
+        future.add_done_callback(done)
+        return out
+
+    def _coalesce(self, key, start):
+        """Returns the in-flight future for key, or starts a new one"""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future
+            future = Future()
+            self._in_flight[key] = future
+        future.add_done_callback(lambda f: self._forget(key, f))
+
+        try:
+            started = start()
+        except:
+            future.set_exception()
+        else:
+            started.add_done_callback(lambda f: _copy_future(f, future))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _host_limit(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self._lock:
+            limit = self._host_limits.get(host)
+            if limit is None:
+                limit = threading.BoundedSemaphore(self.per_host)
+                self._host_limits[host] = limit
+        return limit
+
+    def _blocking_fetch(self, url, httprange):
+        open3dhub.check_online(url)
+        headers = {}
+        if httprange is not None:
+            offset, length = httprange
+            headers['Range'] = 'bytes=%d-%d' % (offset, offset+length-1)
+
+        with self._host_limit(url):
+            start = time.time()
+            resp = self.session.get(url, headers=headers)
+        open3dhub.record_fetch(url, start, resp)
+        open3dhub.check_status(url, resp)
+        return resp.content
+
+    def urlfetch(self, url, httprange=None):
+        key = ('url', url, httprange)
+        return self._coalesce(key, lambda: self._submit(self._io_pool, self._blocking_fetch, url, httprange))
+
+    def json_fetch(self, url):
+        return self._then(self.urlfetch(url), json.loads)
+
+    def hashfetch(self, dlhash, httprange=None):
+        return self.urlfetch(open3dhub.DOWNLOAD_URL + '/' + dlhash, httprange)
+
+    def get_single_metadata(self, path):
+        pathinfo = open3dhub.PathInfo(path)
+        return self.json_fetch(open3dhub.MODELINFO_URL % {'path': pathinfo.normpath})
+
+    def get_search_list(self, q, policy=None):
+        if policy is None:
+            policy = open3dhub.ADMISSION_POLICY
+        result = Future()
+        all_items = []
+
+        def fetch_page(start):
+            self.json_fetch(open3dhub.search_page_url(q, start)).add_done_callback(on_page)
+
+        def on_page(f):
+            try:
+                items, next_start = open3dhub.parse_search_page(f.result())
+            except:
+                result.set_exception()
+                return
+            all_items.extend(policy.filter(items))
+            if next_start is None:
+                result.set_result(all_items)
+            else:
+                fetch_page(next_start)
+
+        fetch_page(0)
+        return result
+
+    def path_to_mesh_data(self, path):
+        """Returns a future for (metadata, mesh_data), the downloaded but
+        unparsed mesh"""
+        def got_metadata(metadata):
+            mesh_hash = metadata['metadata']['types']['optimized']['hash']
+            return self._then(self.hashfetch(mesh_hash), lambda mesh_data: (metadata, mesh_data))
+        return self._then(self.get_single_metadata(path), got_metadata)
+
+    def path_to_mesh(self, path):
+        """Returns a future for (metadata, mesh). Textures are fetched
+        on demand when first accessed, as with open3dhub.path_to_mesh.
+        The mesh is parsed on a thread, so parses of several meshes share
+        one core."""
+        def parse((metadata, mesh_data)):
+            mesh_future = self._submit(self._mesh_pool, open3dhub.parse_mesh, metadata, mesh_data)
+            return self._then(mesh_future, lambda mesh: (metadata, mesh))
+        return self._coalesce(('mesh', path), lambda: self._then(self.path_to_mesh_data(path), parse))
+
+    def path_to_bounds(self, path):
+        """Returns a future for (metadata, bounds info) of a mesh, as from
+        meshtool's getBoundsInfo. The mesh is parsed in a worker process."""
+        def parse((metadata, mesh_data)):
+            bounds_future = self._submit_process(parse_bounds, metadata, mesh_data)
+            return self._then(bounds_future, lambda bounds: (metadata, bounds))
+        return self._coalesce(('bounds', path), lambda: self._then(self.path_to_mesh_data(path), parse))
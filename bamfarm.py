@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""Converts open3dhub models to panda3d BAM files on a process pool
+
+Output files are named by a key computed from the content hashes of the
+mesh and its subfiles plus the conversion options, so a model is only
+converted again when its content or the options change. Conversions
+that fail are recorded in failures.json in the output directory instead
+of leaving placeholder files behind, and index.json maps each model path
+to the BAM file holding it.
+
+Given a directory written by sharedcatalog.publish, the workers read the
+metadata of published models from it instead of fetching it.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import posixpath
+import traceback
+import multiprocessing
+from optparse import OptionParser
+from clint.textui import progress
+
+import cache
+import open3dhub
+import sharedcatalog
+
+# bump this when mesh_to_bamfile output changes so old files are not reused
+CONVERT_VERSION = 1
+
+# panda3d holds on to memory, so recycle workers every so often
+TASKS_PER_WORKER = 50
+
+def conversion_key(mesh_hash, subfile_hashes, options):
+    """Returns the output key for a mesh hash, a dict of subfile names to
+    hashes and a dict of conversion options"""
+    h = hashlib.sha1()
+    h.update('v%d\n' % CONVERT_VERSION)
+    h.update(mesh_hash + '\n')
+    for name, subhash in sorted(subfile_hashes.iteritems()):
+        h.update('%s=%s\n' % (name, subhash))
+    h.update(json.dumps(options, sort_keys=True))
+    return h.hexdigest()
+
+def subfile_hashes(metadata):
+    """Returns a dict of subfile basename to download hash"""
+    typedata = metadata['metadata']['types']['optimized']
+    hashes = {}
+    for subfile in typedata['subfiles']:
+        base_name = posixpath.basename(posixpath.split(subfile)[0])
+        hashes[base_name] = open3dhub.get_subfile_hash(subfile)
+    return hashes
+
+def convert_one(args):
+    """Pool worker that converts a single model. Returns a result dict
+    with a status of 'converted', 'skipped', 'failed-before' or 'failed'."""
+    path, outdir, options, failed_key = args
+    start = time.time()
+    result = {'path': path, 'key': None, 'bytes': 0}
+
+    try:
+        # workers don't use the shelf, which only one process may write
+        shared = cache.get_shared()
+        metadata = shared.get_metadata(path) if shared is not None else None
+        if metadata is None:
+            metadata = open3dhub.get_single_metadata(path)
+        mesh_hash = metadata['metadata']['types']['optimized']['hash']
+        hashes = subfile_hashes(metadata)
+        key = conversion_key(mesh_hash, hashes, options)
+        bam_file = os.path.join(outdir, key + '.bam')
+        result['key'] = key
+
+        if os.path.isfile(bam_file):
+            result['status'] = 'skipped'
+        elif key == failed_key:
+            result['status'] = 'failed-before'
+        else:
+            mesh_data = open3dhub.hashfetch(mesh_hash)
+            subfiles = dict((name, open3dhub.hashfetch(subhash))
+                            for name, subhash in hashes.iteritems())
+            mesh = open3dhub.load_mesh(mesh_data, subfiles)
+            open3dhub.mesh_to_bamfile(mesh, path.replace('/', '_'), bam_file,
+                                      flatten=options['flatten'])
+            result['status'] = 'converted'
+            result['bytes'] = len(mesh_data) + sum(len(d) for d in subfiles.itervalues())
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+
+    result['seconds'] = time.time() - start
+    return result
+
+def _init_worker(catalog):
+    """Pool initializer that gives the worker its own HTTP session and
+    attaches the sharedcatalog directory catalog if it is given"""
+    open3dhub.reset_session()
+    if catalog is not None:
+        sharedcatalog.attach(catalog)
+
+def _load_json(fname):
+    if os.path.isfile(fname):
+        with open(fname) as f:
+            return json.load(f)
+    return {}
+
+def _save_json(obj, fname):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.rename(fname + '.tmp', fname)
+
+def convert_all(paths, outdir, options, workers=None, retry_failed=False, catalog=None):
+    """Converts paths into outdir and returns a dict of result counts and
+    throughput numbers. catalog is an optional sharedcatalog directory
+    the workers attach."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    index_file = os.path.join(outdir, 'index.json')
+    failures_file = os.path.join(outdir, 'failures.json')
+    index = _load_json(index_file)
+    failures = _load_json(failures_file)
+
+    tasks = []
+    for path in paths:
+        failed_key = None
+        if not retry_failed and path in failures:
+            failed_key = failures[path]['key']
+        tasks.append((path, outdir, options, failed_key))
+
+    counts = {'converted': 0, 'skipped': 0, 'failed-before': 0, 'failed': 0}
+    total_bytes = 0
+    busy_seconds = 0.0
+    start = time.time()
+
+    # the parent may have fetched tags through open3dhub's session already
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(catalog,),
+                                maxtasksperchild=TASKS_PER_WORKER)
+    try:
+        results = pool.imap_unordered(convert_one, tasks)
+        for result in progress.bar(results, label='Converting... ', expected_size=len(tasks)):
+            counts[result['status']] += 1
+            total_bytes += result['bytes']
+            busy_seconds += result['seconds']
+            path = result['path']
+
+            if result['status'] == 'failed':
+                failures[path] = {'key': result['key'], 'error': result['error']}
+            elif result['status'] in ('converted', 'skipped'):
+                failures.pop(path, None)
+                index[path] = result['key'] + '.bam'
+    except:
+        # don't wait for the rest of the catalog to convert
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        _save_json(index, index_file)
+        _save_json(failures, failures_file)
+
+    elapsed = time.time() - start
+    counts['elapsed'] = elapsed
+    counts['bytes'] = total_bytes
+    counts['busy_seconds'] = busy_seconds
+    counts['models_per_second'] = len(tasks) / elapsed if elapsed > 0 else 0.0
+    counts['mb_per_second'] = total_bytes / (1024.0 * 1024.0) / elapsed if elapsed > 0 else 0.0
+    return counts
+
+def main():
+    parser = OptionParser(usage="Usage: bamfarm.py -o outdir [-t tag] [-f paths.txt] [path ...]",
+                          description="Converts open3dhub models to BAM files in parallel")
+    parser.add_option("-o", "--outdir", dest="outdir",
+                      help="write BAM files, index.json and failures.json to OUTDIR", metavar="OUTDIR")
+    parser.add_option("-t", "--tag", dest="tags", action="append", default=[],
+                      help="convert every model with TAG (may be repeated)", metavar="TAG")
+    parser.add_option("-f", "--file", dest="pathfile",
+                      help="convert the model paths listed in FILE, one per line", metavar="FILE")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None,
+                      help="number of worker processes (default: number of CPUs)")
+    parser.add_option("--unflattened", dest="flatten", action="store_false", default=True,
+                      help="do not flatten the scene graph before writing")
+    parser.add_option("--retry-failed", dest="retry_failed", action="store_true", default=False,
+                      help="retry models that failed with the same content before")
+    parser.add_option("--catalog", dest="catalog",
+                      help="read metadata of the models published in the shared catalog DIR", metavar="DIR")
+    (options, args) = parser.parse_args()
+
+    if options.outdir is None:
+        parser.print_help()
+        parser.exit(1, "Must specify an output directory.\n")
+
+    paths = list(args)
+    if options.pathfile is not None:
+        with open(options.pathfile) as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    if len(options.tags) > 0:
+        for tag in options.tags:
+            paths.extend(m['full_path'] for m in cache.get_tag(tag))
+
+    # keep the first occurrence of each path
+    seen = set()
+    paths = [p for p in paths if not (p in seen or seen.add(p))]
+
+    if len(paths) == 0:
+        parser.print_help()
+        parser.exit(1, "No models to convert.\n")
+
+    stats = convert_all(paths, options.outdir, {'flatten': options.flatten},
+                        workers=options.jobs, retry_failed=options.retry_failed,
+                        catalog=options.catalog)
+
+    print 'Converted %d, skipped %d up to date, %d failed (%d failed before)' % \
+            (stats['converted'], stats['skipped'], stats['failed'], stats['failed-before'])
+    print 'Elapsed %.1fs, %.2f models/s, %.2f MB/s downloaded, %.1f worker-seconds' % \
+            (stats['elapsed'], stats['models_per_second'], stats['mb_per_second'], stats['busy_seconds'])
+
+    if stats['failed'] > 0:
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Broad-phase overlap tests between axis-aligned boxes
+
+Boxes are hashed into a uniform grid of cells, and only boxes that share
+a cell are compared exactly, so finding the overlapping pairs among N
+boxes is about linear array work instead of comparing every pair::
+
+    i, j = broadphase.overlapping_pairs(minpts, maxpts)
+    keep = broadphase.keep_first(minpts, maxpts)
+
+An OccupancyGrid keeps the boxes placed so far, so later batches can be
+tested against everything placed before them::
+
+    grid = broadphase.OccupancyGrid(cell_size=16)
+    grid.insert(road_minpts, road_maxpts, 'road')
+    placed = grid.place(house_minpts, house_maxpts, 'house')
+
+Cells are hashed from their integer coordinates, so the grid needs no
+fixed extent; two cells hashing alike only costs extra exact tests. Boxes
+are inclusive, like the overlap test of generate-scene.py and spatial.py.
+"""
+
+import numpy
+
+# boxes covering more than this many cells are tested against every box
+# directly instead of being hashed into all of them
+MAX_CELLS = 64
+
+# multipliers of the cell coordinate hash
+_HASH = numpy.array([73856093, 19349663, 83492791], dtype=numpy.int64)
+
+def as_boxes(minpts, maxpts):
+    """Returns minpts and maxpts as (N, 3) float32 arrays"""
+    return (numpy.asarray(minpts, dtype=numpy.float32).reshape(-1, 3),
+            numpy.asarray(maxpts, dtype=numpy.float32).reshape(-1, 3))
+
+def cell_size_for(minpts, maxpts):
+    """Returns a cell size about the median size of the boxes, so most
+    boxes fall into a handful of cells"""
+    if len(minpts) == 0:
+        return 1.0
+    size = numpy.median((maxpts - minpts).max(axis=1))
+    extent = (maxpts.max(axis=0) - minpts.min(axis=0)).max()
+    # keeps cell coordinates well inside int64 for scenes of tiny boxes
+    return float(max(size, extent / float(1 << 20), 1e-6))
+
+def overlap(minpts1, maxpts1, minpts2, maxpts2):
+    """Returns which rows of the first boxes overlap the matching rows of
+    the second"""
+    return ((maxpts1 >= minpts2) & (minpts1 <= maxpts2)).all(axis=-1)
+
+def _expand_ranges(starts, counts):
+    """Returns (owners, positions): for each range, its index repeated
+    and the positions starts[i] to starts[i] + counts[i] - 1"""
+    ends = numpy.cumsum(counts)
+    total = ends[-1] if len(ends) > 0 else 0
+    owners = numpy.repeat(numpy.arange(len(counts)), counts)
+    return owners, numpy.repeat(starts, counts) + numpy.arange(total) - numpy.repeat(ends - counts, counts)
+
+def cell_keys(minpts, maxpts, cell_size):
+    """Returns (ids, keys, large): the hashed key of each cell covered by
+    each box paired with the box's id, and the ids of the boxes covering
+    more than MAX_CELLS cells, which are left out of the pairs"""
+    lo = numpy.floor(minpts.astype(numpy.float64) / cell_size).astype(numpy.int64)
+    hi = numpy.floor(maxpts.astype(numpy.float64) / cell_size).astype(numpy.int64)
+    spans = hi - lo + 1
+    counts = spans.prod(axis=1)
+    large = counts > MAX_CELLS
+    small = numpy.flatnonzero(~large)
+
+    owners, offsets = _expand_ranges(numpy.zeros(len(small), dtype=numpy.int64), counts[small])
+    ids = small[owners]
+    spans = spans[ids]
+    cells = lo[ids]
+    cells[:, 2] += offsets % spans[:, 2]
+    offsets //= spans[:, 2]
+    cells[:, 1] += offsets % spans[:, 1]
+    cells[:, 0] += offsets // spans[:, 1]
+
+    keys = cells * _HASH
+    keys = keys[:, 0] ^ keys[:, 1] ^ keys[:, 2]
+    return ids, keys, numpy.flatnonzero(large)
+
+def _same_key_pairs(ids, keys):
+    """Returns (a, b) pairing every two entries of ids with equal keys"""
+    order = numpy.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    ids = ids[order]
+    n = len(keys)
+    positions = numpy.arange(n)
+    first = numpy.ones(n, dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    group_start = numpy.maximum.accumulate(numpy.where(first, positions, 0))
+
+    # each entry pairs with the entries before it in its group
+    a, b = _expand_ranges(group_start, positions - group_start)
+    return ids[a], ids[b]
+
+def _unique_pairs(i, j, n):
+    """Orders each pair low id first and drops repeats, sorted by (i, j)"""
+    i, j = numpy.minimum(i, j), numpy.maximum(i, j)
+    keys = numpy.unique(i.astype(numpy.int64) * n + j)
+    return keys // n, keys % n
+
+def overlapping_pairs(minpts, maxpts, cell_size=None):
+    """Returns (i, j), arrays of the ids of every pair of overlapping boxes
+    with i < j, sorted"""
+    minpts, maxpts = as_boxes(minpts, maxpts)
+    n = len(minpts)
+    if cell_size is None:
+        cell_size = cell_size_for(minpts, maxpts)
+
+    ids, keys, large = cell_keys(minpts, maxpts, cell_size)
+    a, b = _same_key_pairs(ids, keys)
+    found_i = [a]
+    found_j = [b]
+    for box in large:
+        found_i.append(numpy.repeat(box, n))
+        found_j.append(numpy.arange(n))
+
+    i = numpy.concatenate(found_i)
+    j = numpy.concatenate(found_j)
+    candidates = (i != j) & overlap(minpts[i], maxpts[i], minpts[j], maxpts[j])
+    return _unique_pairs(i[candidates], j[candidates], n)
+
+def keep_first(minpts, maxpts, cell_size=None):
+    """Returns a boolean mask of the boxes that overlap none of the boxes
+    before them"""
+    minpts, maxpts = as_boxes(minpts, maxpts)
+    keep = numpy.ones(len(minpts), dtype=bool)
+    i, j = overlapping_pairs(minpts, maxpts, cell_size)
+    keep[j] = False
+    return keep
+
+class OccupancyGrid(object):
+    """The boxes placed so far in a scene, hashed into cells of cell_size.
+    Each box belongs to a layer, such as its model type, and tests can
+    leave layers out, so that trees may touch trees or vehicles sit on
+    roads. Batches are inserted as sorted runs of cell keys, and runs of
+    similar size are merged, so there are only logarithmically many."""
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.layers = []
+        self._layer_ids = {}
+        self._count = 0
+        self._minpts = numpy.empty((64, 3), dtype=numpy.float32)
+        self._maxpts = numpy.empty((64, 3), dtype=numpy.float32)
+        self._layer = numpy.empty(64, dtype=numpy.int16)
+        self._runs = []
+        self._large = numpy.empty(0, dtype=numpy.int64)
+
+    def __len__(self):
+        return self._count
+
+    minpts = property(lambda s: s._minpts[:s._count])
+    maxpts = property(lambda s: s._maxpts[:s._count])
+
+    def layer_id(self, layer):
+        layer_id = self._layer_ids.get(layer)
+        if layer_id is None:
+            layer_id = self._layer_ids[layer] = len(self.layers)
+            self.layers.append(layer)
+        return layer_id
+
+    def _layer_mask(self, ignore):
+        mask = numpy.ones(max(len(self.layers), 1), dtype=bool)
+        for layer in ignore:
+            if layer in self._layer_ids:
+                mask[self._layer_ids[layer]] = False
+        return mask
+
+    def insert(self, minpts, maxpts, layer):
+        """Adds boxes to the grid in layer"""
+        minpts, maxpts = as_boxes(minpts, maxpts)
+        n = len(minpts)
+        if n == 0:
+            return
+        start = self._count
+        if start + n > len(self._layer):
+            capacity = max(2 * len(self._layer), start + n)
+            self._minpts = numpy.resize(self._minpts, (capacity, 3))
+            self._maxpts = numpy.resize(self._maxpts, (capacity, 3))
+            self._layer = numpy.resize(self._layer, capacity)
+        self._minpts[start:start + n] = minpts
+        self._maxpts[start:start + n] = maxpts
+        self._layer[start:start + n] = self.layer_id(layer)
+        self._count += n
+
+        ids, keys, large = cell_keys(minpts, maxpts, self.cell_size)
+        self._large = numpy.concatenate([self._large, large + start])
+        order = numpy.argsort(keys, kind='mergesort')
+        self._runs.append((keys[order], ids[order] + start))
+        while len(self._runs) > 1 and len(self._runs[-2][0]) <= 2 * len(self._runs[-1][0]):
+            (keys1, ids1), (keys2, ids2) = self._runs.pop(), self._runs.pop()
+            keys = numpy.concatenate([keys2, keys1])
+            order = numpy.argsort(keys, kind='mergesort')
+            self._runs.append((keys[order], numpy.concatenate([ids2, ids1])[order]))
+
+    def test(self, minpts, maxpts, ignore=()):
+        """Returns a boolean mask of the boxes that overlap a box in the
+        grid outside the layers in ignore"""
+        minpts, maxpts = as_boxes(minpts, maxpts)
+        hit = numpy.zeros(len(minpts), dtype=bool)
+        if self._count == 0 or len(minpts) == 0:
+            return hit
+        layer_ok = self._layer_mask(ignore)
+
+        def check(queries, stored):
+            keep = layer_ok[self._layer[stored]] & \
+                    overlap(minpts[queries], maxpts[queries], self._minpts[stored], self._maxpts[stored])
+            hit[queries[keep]] = True
+
+        ids, keys, large = cell_keys(minpts, maxpts, self.cell_size)
+        for run_keys, run_ids in self._runs:
+            starts = numpy.searchsorted(run_keys, keys, side='left')
+            counts = numpy.searchsorted(run_keys, keys, side='right') - starts
+            owners, positions = _expand_ranges(starts, counts)
+            check(ids[owners], run_ids[positions])
+
+        stored = numpy.arange(self._count)
+        for box in large:
+            check(numpy.repeat(box, self._count), stored)
+        queries = numpy.arange(len(minpts))
+        for box in self._large:
+            check(queries, numpy.repeat(box, len(minpts)))
+        return hit
+
+    def place(self, minpts, maxpts, layer, ignore=()):
+        """Inserts into layer the boxes that overlap nothing in the grid
+        outside the layers in ignore, nor, unless layer is ignored, an
+        earlier box of the batch. Returns a boolean mask of the boxes
+        placed."""
+        minpts, maxpts = as_boxes(minpts, maxpts)
+        placed = ~self.test(minpts, maxpts, ignore)
+        if layer not in ignore:
+            rows = numpy.flatnonzero(placed)
+            placed[rows] = keep_first(minpts[rows], maxpts[rows], self.cell_size)
+        self.insert(minpts[placed], maxpts[placed], layer)
+        return placed
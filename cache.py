@@ -1,28 +1,244 @@
 import shelve
+import time
+from multiprocessing.pool import ThreadPool
 from meshtool.filters.print_filters.print_bounds import getBoundsInfo
+import fastbounds
 import open3dhub
+import telemetry
 
 CACHE = '.cache'
-SHELF = shelve.open(CACHE)
+
+# opened on first use, so worker processes that only read a shared
+# catalog never open the shelf
+_shelf = None
+
+# a read-only sharedcatalog.SharedCatalog consulted before the shelf
+_shared = None
+
+class CacheMiss(Exception):
+    """Raised in offline mode for entries that would have to be fetched.
+    keys lists the missing shelf keys."""
+    def __init__(self, keys):
+        Exception.__init__(self, 'not cached: %s' % ', '.join(keys))
+        self.keys = keys
+
+def shelf():
+    """Returns the cache shelf, opening it on first use"""
+    global _shelf
+    if _shelf is None:
+        _shelf = shelve.open(CACHE)
+    return _shelf
+
+def _validators_key(key):
+    return 'VALIDATORS_' + key
+
+def _failed_key(path):
+    return 'FAILED_' + str(path)
+
+def _record(name, key, start, hit):
+    telemetry.record('cache', name, start, time.time() - start, key=key, hit=hit)
+
+def attach_shared(catalog):
+    """Makes get_bounds and get_metadata answer the paths published in a
+    sharedcatalog.SharedCatalog from it instead of the shelf. Pass None to
+    detach."""
+    global _shared
+    _shared = catalog
+
+def get_shared():
+    """Returns the attached sharedcatalog.SharedCatalog, or None"""
+    return _shared
+
+def check_admission(path):
+    """Raises open3dhub.ModelRejected if path failed to load before or is
+    over the budget of open3dhub.ADMISSION_POLICY, unless the policy
+    exempts it"""
+    if path in open3dhub.ADMISSION_POLICY.exempt:
+        return
+    failure = shelf().get(_failed_key(path))
+    if failure is not None:
+        raise open3dhub.ModelRejected(path, 'failed to load before (%s)' % failure)
+    reason = open3dhub.ADMISSION_POLICY.reject_reason(get_metadata(path))
+    if reason is not None:
+        raise open3dhub.ModelRejected(path, reason)
+
+def failed_paths():
+    """Returns a dict of the paths in the negative cache to their errors"""
+    db = shelf()
+    return dict((key[len('FAILED_'):], db[key]) for key in db.keys()
+                if key.startswith('FAILED_'))
+
+def clear_failures():
+    """Empties the negative cache so failed models are tried again"""
+    db = shelf()
+    for key in db.keys():
+        if key.startswith('FAILED_'):
+            del db[key]
 
 def get_tag(tag):
+    db = shelf()
+    start = time.time()
     tagkey = "TAG_" + str(tag)
-    if tagkey not in SHELF:
-        SHELF[tagkey] = open3dhub.get_search_list('tags:"%s"' % tag)
-    return SHELF[tagkey]
+    hit = tagkey in db
+    if not hit:
+        if open3dhub.OFFLINE:
+            raise CacheMiss([tagkey])
+        items, validators = open3dhub.get_search_list_validated('tags:"%s"' % tag)
+        db[tagkey] = items
+        db[_validators_key(tagkey)] = validators
+    # the full list is cached so that changing the policy needs no refetch
+    result = [item for item in open3dhub.ADMISSION_POLICY.filter(db[tagkey])
+              if _failed_key(item['full_path']) not in db]
+    _record('get_tag', tagkey, start, hit)
+    return result
+
+def _compute_bounds(metadata, mesh_data):
+    try:
+        return fastbounds.get_bounds_info(mesh_data)
+    except fastbounds.UnsupportedError:
+        mesh = open3dhub.parse_mesh(metadata, mesh_data)
+        return getBoundsInfo(mesh)
 
 def get_bounds(path):
+    start = time.time()
     pathkey = 'BOUNDS_' + str(path)
-    if pathkey not in SHELF:
-        metadata, mesh = open3dhub.path_to_mesh(path)
-        SHELF[pathkey] = getBoundsInfo(mesh)
+    if _shared is not None:
+        result = _shared.get_bounds(path)
+        if result is not None:
+            _record('get_bounds', pathkey, start, True)
+            return result
+    
+    db = shelf()
+    hit = pathkey in db
+    if not hit:
+        if open3dhub.OFFLINE:
+            # a known rejection says more than the miss
+            try:
+                check_admission(path)
+            except CacheMiss:
+                pass
+            raise CacheMiss([pathkey])
+        check_admission(path)
+        # network and HTTP errors may be transient, so only failures to
+        # use a downloaded mesh are remembered
+        metadata, mesh_data = open3dhub.path_to_mesh_data(path)
+        try:
+            db[pathkey] = _compute_bounds(metadata, mesh_data)
+        except IOError:
+            # e.g. a subfile fetched while parsing
+            raise
+        except Exception, ex:
+            db[_failed_key(path)] = '%s: %s' % (type(ex).__name__, ex)
+            raise
     
-    return SHELF[pathkey]
+    result = db[pathkey]
+    _record('get_bounds', pathkey, start, hit)
+    return result
 
 def get_metadata(path):
+    start = time.time()
     key = 'METADATA_' + str(path)
-    if key not in SHELF:
-        metadata, mesh = open3dhub.path_to_mesh(path)
-        SHELF[key] = metadata
+    if _shared is not None:
+        result = _shared.get_metadata(path)
+        if result is not None:
+            _record('get_metadata', key, start, True)
+            return result
+    
+    db = shelf()
+    hit = key in db
+    if not hit:
+        if open3dhub.OFFLINE:
+            raise CacheMiss([key])
+        metadata, validators = open3dhub.get_single_metadata_validated(path)
+        db[key] = metadata
+        db[_validators_key(key)] = validators
+    
+    result = db[key]
+    _record('get_metadata', key, start, hit)
+    return result
+
+def missing_keys(tags=(), paths=()):
+    """Dry run of get_tag for tags and of get_metadata and get_bounds for
+    paths and every admitted model of the tags. Returns the keys of the
+    entries that are not cached, without touching the network."""
+    db = shelf()
+    missing = []
+    paths = list(paths)
+    for tag in tags:
+        tagkey = 'TAG_' + str(tag)
+        if tagkey not in db:
+            missing.append(tagkey)
+            continue
+        paths.extend(item['full_path'] for item in open3dhub.ADMISSION_POLICY.filter(db[tagkey]))
+    
+    seen = set()
+    for path in paths:
+        if path in seen or _failed_key(path) in db:
+            continue
+        seen.add(path)
+        
+        metakey = 'METADATA_' + str(path)
+        metadata = _shared.get_metadata(path) if _shared is not None else None
+        if metadata is None:
+            metadata = db.get(metakey)
+        if metadata is None:
+            missing.append(metakey)
+        elif not open3dhub.ADMISSION_POLICY.admits(metadata):
+            continue
+        
+        pathkey = 'BOUNDS_' + str(path)
+        if pathkey not in db and (_shared is None or _shared.get_bounds(path) is None):
+            missing.append(pathkey)
+    
+    return missing
+
+def _revalidate_entry(job):
+    """Returns (key, result) where result is None if the entry is still
+    valid, (value, validators) if it changed, or the exception raised"""
+    key, validators = job
+    try:
+        if key.startswith('TAG_'):
+            if validators is not None and not open3dhub.search_list_changed(validators):
+                return key, None
+            return key, open3dhub.get_search_list_validated('tags:"%s"' % key[len('TAG_'):])
+        
+        metadata, validators = open3dhub.get_single_metadata_validated(key[len('METADATA_'):], validators)
+        if metadata is None:
+            return key, None
+        return key, (metadata, validators)
+    except Exception, ex:
+        return key, ex
+
+def revalidate(workers=16):
+    """Refreshes all cached tag and metadata entries using conditional
+    requests, run in parallel, so unchanged entries cost a 304 response.
+    Returns a dict of counts of unchanged, updated and failed entries."""
+    db = shelf()
+    jobs = []
+    for key in db.keys():
+        if key.startswith('TAG_') or key.startswith('METADATA_'):
+            jobs.append((key, db.get(_validators_key(key))))
+    
+    counts = {'unchanged': 0, 'updated': 0, 'failed': 0}
+    if len(jobs) == 0:
+        return counts
+    
+    # requests run on the pool; the shelf is only written from this thread
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        for key, result in pool.imap_unordered(telemetry.bind(_revalidate_entry), jobs):
+            if result is None:
+                counts['unchanged'] += 1
+            elif isinstance(result, Exception):
+                counts['failed'] += 1
+            else:
+                value, validators = result
+                db[key] = value
+                db[_validators_key(key)] = validators
+                counts['updated'] += 1
+    finally:
+        pool.close()
+        pool.join()
+        db.sync()
     
-    return SHELF[key]
+    return counts
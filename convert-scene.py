@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+import os
+from optparse import OptionParser
+
+import scenefile
+
+def main():
+    parser = OptionParser(usage="Usage: convert-scene.py [--compact] in.json|in.scene out.scene|out.json",
+                          description="Converts a scene between the JSON and binary formats. "
+                                      "The output is binary unless its name ends in .json.")
+    parser.add_option("--compact", dest="compact", action="store_true", default=False,
+                      help="store binary coordinates as float32 instead of float64")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        parser.exit(1, "Wrong number of arguments.\n")
+
+    if not os.path.isfile(args[0]):
+        parser.print_help()
+        parser.exit(1, "Input file '%s' is not a valid file.\n" % args[0])
+
+    infile, outfile = args
+    json_data = scenefile.read_json(infile)
+    if outfile.endswith('.json'):
+        scenefile.write_json(outfile, json_data)
+    else:
+        scenefile.write(outfile, json_data, compact=options.compact)
+
+    print 'Converted %d models from %s (%d bytes) to %s (%d bytes)' % \
+            (len(json_data), infile, os.path.getsize(infile), outfile, os.path.getsize(outfile))
+
+if __name__ == '__main__':
+    main()
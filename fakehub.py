@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+"""Local stand-in for the open3dhub API and CDN
+
+Serves the browse, search, modelinfo, dns and download endpoints used by
+open3dhub.py from a directory of fixture models, optionally recording
+misses from a real upstream server into that directory. Latency,
+bandwidth and error rates can be injected so that network behaviour can
+be measured repeatably offline.
+
+Point the client code at it with open3dhub.set_base_url(server.url) or
+by setting OPEN3DHUB_URL in the environment.
+"""
+
+import os
+import re
+import json
+import gzip
+import time
+import hashlib
+import random
+import urllib
+import urlparse
+import posixpath
+import threading
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+from optparse import OptionParser
+
+from open3dhub import model_tags
+
+SEARCH_ROWS = 100
+BROWSE_ROWS = 100
+WRITE_CHUNK_SIZE = 16 * 1024
+
+def _quote(s):
+    return urllib.quote(s, safe='')
+
+class FixtureStore(object):
+    """A directory of fixture models laid out as::
+
+        modelinfo/<quoted full path>.json  modelinfo JSON for each model
+        download/<hash>                    content addressed files
+        dns.json                           subfile path to hash mapping
+        responses/<quoted request uri>     verbatim recorded responses
+
+    Search and browse requests are answered from recorded responses when
+    present and are otherwise synthesized from the modelinfo files.
+    """
+    def __init__(self, root):
+        self.root = root
+        for subdir in ('modelinfo', 'download', 'responses'):
+            path = os.path.join(root, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self._lock = threading.Lock()
+
+        self._dns = {}
+        if os.path.isfile(self._dns_file):
+            self._dns = json.load(open(self._dns_file))
+
+        self._models = {}
+        modeldir = os.path.join(root, 'modelinfo')
+        for fname in os.listdir(modeldir):
+            if fname.endswith('.json'):
+                info = json.load(open(os.path.join(modeldir, fname)))
+                self._models[info['full_path']] = info
+
+    _dns_file = property(lambda s: os.path.join(s.root, 'dns.json'))
+
+    def models(self):
+        with self._lock:
+            return [self._models[k] for k in sorted(self._models)]
+
+    def modelinfo(self, path):
+        with self._lock:
+            return self._models.get(posixpath.normpath(path))
+
+    def add_modelinfo(self, info):
+        fname = os.path.join(self.root, 'modelinfo', _quote(info['full_path']) + '.json')
+        with open(fname, 'w') as f:
+            json.dump(info, f)
+        with self._lock:
+            self._models[info['full_path']] = info
+
+    def download_file(self, dlhash):
+        fname = os.path.join(self.root, 'download', _quote(dlhash))
+        return fname if os.path.isfile(fname) else None
+
+    def add_download(self, dlhash, data):
+        with open(os.path.join(self.root, 'download', _quote(dlhash)), 'wb') as f:
+            f.write(data)
+
+    def dns(self, subfile_path):
+        with self._lock:
+            return self._dns.get(subfile_path)
+
+    def add_dns(self, subfile_path, dlhash):
+        with self._lock:
+            self._dns[subfile_path] = dlhash
+            with open(self._dns_file, 'w') as f:
+                json.dump(self._dns, f, indent=2)
+
+    def response(self, uri):
+        fname = os.path.join(self.root, 'responses', _quote(uri))
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'rb') as f:
+            return f.read()
+
+    def add_response(self, uri, data):
+        with open(os.path.join(self.root, 'responses', _quote(uri)), 'wb') as f:
+            f.write(data)
+
+    def search(self, q):
+        """Returns the models matching every tags:"..." term in q. Any
+        other words must appear in the model's title."""
+        tags = re.findall(r'tags:"([^"]*)"', q) + re.findall(r'tags:([^"\s]+)', q)
+        words = re.sub(r'tags:("[^"]*"|\S+)', ' ', q).lower().split()
+
+        matches = []
+        for info in self.models():
+            model_tag_set = set(model_tags(info))
+            if not all(t in model_tag_set for t in tags):
+                continue
+            title = info.get('metadata', {}).get('title', '').lower()
+            if not all(w in title for w in words):
+                continue
+            matches.append(info)
+        return matches
+
+class Faults(object):
+    """Latency, bandwidth and error injection shared by all requests
+
+    latency and jitter are in seconds, bandwidth in bytes per second per
+    response (None for unlimited) and error_rate is the fraction of
+    requests answered with 503 Service Unavailable."""
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def should_fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def write(self, wfile, data):
+        if not self.bandwidth:
+            wfile.write(data)
+            return
+        for start in range(0, len(data), WRITE_CHUNK_SIZE):
+            chunk = data[start:start+WRITE_CHUNK_SIZE]
+            wfile.write(chunk)
+            time.sleep(len(chunk) / float(self.bandwidth))
+
+class FakeHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = 'fakehub/1.0'
+    # keep-alive, so client connection pooling behaves as against a CDN
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        faults = self.server.faults
+        faults.delay()
+        if faults.should_fail():
+            return self.send_body('injected failure', status=503, content_type='text/plain')
+
+        parsed = urlparse.urlparse(self.path)
+        path = urllib.unquote(parsed.path)
+
+        try:
+            if path.startswith('/download/'):
+                return self.do_download(path[len('/download/'):])
+            elif path.startswith('/dns/'):
+                return self.do_dns(path[len('/dns'):])
+            elif path.startswith('/api/modelinfo/'):
+                return self.do_modelinfo('/' + path[len('/api/modelinfo/'):].lstrip('/'))
+            elif path.startswith('/api/search'):
+                return self.do_search(urlparse.parse_qs(parsed.query))
+            elif path.startswith('/api/browse'):
+                return self.do_browse(path[len('/api/browse'):].strip('/'))
+        except Exception, ex:
+            return self.send_body(str(ex), status=500, content_type='text/plain')
+
+        return self.send_body('not found', status=404, content_type='text/plain')
+
+    def send_body(self, data, status=200, content_type='application/json', headers=None):
+        if status == 200:
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            headers = dict(headers or {})
+            headers['ETag'] = etag
+
+        encoding = None
+        accept = self.headers.get('Accept-Encoding', '')
+        if self.server.gzip and status == 200 and 'gzip' in accept:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(data)
+            data = buf.getvalue()
+            encoding = 'gzip'
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        for key, val in (headers or {}).iteritems():
+            self.send_header(key, val)
+        self.end_headers()
+        self.server.faults.write(self.wfile, data)
+
+    def send_json(self, obj):
+        self.send_body(json.dumps(obj))
+
+    def fetch_upstream(self):
+        """Fetches the current request from the upstream server when
+        recording, returning the body or None on a miss"""
+        if self.server.upstream is None:
+            return None
+        import requests
+        resp = requests.get(self.server.upstream + self.path)
+        if resp.status_code != 200:
+            return None
+        return resp.content
+
+    def do_download(self, dlhash):
+        fname = self.server.store.download_file(dlhash)
+        if fname is None:
+            data = self.fetch_upstream()
+            if data is None:
+                return self.send_body('not found', status=404, content_type='text/plain')
+            self.server.store.add_download(dlhash, data)
+            fname = self.server.store.download_file(dlhash)
+
+        with open(fname, 'rb') as f:
+            data = f.read()
+
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match is None:
+            return self.send_body(data, content_type='application/octet-stream')
+
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(data) - 1
+        end = min(end, len(data) - 1)
+        if start > end:
+            return self.send_body('', status=416, content_type='text/plain')
+
+        # ranged responses are never compressed, so bypass send_body's gzip
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+        self.end_headers()
+        self.server.faults.write(self.wfile, data[start:end+1])
+
+    def do_dns(self, subfile_path):
+        dlhash = self.server.store.dns(subfile_path)
+        if dlhash is None:
+            data = self.fetch_upstream()
+            if data is None:
+                return self.send_body('not found', status=404, content_type='text/plain')
+            dlhash = json.loads(data)['Hash']
+            self.server.store.add_dns(subfile_path, dlhash)
+        self.send_json({'Hash': dlhash})
+
+    def do_modelinfo(self, path):
+        info = self.server.store.modelinfo(path)
+        if info is None:
+            data = self.fetch_upstream()
+            if data is None:
+                return self.send_body('not found', status=404, content_type='text/plain')
+            info = json.loads(data)
+            self.server.store.add_modelinfo(info)
+        self.send_json(info)
+
+    def recorded(self):
+        """Returns a recorded response for this request, recording it from
+        upstream first if needed"""
+        data = self.server.store.response(self.path)
+        if data is None:
+            data = self.fetch_upstream()
+            if data is not None:
+                self.server.store.add_response(self.path, data)
+        return data
+
+    def do_search(self, query):
+        data = self.recorded()
+        if data is not None:
+            return self.send_body(data)
+
+        q = query.get('q', [''])[0]
+        start = int(query.get('start', ['0'])[0])
+        rows = int(query.get('rows', [str(SEARCH_ROWS)])[0])
+        matches = self.server.store.search(q)
+        self.send_json(_page(matches, start, rows))
+
+    def do_browse(self, start):
+        data = self.recorded()
+        if data is not None:
+            return self.send_body(data)
+
+        start = int(start) if start else 0
+        self.send_json(_page(self.server.store.models(), start, BROWSE_ROWS))
+
+def _page(items, start, rows):
+    next_start = start + rows
+    return {'content_items': items[start:next_start],
+            'next_start': next_start if next_start < len(items) else None}
+
+class FakeHubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded fake open3dhub server. Use port 0 to pick a free port."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store, host='127.0.0.1', port=0, faults=None,
+                 upstream=None, gzip=False, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), FakeHubHandler)
+        self.store = store
+        self.faults = faults if faults is not None else Faults()
+        self.upstream = upstream.rstrip('/') if upstream is not None else None
+        self.gzip = gzip
+        self.verbose = verbose
+
+    url = property(lambda s: 'http://%s:%d' % s.server_address)
+
+    def start(self):
+        """Serves from a background thread and returns self"""
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+def main():
+    parser = OptionParser(usage="Usage: fakehub.py [options] fixtures/",
+                          description="Serves a local stand-in for the open3dhub API from a fixture directory")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8080,
+                      help="port to listen on (default 8080)")
+    parser.add_option("--record", dest="record", metavar="URL",
+                      help="fetch misses from URL and record them into the fixture directory")
+    parser.add_option("--latency", dest="latency", type="float", default=0.0,
+                      help="added latency per request in milliseconds")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0.0,
+                      help="random extra latency of up to this many milliseconds")
+    parser.add_option("--bandwidth", dest="bandwidth", type="float", default=None,
+                      help="per-response bandwidth limit in KB/s")
+    parser.add_option("--error-rate", dest="error_rate", type="float", default=0.0,
+                      help="fraction of requests that fail with 503")
+    parser.add_option("--seed", dest="seed", type="int", default=None,
+                      help="random seed for jitter and error injection")
+    parser.add_option("--gzip", dest="gzip", action="store_true", default=False,
+                      help="gzip-encode responses for clients that accept it")
+    parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                      help="log every request")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        parser.exit(1, "Wrong number of arguments.\n")
+
+    faults = Faults(latency=options.latency / 1000.0,
+                    jitter=options.jitter / 1000.0,
+                    bandwidth=options.bandwidth * 1024 if options.bandwidth else None,
+                    error_rate=options.error_rate,
+                    seed=options.seed)
+    server = FakeHubServer(FixtureStore(args[0]), port=options.port, faults=faults,
+                           upstream=options.record, gzip=options.gzip,
+                           verbose=options.verbose)
+
+    print 'Serving %s on %s' % (args[0], server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
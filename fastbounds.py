@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+"""Bounds of a COLLADA document without building a pycollada scene
+
+get_bounds_info() streams a DAE document, keeping only the position
+sources of its geometries and the node hierarchy of its scene, and
+computes the same bounding box, center and center-farthest distance as
+meshtool's getBoundsInfo with numpy. Materials, effects, images and
+animations are discarded as they are parsed.
+
+Run as a script, it cross-checks the fast extractor against getBoundsInfo
+for the given models and reports any mismatches, and the time and
+downloads of a cold bounds computation along both paths.
+"""
+
+import sys
+import math
+import time
+from StringIO import StringIO
+from optparse import OptionParser
+from xml.etree import cElementTree as etree
+
+import numpy
+
+PRIMITIVE_TAGS = set(['triangles', 'polylist', 'polygons', 'lines'])
+UNSUPPORTED_PRIMITIVE_TAGS = set(['linestrips', 'tristrips', 'trifans'])
+
+# everything under these is irrelevant to bounds and freed while parsing
+DISCARD_LIBRARIES = set(['library_images', 'library_effects', 'library_materials',
+                         'library_animations', 'library_animation_clips',
+                         'library_controllers', 'library_cameras', 'library_lights'])
+
+class UnsupportedError(Exception):
+    """Raised for documents the fast path can't handle, such that callers
+    should fall back to a full pycollada load"""
+    pass
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+def _ref(url):
+    return url[1:] if url.startswith('#') else url
+
+def _floats(text):
+    if text is None:
+        return numpy.zeros(0, dtype=numpy.float64)
+    return numpy.fromstring(text, dtype=numpy.float64, sep=' ')
+
+def _ints(text):
+    if text is None:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.fromstring(text, dtype=numpy.int64, sep=' ')
+
+def _rotation(x, y, z, degrees):
+    # like pycollada, the axis is used as given rather than normalized
+    m = numpy.identity(4)
+    a = math.radians(degrees)
+    c, s = math.cos(a), math.sin(a)
+    t = 1 - c
+    m[:3,:3] = [[t*x*x + c,   t*x*y - s*z, t*x*z + s*y],
+                [t*x*y + s*z, t*y*y + c,   t*y*z - s*x],
+                [t*x*z - s*y, t*y*z + s*x, t*z*z + c]]
+    return m
+
+def _node_matrix(node):
+    """Returns the 4x4 local transform of a <node> element"""
+    matrix = numpy.identity(4)
+    for child in node:
+        tag = _local(child.tag)
+        if tag == 'matrix':
+            m = _floats(child.text).reshape((4, 4))
+        elif tag == 'translate':
+            m = numpy.identity(4)
+            m[:3,3] = _floats(child.text)
+        elif tag == 'rotate':
+            m = _rotation(*_floats(child.text))
+        elif tag == 'scale':
+            m = numpy.diag(numpy.append(_floats(child.text), 1.0))
+        elif tag in ('lookat', 'skew'):
+            raise UnsupportedError('<%s> transforms are not supported' % tag)
+        else:
+            continue
+        matrix = numpy.dot(matrix, m)
+    return matrix
+
+class _Document(object):
+    """The parts of a DAE document needed for bounds"""
+    def __init__(self, data):
+        self.sources = {}           # source id -> (N, 3) positions or (text, stride)
+        self.vertices = {}          # vertices id -> position source id
+        self.geometries = {}        # geometry id -> list of (vertices id, indices)
+        self.nodes = {}             # library node id -> element
+        self.visual_scenes = {}     # visual scene id -> element
+        self.scene_url = None
+
+        path = []
+        geometry_id = None
+        for event, elem in etree.iterparse(StringIO(data), events=('start', 'end')):
+            tag = _local(elem.tag)
+            if event == 'start':
+                path.append(tag)
+                if tag == 'geometry':
+                    geometry_id = elem.get('id')
+                    self.geometries[geometry_id] = []
+                continue
+
+            path.pop()
+            if any(p in DISCARD_LIBRARIES for p in path) or tag in DISCARD_LIBRARIES:
+                elem.clear()
+            elif tag == 'source' and 'library_geometries' in path:
+                self._add_source(elem)
+                elem.clear()
+            elif tag == 'vertices':
+                for inp in elem:
+                    if _local(inp.tag) == 'input' and inp.get('semantic') == 'POSITION':
+                        self.vertices[elem.get('id')] = _ref(inp.get('source'))
+            elif tag in PRIMITIVE_TAGS and geometry_id is not None:
+                self._add_primitive(geometry_id, elem)
+                elem.clear()
+            elif tag in UNSUPPORTED_PRIMITIVE_TAGS and 'library_geometries' in path:
+                raise UnsupportedError('<%s> primitives are not supported' % tag)
+            elif tag == 'geometry':
+                geometry_id = None
+                elem.clear()
+            elif tag == 'node' and path and path[-1] == 'library_nodes':
+                self.nodes[elem.get('id')] = elem
+            elif tag == 'visual_scene':
+                self.visual_scenes[elem.get('id')] = elem
+            elif tag == 'instance_visual_scene' and 'scene' in path:
+                self.scene_url = _ref(elem.get('url'))
+
+    def _add_primitive(self, geometry_id, elem):
+        vertices_id = None
+        vertex_offset = 0
+        stride = 1
+        indices = []
+        for child in elem:
+            tag = _local(child.tag)
+            if tag == 'input':
+                offset = int(child.get('offset', 0))
+                stride = max(stride, offset + 1)
+                if child.get('semantic') == 'VERTEX':
+                    vertices_id = _ref(child.get('source'))
+                    vertex_offset = offset
+            elif tag == 'p':
+                indices.append(_ints(child.text))
+        if vertices_id is None or len(indices) == 0:
+            return
+        indices = numpy.concatenate(indices)
+        indices = indices[:(len(indices) // stride) * stride][vertex_offset::stride]
+        if len(indices) > 0:
+            self.geometries[geometry_id].append((vertices_id, indices))
+
+    def _add_source(self, elem):
+        # parsing the numbers is most of the cost, so only the text is kept
+        # here and parsed later if the source turns out to hold positions
+        float_array = None
+        stride = 3
+        for child in elem.iter():
+            tag = _local(child.tag)
+            if tag == 'float_array':
+                float_array = child
+            elif tag == 'accessor':
+                stride = int(child.get('stride', 1))
+        if float_array is None or stride < 3:
+            return
+        self.sources[elem.get('id')] = (float_array.text, stride)
+
+    def _positions(self, source_id):
+        source = self.sources.get(source_id)
+        if source is None:
+            return None
+        if isinstance(source, tuple):
+            text, stride = source
+            values = _floats(text)
+            values = values[:(len(values) // stride) * stride].reshape((-1, stride))
+            source = self.sources[source_id] = values[:,:3]
+        return source
+
+    def geometry_positions(self, geometry_id):
+        """Returns a list of the arrays of positions referenced by each of
+        a geometry's primitives"""
+        arrays = []
+        for vertices_id, indices in self.geometries.get(geometry_id, ()):
+            positions = self._positions(self.vertices.get(vertices_id, vertices_id))
+            if positions is None:
+                continue
+            if indices.max() >= len(positions):
+                raise UnsupportedError('index out of range in geometry %s' % geometry_id)
+            arrays.append(positions[indices])
+        return arrays
+
+    def instances(self):
+        """Yields (positions, world matrix) for every geometry instance
+        in the document's scene"""
+        if self.scene_url is None or self.scene_url not in self.visual_scenes:
+            raise UnsupportedError('document has no scene')
+        stack = [(node, numpy.identity(4), 0) for node in self.visual_scenes[self.scene_url]
+                 if _local(node.tag) == 'node']
+        while stack:
+            node, parent, depth = stack.pop()
+            if depth > 64:
+                raise UnsupportedError('node hierarchy too deep or cyclic')
+            world = numpy.dot(parent, _node_matrix(node))
+            for child in node:
+                tag = _local(child.tag)
+                if tag == 'node':
+                    stack.append((child, world, depth + 1))
+                elif tag == 'instance_node':
+                    target = self.nodes.get(_ref(child.get('url')))
+                    if target is not None:
+                        stack.append((target, world, depth + 1))
+                elif tag == 'instance_geometry':
+                    for positions in self.geometry_positions(_ref(child.get('url'))):
+                        yield positions, world
+                elif tag == 'instance_controller':
+                    raise UnsupportedError('skinned and morphed geometry is not supported')
+
+def get_bounds_info(data):
+    """Returns a dict with 'bounds' (min, max), 'center', 'center_farthest'
+    and 'center_farthest_distance' for the DAE document in the string
+    data, matching meshtool's getBoundsInfo. Raises UnsupportedError if the
+    document can't be handled without pycollada."""
+    try:
+        doc = _Document(data)
+    except SyntaxError, ex:
+        raise UnsupportedError('could not parse document: %s' % ex)
+
+    transformed = []
+    for positions, world in doc.instances():
+        transformed.append(numpy.dot(positions, world[:3,:3].T) + world[:3,3])
+    if len(transformed) == 0:
+        raise UnsupportedError('document has no geometry in its scene')
+
+    minpt = numpy.min([numpy.min(pts, axis=0) for pts in transformed], axis=0).astype(numpy.float32)
+    maxpt = numpy.max([numpy.max(pts, axis=0) for pts in transformed], axis=0).astype(numpy.float32)
+    center = (maxpt - minpt) / 2 + minpt
+
+    farthest_distance = -1.0
+    farthest = None
+    for pts in transformed:
+        diff = pts - center
+        dists = numpy.einsum('ij,ij->i', diff, diff)
+        idx = dists.argmax()
+        if dists[idx] > farthest_distance:
+            farthest_distance = dists[idx]
+            farthest = pts[idx].astype(numpy.float32)
+
+    return {'bounds': (minpt, maxpt),
+            'center': center,
+            'center_farthest': farthest,
+            'center_farthest_distance': float(numpy.sqrt(farthest_distance))}
+
+def compare(fast, slow, tolerance=1e-4):
+    """Returns a list of descriptions of where two bounds infos differ by
+    more than tolerance relative to the slow farthest distance"""
+    scale = max(slow['center_farthest_distance'], 1e-12)
+    errors = []
+    checks = [('min', fast['bounds'][0], slow['bounds'][0]),
+              ('max', fast['bounds'][1], slow['bounds'][1]),
+              ('center', fast['center'], slow['center']),
+              ('center_farthest_distance', fast['center_farthest_distance'], slow['center_farthest_distance'])]
+    for name, a, b in checks:
+        diff = numpy.max(numpy.abs(numpy.asarray(a, dtype=numpy.float64) - numpy.asarray(b, dtype=numpy.float64)))
+        if diff / scale > tolerance:
+            errors.append('%s: fast %s != slow %s' % (name, a, b))
+    return errors
+
+def _http_totals(events):
+    """Returns (requests, bytes on the wire) of the HTTP telemetry events"""
+    http = [e for e in events if e['kind'] == 'http']
+    return len(http), sum(e.get('wire_bytes', 0) for e in http)
+
+def main():
+    parser = OptionParser(usage="Usage: fastbounds.py [-t tag] [path ...]",
+                          description="Cross-checks fast bounds extraction against meshtool's getBoundsInfo")
+    parser.add_option("-t", "--tag", dest="tags", action="append", default=[],
+                      help="check every model with TAG (may be repeated)", metavar="TAG")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=1e-4,
+                      help="allowed difference relative to the model's size (default 1e-4)")
+    (options, args) = parser.parse_args()
+
+    from meshtool.filters.print_filters.print_bounds import getBoundsInfo
+    import open3dhub
+    import cache
+    import telemetry
+
+    paths = list(args)
+    for tag in options.tags:
+        paths.extend(m['full_path'] for m in cache.get_tag(tag))
+
+    if len(paths) == 0:
+        parser.print_help()
+        parser.exit(1, "No models to check.\n")
+
+    # every model is timed cold, fetched from the server as on a cache
+    # miss: the fast path downloads only the mesh document, while a full
+    # load also downloads whatever subfiles pycollada asks for
+    telemetry.enable()
+    totals = {'fast_cold': 0.0, 'slow_cold': 0.0, 'fast_parse': 0.0, 'slow_parse': 0.0,
+              'fast_requests': 0, 'slow_requests': 0, 'fast_bytes': 0, 'slow_bytes': 0}
+    mismatched = unsupported = 0
+    for path in paths:
+        telemetry.reset()
+        start = time.time()
+        metadata, mesh_data = open3dhub.path_to_mesh_data(path)
+        parse_start = time.time()
+        try:
+            fast = get_bounds_info(mesh_data)
+        except UnsupportedError, ex:
+            print 'UNSUPPORTED %s: %s' % (path, ex)
+            unsupported += 1
+            continue
+        fast_parse = time.time() - parse_start
+        fast_cold = time.time() - start
+        fast_requests, fast_bytes = _http_totals(telemetry.events())
+
+        telemetry.reset()
+        start = time.time()
+        metadata, mesh = open3dhub.path_to_mesh(path)
+        slow = getBoundsInfo(mesh)
+        slow_cold = time.time() - start
+        slow_requests, slow_bytes = _http_totals(telemetry.events())
+
+        start = time.time()
+        getBoundsInfo(open3dhub.parse_mesh(metadata, mesh_data))
+        slow_parse = time.time() - start
+
+        for key, value in [('fast_cold', fast_cold), ('slow_cold', slow_cold),
+                           ('fast_parse', fast_parse), ('slow_parse', slow_parse),
+                           ('fast_requests', fast_requests), ('slow_requests', slow_requests),
+                           ('fast_bytes', fast_bytes), ('slow_bytes', slow_bytes)]:
+            totals[key] += value
+
+        errors = compare(fast, slow, options.tolerance)
+        if len(errors) > 0:
+            mismatched += 1
+            print 'MISMATCH %s' % path
+            for error in errors:
+                print '    ' + error
+        else:
+            print 'ok %s (cold %.1f ms in %d requests vs %.1f ms in %d requests)' % \
+                    (path, fast_cold * 1000, fast_requests, slow_cold * 1000, slow_requests)
+
+    print
+    print 'Checked %d models: %d mismatched, %d unsupported' % (len(paths), mismatched, unsupported)
+    if totals['fast_cold'] > 0:
+        print 'Cold: fast %.2fs, %d requests, %.1f KB; full load %.2fs, %d requests, %.1f KB; speedup %.1fx' % \
+                (totals['fast_cold'], totals['fast_requests'], totals['fast_bytes'] / 1024.0,
+                 totals['slow_cold'], totals['slow_requests'], totals['slow_bytes'] / 1024.0,
+                 totals['slow_cold'] / totals['fast_cold'])
+    if totals['fast_parse'] > 0:
+        print 'Parse only: fast %.2fs, full load %.2fs, speedup %.1fx' % \
+                (totals['fast_parse'], totals['slow_parse'], totals['slow_parse'] / totals['fast_parse'])
+
+    if mismatched > 0:
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
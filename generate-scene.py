@@ -2,8 +2,8 @@
 
 import os
 import sys
-import json
 import math
+import itertools
 import numpy
 import random
 import collada
@@ -16,10 +16,15 @@ from panda3d.core import Vec3, Quat
 from clint.textui import progress
 from collada.util import normalize_v3
 
-import poisson_disk
+import broadphase
 import cache
 import open3dhub
+import placement
 import scene
+import scenefile
+import sharedcatalog
+import telemetry
+import tiles
 
 TERRAIN_PATH = '/jterrace/terrain.dae/0'
 ROAD_PATH = '/kittyvision/street.dae/0'
@@ -36,21 +41,30 @@ def get_tag_type(tag):
     print 'received %d' % len(L)
     return L
 
-def get_models():
-    model_types = {
-        'houses': get_tag_type('house'),
-        'trees': get_tag_type('tree'),
-        'plants': get_tag_type('plant'),
-        #'lawn': get_tag_type('lawn'),
-        'flying': get_tag_type('flying'),
-        'boats': get_tag_type('boat'),
-        'winter': get_tag_type('winter'),
-        #'street': get_tag_type('street'),
-        #'underwater': get_tag_type('underwater'),
-        'vehicles': get_tag_type('vehicle'),
-        'buildings': get_tag_type('building'),
-        #'roads': get_tag_type('road'),
-    }
+# model categories and the tag each is searched by
+MODEL_TAGS = {
+    'houses': 'house',
+    'trees': 'tree',
+    'plants': 'plant',
+    #'lawn': 'lawn',
+    'flying': 'flying',
+    'boats': 'boat',
+    'winter': 'winter',
+    #'street': 'street',
+    #'underwater': 'underwater',
+    'vehicles': 'vehicle',
+    'buildings': 'building',
+    #'roads': 'road',
+}
+
+def get_models(tag_index=None):
+    """Returns a dict of model category to list of catalog items. If a
+    tagindex.TagIndex is given, categories are queried from it locally
+    instead of through the cache and search API."""
+    if tag_index is not None:
+        return get_indexed_models(tag_index)
+    
+    model_types = dict((name, get_tag_type(tag)) for name, tag in sorted(MODEL_TAGS.iteritems()))
     
     trees = set(m['full_path'] for m in model_types['trees'])
     model_types['shrubs'] = [m for m in model_types['plants'] if m['full_path'] not in trees]
@@ -60,14 +74,171 @@ def get_models():
     
     return model_types
 
+INDEXED_MODEL_QUERIES = {
+    'houses': 'house',
+    'trees': 'tree',
+    'plants': 'plant',
+    'flying': 'flying',
+    'boats': 'boat',
+    'winter': 'winter',
+    'vehicles': 'vehicle',
+    'buildings': 'building',
+    'shrubs': 'plant AND NOT tree',
+    'commercial_buildings': 'building AND NOT house',
+}
+
+def get_indexed_models(tag_index):
+    policy = open3dhub.ADMISSION_POLICY
+    failed = cache.failed_paths()
+    model_types = {}
+    for name, q in sorted(INDEXED_MODEL_QUERIES.iteritems()):
+        model_types[name] = [m for m in policy.filter(tag_index.query(q))
+                             if m['full_path'] not in failed]
+        print 'Query "%s" matched %d' % (q, len(model_types[name]))
+    return model_types
+
+def missing_cache_keys(tag_index=None):
+    """Returns the cache keys a generation run would have to fetch"""
+    paths = [TERRAIN_PATH, ROAD_PATH]
+    if tag_index is None:
+        return cache.missing_keys(MODEL_TAGS.values(), paths)
+    for q in INDEXED_MODEL_QUERIES.itervalues():
+        paths.extend(tag_index.query_paths(q))
+    return cache.missing_keys(paths=paths)
+
+def exit_if_missing(parser, missing):
+    """Lists the missing cache keys and exits if there are any"""
+    if len(missing) > 0:
+        for key in missing:
+            print >> sys.stderr, key
+        parser.exit(1, "%d cache entries are missing for offline generation.\n" % len(missing))
+
+def center_points(centers):
+    """Returns the mapgen coordinates of map centers as an (N, 3) array"""
+    return numpy.array([(c.x, c.y, c.elevation * Z_SCALE) for c in centers],
+                       dtype=numpy.float32).reshape(-1, 3)
+
+# size of the cells of the scene's occupancy grid, about a house's width
+OCCUPANCY_CELL_SIZE = 16.0
+
+# model types that the models of a type may overlap
+MAY_OVERLAP = {
+    'road': ['road'],
+    'tree': ['tree'],
+    'vehicle': ['road'],
+}
+
+# The stages in the order their candidates are generated and placed, as
+# (name, model type, rule). With rule 'each', every batch of candidates
+# is placed as it comes; with 'all', the stage's candidates are placed
+# together; 'zone' first drops those overlapping an earlier candidate.
+STAGES = [
+    ('road objects', 'road', 'all'),
+    ('Sparse Forest', 'tree', 'each'),
+    ('Dense Forest', 'tree', 'each'),
+    ('Residential Buildings', 'house', 'zone'),
+    ('Commercial Buildings', 'commercial', 'zone'),
+    ('winter objects', 'winter', 'all'),
+    ('vehicles', 'vehicle', 'all'),
+    ('flying objects', 'flying', 'all'),
+    ('boat objects', 'boat', 'all'),
+]
+STAGE_ORDER = dict((name, i) for i, (name, model_type, rule) in enumerate(STAGES))
+
+def owned_centers(centers, shard=None):
+    """Returns (index, center) of the centers that shard, an (i, N) pair,
+    generates, or of all centers if shard is None"""
+    return [(index, c) for index, c in enumerate(centers)
+            if shard is None or placement.shard_of(c.id, shard[1]) == shard[0]]
+
+def remove_overlapping(models):
+    """Returns the models of a scene.SceneModelArray, last first, that
+    overlap none of the models before them"""
+    minpts, maxpts = models.world_bounds()
+    keep = broadphase.keep_first(minpts, maxpts)
+    return models.subset(numpy.flatnonzero(keep)[::-1])
+
+def place_models(occupancy, models, model_type):
+    """Returns the models of a scene.SceneModelArray that overlap nothing
+    already in the broadphase.OccupancyGrid occupancy, nor each other,
+    except where MAY_OVERLAP allows it, and adds them to it"""
+    minpts, maxpts = models.placed_bounds()
+    placed = occupancy.place(minpts, maxpts, model_type, MAY_OVERLAP.get(model_type, ()))
+    return models.subset(placed)
+
+def place_stage(occupancy, model_type, rule, batches):
+    """Yields the records of the candidate SceneModelArrays of a stage
+    that are placed in occupancy, following the stage's rule"""
+    if rule == 'each':
+        for models in batches:
+            for j in place_models(occupancy, models, model_type).to_json():
+                yield j
+        return
+    
+    batches = list(batches)
+    if len(batches) == 0:
+        return
+    models = scene.SceneModelArray.concatenate(batches)
+    if rule == 'zone':
+        models = remove_overlapping(models)
+    for j in place_models(occupancy, models, model_type).to_json():
+        yield j
+
+def end_stage(name, groups):
+    """Yields groups, then the group (name, None, None) that ends stage
+    name"""
+    for group in groups:
+        yield group
+    yield name, None, None
+
+def place_candidates(groups, write):
+    """Places candidate groups of (stage name, center index,
+    SceneModelArray), ordered as generated, in a new occupancy grid and
+    passes the records of each stage to write. Groups are pulled inside
+    the stage they belong to. A stage ends at its end_stage group, so the
+    next stage's first group isn't generated early, or else at the first
+    group of a later stage."""
+    occupancy = broadphase.OccupancyGrid(OCCUPANCY_CELL_SIZE)
+    groups = iter(groups)
+    pending = []
+    
+    def batches(name):
+        while True:
+            if len(pending) == 0:
+                group = next(groups, None)
+                if group is None:
+                    return
+                pending.append(group)
+            stage, index, models = pending[0]
+            if stage != name:
+                return
+            del pending[:]
+            if models is None:
+                return
+            yield models
+    
+    for name, model_type, rule in STAGES:
+        with telemetry.stage(name):
+            count = write(place_stage(occupancy, model_type, rule, batches(name)))
+        print 'Generated (%d) %s' % (count, name)
+    if len(pending) == 0:
+        pending.extend(itertools.islice(groups, 1))
+    if len(pending) > 0:
+        raise ValueError('candidates of stage %r are out of order' % pending[0][0])
+
 def normal_vector(a, b, c):
     direction = numpy.cross(b - a, c - a)
     normalize_v3(direction[None, :])
     return direction
 
-def generate_roads(models, terrain, map, json_out):
-    numroads = 0
-    for center in progress.bar(map.centers.values(), label='Generating roads... '):
+def generate_roads(models, terrain, map, roads=None, shard=None):
+    """Yields the candidate roads of each center with roads. If roads is
+    a list, the records of all roads, even those of centers other shards
+    own, are appended to it for generate_vehicles."""
+    owned = set(index for index, c in owned_centers(map.centers.values(), shard))
+    for index, center in enumerate(progress.bar(map.centers.values(), label='Generating roads... ')):
+        if index not in owned and roads is None:
+            continue
         road_edges = [e for e in center.edges if e.is_road and e.corner0 is not None and e.corner1 is not None]
         if len(road_edges) != 2:
             continue
@@ -80,6 +251,7 @@ def generate_roads(models, terrain, map, json_out):
         
         region_center = numpy.array([center.x, center.y, center.elevation * Z_SCALE])
         
+        road_models = []
         for end1, edge1, edge2 in [(region_center, e1_0, e1_1), (region_center, e2_0, e2_1)]:
             end2 = v3mid(edge1, edge2)
             
@@ -98,7 +270,7 @@ def generate_roads(models, terrain, map, json_out):
                            scale=scale,
                            model_type='road')
             
-            kataboundmin, kataboundmax = scene.sirikata_bounds(m.boundsInfo)
+            kataboundmin, kataboundmax = scene.BOUNDS.bounds(ROAD_PATH)
             scenemin = kataboundmin * scale + midpt
             scenemax = kataboundmax * scale + midpt
             xmid = (scenemax[0] - scenemin[0]) / 2.0 + scenemin[0]
@@ -137,26 +309,26 @@ def generate_roads(models, terrain, map, json_out):
             m.orient_z = q.getK()
             m.orient_w = q.getR()
             
-            numroads += 1
-            json_out.append(m.to_json())
-    
-    print 'Generated (%d) road objects' % numroads
+            road_models.append(m)
+        
+        if roads is not None:
+            roads.extend(m.to_json() for m in road_models)
+        if index in owned:
+            yield 'road objects', index, scene.SceneModelArray.from_models(road_models, dtype=numpy.float64)
 
-def generate_flying(models, terrain, map, json_out):
-    terrain_bounds = scene.sirikata_bounds(terrain.boundsInfo)
-    minpt, maxpt = terrain_bounds
-    minpt *= terrain.scale
-    maxpt *= terrain.scale
+def generate_flying(models, terrain, map):
+    minpt, maxpt = scene.BOUNDS.bounds(terrain.path)
+    minpt = minpt * terrain.scale
+    maxpt = maxpt * terrain.scale
     height_max = (maxpt[2] - minpt[2]) * 1.20
     
     flying_models = models['flying']
     centers = map.centers.values()
     random.shuffle(centers)
     centers = centers[:len(flying_models)]
-    for center, flying_model in progress.bar(zip(centers, flying_models), label='Generating flying objects... '):
-        center_pt = numpy.array([center.x, center.y, center.elevation * Z_SCALE], dtype=numpy.float32)
-        center_pt = scene.mapgen_coords_to_sirikata(center_pt, terrain)
-
+    center_pts = scene.terrain_transform(terrain).transform(center_points(centers))
+    candidates = []
+    for center_pt, flying_model in progress.bar(zip(center_pts, flying_models), label='Generating flying objects... '):
         rand_height = random.uniform(center_pt[2], height_max) * 1.10
         
         m = scene.SceneModel(flying_model['full_path'],
@@ -165,10 +337,11 @@ def generate_flying(models, terrain, map, json_out):
                        z=rand_height,
                        scale=random.uniform(1.0, 8.0),
                        model_type='flying')
-        json_out.append(m.to_json())
-    print 'Generated (%d) flying objects' % len(flying_models)
+        candidates.append(m)
+    
+    yield 'flying objects', 0, scene.SceneModelArray.from_models(candidates, dtype=numpy.float64)
 
-def generate_boats(models, terrain, map, json_out):
+def generate_boats(models, terrain, map):
     boats = models['boats']
     oceans = [c for c in map.centers.values() if c.biome == 'OCEAN']
     lakes = [c for c in map.centers.values() if c.biome == 'LAKE']
@@ -180,9 +353,9 @@ def generate_boats(models, terrain, map, json_out):
     centers = oceans + lakes
     boats = boats + boats + boats
     
-    for center, boat_model in progress.bar(zip(centers, boats), label='Generating boats...'):
-        center_pt = numpy.array([center.x, center.y, center.elevation * Z_SCALE], dtype=numpy.float32)
-        center_pt = scene.mapgen_coords_to_sirikata(center_pt, terrain)
+    center_pts = scene.terrain_transform(terrain).transform(center_points(centers))
+    candidates = []
+    for center_pt, boat_model in progress.bar(zip(center_pts, boats), label='Generating boats...'):
         scale = random.uniform(5.0, 15.0)
         
         m = scene.SceneModel(boat_model['full_path'],
@@ -192,11 +365,11 @@ def generate_boats(models, terrain, map, json_out):
                        scale=scale,
                        model_type='boat')
         
-        json_out.append(m.to_json())
+        candidates.append(m)
     
-    print 'Generated (%d) boat objects' % len(boats)
+    yield 'boat objects', 0, scene.SceneModelArray.from_models(candidates, dtype=numpy.float64)
 
-def generate_winter(models, terrain, map, json_out):
+def generate_winter(models, terrain, map):
     winter = models['winter']
     snow = [c for c in map.centers.values() if c.biome == 'SNOW']
     random.shuffle(snow)
@@ -204,9 +377,9 @@ def generate_winter(models, terrain, map, json_out):
     winter = winter + winter
     snow = snow[:len(winter)]
     
-    for center, winter_model in progress.bar(zip(snow, winter), label='Generating winter objects...'):
-        center_pt = numpy.array([center.x, center.y, center.elevation * Z_SCALE], dtype=numpy.float32)
-        center_pt = scene.mapgen_coords_to_sirikata(center_pt, terrain)
+    center_pts = scene.terrain_transform(terrain).transform(center_points(snow))
+    candidates = []
+    for center_pt, winter_model in progress.bar(zip(center_pts, winter), label='Generating winter objects...'):
         scale = random.uniform(3.0, 10.0)
         
         m = scene.SceneModel(winter_model['full_path'],
@@ -216,17 +389,19 @@ def generate_winter(models, terrain, map, json_out):
                        scale=scale,
                        model_type='winter')
         
-        json_out.append(m.to_json())
+        candidates.append(m)
     
-    print 'Generated (%d) winter objects' % len(winter)
+    yield 'winter objects', 0, scene.SceneModelArray.from_models(candidates, dtype=numpy.float64)
 
-def generate_vehicles(models, terrain, map, json_out):
+def generate_vehicles(models, terrain, map, roads):
+    """Yields vehicles candidates on the road records in the list roads"""
     vehicles = models['vehicles']
     vehicles = vehicles + vehicles
-    roads = [j for j in json_out if j['type'] == 'road']
+    roads = list(roads)
     random.shuffle(roads)
     roads = roads[:len(vehicles)]
     
+    candidates = []
     for road, vehicle_model in progress.bar(zip(roads, vehicles), label='Generating vehicles...'):
         road_pt = numpy.array([road['x'], -1 * road['z'], road['y']], dtype=numpy.float32)
         
@@ -243,215 +418,94 @@ def generate_vehicles(models, terrain, map, json_out):
                        orient_z=road['orient_y'],
                        orient_w=road['orient_w'])
         
-        json_out.append(m.to_json())
-        
-    print 'Generated (%d) vehicles' % len(vehicles)
-
-def plane_from_points(v1, v2, v3):
-    """Computes the best fit plane through a set of points.
-    
-    Returns
-      (n, d) where n in the normal of the plane, d is the scalar offset
-    """
+        candidates.append(m)
     
-    vec1 = v1 - v2
-    vec2 = v1 - v3
-    norm = numpy.cross(vec1, vec2)
-    d = numpy.dot(norm, v3)
-    return (norm, d)
+    yield 'vehicles', 0, scene.SceneModelArray.from_models(candidates, dtype=numpy.float64)
 
 def iterate_poisson_samples(centers, map, name, radius, num_samples):
-    for center in progress.bar(centers, label='Generating %s...' % name):
-        
-        tris = []
-        for edge in center.edges:
-            corner0 = edge.corner0
-            corner1 = edge.corner1
-            center0 = edge.center0
-            center1 = edge.center1
-            if corner0 is None or corner1 is None:
-                continue
-            
-            if center.id == center0.id:
-                v1 = map.corners[corner1.id]
-                v2 = map.corners[corner0.id]
-                v3 = map.centers[center0.id]
-            elif center.id == center1.id:
-                v1 = map.centers[center1.id]
-                v2 = map.corners[corner0.id]
-                v3 = map.corners[corner1.id]
-            else:
-                continue
-            
-            tris.append((v1, v2, v3))
-            
-        for tri in tris:
-            minx = min([v.x for v in tri])
-            miny = min([v.y for v in tri])
-            maxx = max([v.x for v in tri])
-            maxy = max([v.y for v in tri])
-            width = int(maxx - minx)
-            height = int(maxy - miny)
-            
-            samples = poisson_disk.sample_poisson_uniform(width, height, radius, num_samples)
-            samples = [(x+minx, y+miny) for x,y in samples]
+    """Yields (index, samples) for each triangle of the polygons of the
+    (index, center) pairs centers, where samples is an (N, 3) float32
+    array of the mapgen coordinates of the triangle's poisson disk
+    samples"""
+    for index, center in progress.bar(centers, label='Generating %s...' % name):
+        triangles = placement.center_triangles(center, map)
+        for batch in placement.iterate_triangle_samples(triangles, radius, num_samples):
+            yield index, batch
 
-            random.shuffle(samples)
-            samples = samples[:num_samples]
-            
-            pts = numpy.array([(v.x, v.y, v.elevation * Z_SCALE) for v in tri], dtype=numpy.float32)
-            n, d = plane_from_points(*pts)
-            a, b, c = n
-            for x,y in samples:
-                # ax + by + cz = d
-                # z = (d - ax - by)/c
-                z = (d - a*x - b*y) / c
-                
-                yield (x, y, z)
-
-def generate_forest(centers, models, terrain, map, json_out, name, radius, num_samples):
+def iterate_placement_batches(centers, map, terrain, name, radius, num_samples):
+    """Yields the batches of iterate_poisson_samples transformed onto the
+    terrain"""
+    transform = scene.terrain_transform(terrain)
+    for index, batch in iterate_poisson_samples(centers, map, name, radius, num_samples):
+        yield index, transform.transform(batch, out=batch)
+
+def iterate_placements(centers, map, terrain, name, radius, num_samples, choices, scale_range,
+                       model_type, placer=None, shard=None):
+    """Yields (name, center index, SceneModelArray) for batches of
+    candidate models of model_type over the centers that shard owns, with
+    paths drawn from the catalog items choices and scales from
+    scale_range, then the group that ends the stage, as end_stage does.
+    With a placement.Placer, each center is a batch drawn from its own
+    seed; otherwise each triangle is a batch drawn from the random
+    module."""
+    centers = owned_centers(centers, shard)
+    if placer is None:
+        for index, points in iterate_placement_batches(centers, map, terrain, name, radius, num_samples):
+            paths = []
+            scales = []
+            for pt in points:
+                scales.append(random.uniform(*scale_range))
+                paths.append(random.choice(choices)['full_path'])
+            yield name, index, scene.SceneModelArray.from_columns(paths, points, scales, [model_type] * len(paths),
+                                                                  dtype=numpy.float64)
+        yield name, None, None
+        return
+    
+    results = placer.place(name, [c for index, c in centers], map, radius, num_samples, len(choices), scale_range)
+    results = progress.bar(results, expected_size=len(centers), label='Generating %s...' % name)
+    for (index, center), (points, scales, indices) in itertools.izip(centers, results):
+        paths = [choices[i]['full_path'] for i in indices.tolist()]
+        yield name, index, scene.SceneModelArray.from_columns(paths, points, scales, [model_type] * len(paths),
+                                                              dtype=numpy.float64)
+    yield name, None, None
+
+def generate_forest(centers, models, terrain, map, name, radius, num_samples, placer=None, shard=None):
     trees = models['trees']
     
     # for testing
     # trees = [t for t in trees if 'jterrace/palm.dae' in t['full_path']]
     # assert len(trees) == 1
+    
+    return iterate_placements(centers, map, terrain, name, radius, num_samples,
+                              trees, (3.0, 10.0), 'tree', placer, shard)
 
-    num_gen = 0 
-    for x, y, z in iterate_poisson_samples(centers, map, name, radius, num_samples):
-        pt = numpy.array([x,y,z], dtype=numpy.float32)
-        pt = scene.mapgen_coords_to_sirikata(pt, terrain)
-        
-        scale = random.uniform(3.0, 10.0)
-        
-        m = scene.SceneModel(random.choice(trees)['full_path'],
-                       x=float(pt[0]),
-                       y=float(pt[1]),
-                       z=float(pt[2]),
-                       scale=scale,
-                       model_type='tree')
-        
-        json_out.append(m.to_json())
-        num_gen += 1
-                
-    print 'Generated (%d) %s' % (num_gen, name)
-
-def generate_dense_forest(centers, models, terrain, map, json_out):
-    generate_forest(centers, models, terrain, map, json_out, 'Dense Forest', 2, 6)
-
-def generate_sparse_forest(centers, models, terrain, map, json_out):
-    generate_forest(centers, models, terrain, map, json_out, 'Sparse Forest', 10, 1)
-
-def overlaps(bounds1, bounds2):
-    MAX = 1
-    MIN = 0
-    X = 0
-    Y = 1
-    Z = 2
-    
-    if bounds1[MAX][X] < bounds2[MIN][X]:
-        return False
-    if bounds1[MAX][Y] < bounds2[MIN][Y]:
-        return False
-    if bounds1[MAX][Z] < bounds2[MIN][Z]:
-        return False
-    
-    if bounds1[MIN][X] > bounds2[MAX][X]:
-        return False
-    if bounds1[MIN][Y] > bounds2[MAX][Y]:
-        return False
-    if bounds1[MIN][Z] > bounds2[MAX][Z]:
-        return False
-    
-    return True
+def generate_dense_forest(centers, models, terrain, map, placer=None, shard=None):
+    return generate_forest(centers, models, terrain, map, 'Dense Forest', 2, 6, placer, shard)
 
-def remove_overlapping(models):
-    keep_models = []
-    for i in progress.bar(range(len(models)), label='Removing Overlapping...'):
-        m1 = models.pop()
-        overlapping = False
-        
-        for m2 in models:
-            
-            minpt1, maxpt1 = scene.sirikata_bounds(m1.boundsInfo)
-            minpt1 *= m1.scale
-            minpt1 += numpy.array([m1.x, m1.y, m1.z], dtype=numpy.float32)
-            maxpt1 *= m1.scale
-            maxpt1 += numpy.array([m1.x, m1.y, m1.z], dtype=numpy.float32)
-            
-            minpt2, maxpt2 = scene.sirikata_bounds(m2.boundsInfo)
-            minpt2 *= m2.scale
-            minpt2 += numpy.array([m2.x, m2.y, m2.z], dtype=numpy.float32)
-            maxpt2 *= m2.scale
-            maxpt2 += numpy.array([m2.x, m2.y, m2.z], dtype=numpy.float32)
-            
-            overlapping = overlapping or overlaps((minpt1, maxpt1), (minpt2, maxpt2))
-            
-        if not overlapping:
-            keep_models.append(m1)
-            
-    return keep_models
+def generate_sparse_forest(centers, models, terrain, map, placer=None, shard=None):
+    return generate_forest(centers, models, terrain, map, 'Sparse Forest', 10, 1, placer, shard)
 
-def generate_residential_zone(centers, models, terrain, map, json_out):
+def generate_residential_zone(centers, models, terrain, map, placer=None, shard=None):
     houses = models['houses']
     
     # for testing
     # houses = [h for h in houses if 'kittyvision/house11.dae' in h['full_path']]
     # assert len(houses) == 1
     
-    num_gen = 0
-    models = []
-    for x, y, z in iterate_poisson_samples(centers, map, 'Residential Buildings', 15, 1):
-        pt = numpy.array([x,y,z], dtype=numpy.float32)
-        pt = scene.mapgen_coords_to_sirikata(pt, terrain)
-        
-        scale = random.uniform(4.0, 8.0)
-        
-        m = scene.SceneModel(random.choice(houses)['full_path'],
-                       x=float(pt[0]),
-                       y=float(pt[1]),
-                       z=float(pt[2]),
-                       scale=scale,
-                       model_type='house')
-        models.append(m)
-    
-    models = remove_overlapping(models)
-    for m in models:            
-        json_out.append(m.to_json())
-        num_gen += 1
-                
-    print 'Generated (%d) Residential Buildings' % num_gen
+    return iterate_placements(centers, map, terrain, 'Residential Buildings', 15, 1,
+                              houses, (4.0, 8.0), 'house', placer, shard)
 
-def generate_commercial_zone(centers, models, terrain, map, json_out):
+def generate_commercial_zone(centers, models, terrain, map, placer=None, shard=None):
     commercial = models['commercial_buildings']
     
     # for testing
     # commercial = [c for c in commercial if 'emily2e/models/cityimport.dae' in c['full_path']]
     # assert len(commercial) == 1
     
-    num_gen = 0
-    models = []
-    for x, y, z in iterate_poisson_samples(centers, map, 'Commercial Buildings', 20, 2):
-        pt = numpy.array([x,y,z], dtype=numpy.float32)
-        pt = scene.mapgen_coords_to_sirikata(pt, terrain)
-        
-        scale = random.uniform(6.0, 10.0)
-        
-        m = scene.SceneModel(random.choice(commercial)['full_path'],
-                       x=float(pt[0]),
-                       y=float(pt[1]),
-                       z=float(pt[2]),
-                       scale=scale,
-                       model_type='commercial')
-        models.append(m)
-    
-    models = remove_overlapping(models)
-    for m in models:            
-        json_out.append(m.to_json())
-        num_gen += 1
-                
-    print 'Generated (%d) Commercial Buildings' % num_gen
+    return iterate_placements(centers, map, terrain, 'Commercial Buildings', 20, 2,
+                              commercial, (6.0, 10.0), 'commercial', placer, shard)
 
-def generate_houses_and_trees(models, terrain, map, json_out):
+def generate_houses_and_trees(models, terrain, map, placer=None, shard=None):
     USABLE_BIOMES = {'SHRUBLAND', 'TEMPERATE_RAIN_FOREST', 'TEMPERATE_DECIDUOUS_FOREST',
      'GRASSLAND', 'TROPICAL_RAIN_FOREST','TROPICAL_SEASONAL_FOREST'}
     centers = []
@@ -468,69 +522,214 @@ def generate_houses_and_trees(models, terrain, map, json_out):
     start_offset = 0
     end_offset = 0
     
-    start_offset = end_offset
-    end_offset += int(len(centers) * 0.1)
-    generate_sparse_forest(centers[start_offset:end_offset], models, terrain, map, json_out)
-    
-    start_offset = end_offset
-    end_offset += int(len(centers) * 0.1)
-    generate_dense_forest(centers[start_offset:end_offset], models, terrain, map, json_out)
-    
-    start_offset = end_offset
-    end_offset += int(len(centers) * 0.1)
-    generate_residential_zone(centers[start_offset:end_offset], models, terrain, map, json_out)
-    
-    start_offset = end_offset
-    end_offset += int(len(centers) * 0.1)
-    generate_commercial_zone(centers[start_offset:end_offset], models, terrain, map, json_out)
+    for generate in [generate_sparse_forest, generate_dense_forest,
+                     generate_residential_zone, generate_commercial_zone]:
+        start_offset = end_offset
+        end_offset += int(len(centers) * 0.1)
+        for group in generate(centers[start_offset:end_offset], models, terrain, map, placer, shard):
+            yield group
+    
+def write_scene(options, terrain, groups):
+    """Places the candidate groups and writes the scene, tiled or to
+    {outname}.json and {outname}.em"""
+    tiled = options.tile_grid is not None or options.tile_quadtree is not None
+    if tiled:
+        # tiles are partitioned over the whole scene, so it is kept in memory
+        json_out = []
+        def write(records):
+            start = len(json_out)
+            json_out.extend(records)
+            return len(json_out) - start
+    else:
+        writer = scenefile.SceneWriter(options.outname, compact=options.compact)
+        write = writer.write
+    
+    with telemetry.stage('terrain'):
+        write([terrain.to_json()])
+    print 'Generated (1) terrain object'
     
+    place_candidates(groups, write)
     
+    if tiled:
+        manifest = tiles.write_tiles(options.outname + '.tiles', json_out,
+                                     grid=options.tile_grid, quadtree=options.tile_quadtree,
+                                     compact=options.compact)
+        print 'Wrote %d tiles to %s.tiles' % (len(manifest['tiles']), options.outname)
+    else:
+        writer.close()
+
+def write_telemetry(options):
+    if options.telemetry:
+        print telemetry.format_summary()
+    if options.trace is not None:
+        telemetry.write_chrome_trace(options.trace)
+
 def main():
-    parser = OptionParser(usage="Usage: generate-scene.py -o scene map.xml",
+    parser = OptionParser(usage="Usage: generate-scene.py -o scene map.xml\n"
+                                "       generate-scene.py -o scene --merge scene.*of*.shard",
                           description="Generates a JSON scene based on mapgen2 XML output, using meshes from open3dhub")
     parser.add_option("-o", "--outname", dest="outname",
                       help="write JSON scene to {outname}.json and Emerson script to {outname}.em", metavar="OUTNAME")
+    parser.add_option("--telemetry", dest="telemetry", action="store_true", default=False,
+                      help="print a summary of network and cache activity per stage")
+    parser.add_option("--trace", dest="trace",
+                      help="write a Chrome trace of network and cache activity to FILE", metavar="FILE")
+    parser.add_option("--tag-index", dest="tag_index",
+                      help="select models from a local tagindex.py database instead of the search API", metavar="DB")
+    parser.add_option("--max-download-mb", dest="max_download_mb", type="float", default=None,
+                      help="skip models whose compressed download is larger than this many MB")
+    parser.add_option("--max-triangles", dest="max_triangles", type="int", default=None,
+                      help="skip models with more triangles than this")
+    parser.add_option("--max-texture-mb", dest="max_texture_mb", type="float", default=None,
+                      help="skip models whose textures need more than this many MB of RAM")
+    parser.add_option("--offline", dest="offline", action="store_true", default=False,
+                      help="use only cached data, failing before generation if anything is missing")
+    parser.add_option("--compact", dest="compact", action="store_true", default=False,
+                      help="write JSON without indentation or spaces")
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="seed the random choices; models over map centers are placed from per-center seeds, "
+                           "so the scene is the same for any number of workers")
+    parser.add_option("--workers", dest="workers", type="int", default=1,
+                      help="place models over map centers with this many processes (requires --seed)")
+    parser.add_option("--catalog", dest="catalog",
+                      help="read bounds and metadata of the models published in the shared catalog DIR",
+                      metavar="DIR")
+    parser.add_option("--shard", dest="shard",
+                      help="generate only the map centers shard I of N owns, writing candidate models to "
+                           "{outname}.{I}of{N}.shard for --merge (requires --seed)", metavar="I/N")
+    parser.add_option("--merge", dest="merge", action="store_true", default=False,
+                      help="place the candidate models of the shard files given instead of a map, "
+                           "giving the scene a single run with the same seed would")
+    parser.add_option("--tile-grid", dest="tile_grid", type="int",
+                      help="write the scene as an N x N grid of tiles in {outname}.tiles/", metavar="N")
+    parser.add_option("--tile-quadtree", dest="tile_quadtree", type="int",
+                      help="write the scene as quadtree tiles of at most N models in {outname}.tiles/", metavar="N")
     (options, args) = parser.parse_args()
     
-    if len(args) != 1:
+    if len(args) != 1 and not (options.merge and len(args) > 0):
         parser.print_help()
         parser.exit(1, "Wrong number of arguments.\n")
     
-    if not os.path.isfile(args[0]):
-        parser.print_help()
-        parser.exit(1, "Input file '%s' is not a valid file.\n" % args[0])
+    for fname in args:
+        if not os.path.isfile(fname):
+            parser.print_help()
+            parser.exit(1, "Input file '%s' is not a valid file.\n" % fname)
     
     if options.outname is None:
         parser.print_help()
         parser.exit(1, "Must specify an output name.\n")
-        
-    fname = args[0]
-    map = MapGenXml(fname)
-    models = get_models()
     
-    terrain = scene.SceneModel(TERRAIN_PATH, x=0, y=0, z=0, scale=1000, model_type='terrain')
-    json_out = []
-    print 'Generated (1) terrain object'
-    json_out.append(terrain.to_json())
+    if options.tile_grid is not None and options.tile_quadtree is not None:
+        parser.print_help()
+        parser.exit(1, "Can't use both --tile-grid and --tile-quadtree.\n")
     
-    generate_houses_and_trees(models, terrain, map, json_out)
-    generate_winter(models, terrain, map, json_out)
-    generate_roads(models, terrain, map, json_out)
-    generate_vehicles(models, terrain, map, json_out)
-    generate_flying(models, terrain, map, json_out)
-    generate_boats(models, terrain, map, json_out)
+    for tile_option in [options.tile_grid, options.tile_quadtree]:
+        if tile_option is not None and tile_option < 1:
+            parser.print_help()
+            parser.exit(1, "--tile-grid and --tile-quadtree need N of at least 1.\n")
     
-    json_str = json.dumps(json_out, indent=2)
+    if options.workers > 1 and options.seed is None:
+        parser.print_help()
+        parser.exit(1, "--workers requires --seed.\n")
+    
+    shard = None
+    if options.shard is not None:
+        try:
+            shard = tuple(int(part) for part in options.shard.split('/'))
+        except ValueError:
+            shard = None
+        if shard is None or len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+            parser.print_help()
+            parser.exit(1, "--shard must be I/N with 0 <= I < N.\n")
+        if options.seed is None:
+            parser.print_help()
+            parser.exit(1, "--shard requires --seed.\n")
+        if options.merge:
+            parser.print_help()
+            parser.exit(1, "Can't use both --shard and --merge.\n")
+        
+    if options.telemetry or options.trace is not None:
+        telemetry.enable()
+    
+    policy = open3dhub.ADMISSION_POLICY
+    MB = 1024 * 1024
+    open3dhub.set_admission_policy(open3dhub.AdmissionPolicy(
+        max_size_gzip=options.max_download_mb * MB if options.max_download_mb is not None else policy.max_size_gzip,
+        max_triangles=options.max_triangles if options.max_triangles is not None else policy.max_triangles,
+        max_texture_ram=options.max_texture_mb * MB if options.max_texture_mb is not None else policy.max_texture_ram,
+        denied=policy.denied,
+        # the scene can't be built without these, whatever their size
+        exempt=[TERRAIN_PATH, ROAD_PATH]))
+    
+    if options.catalog is not None:
+        sharedcatalog.attach(options.catalog)
     
-    json_name = options.outname + '.json'
-    with open(json_name, 'w') as f:
-        f.write(json_str)
+    terrain = scene.SceneModel(TERRAIN_PATH, x=0, y=0, z=0, scale=1000, model_type='terrain')
     
-    em_name = options.outname + '.em'
-    with open(em_name, 'w') as f:
-        f.write('var OBJECTS = ')
-        f.write(json_str)
-        f.write(';\n')
+    if options.merge:
+        try:
+            if options.offline:
+                open3dhub.set_offline()
+                paths = [TERRAIN_PATH] + placement.candidate_paths(args)
+                exit_if_missing(parser, cache.missing_keys(paths=paths))
+            header, groups = placement.merge_candidates(args, STAGE_ORDER)
+        except placement.ShardError, e:
+            parser.exit(1, "%s\n" % e)
+        print 'Merging %d shards of seed %d' % (header['shards'], header['seed'])
+        write_scene(options, terrain, groups)
+        write_telemetry(options)
+        return
+    
+    fname = args[0]
+    map = MapGenXml(fname)
+    tag_index = None
+    if options.tag_index is not None:
+        import tagindex
+        tag_index = tagindex.TagIndex(options.tag_index)
+    
+    if options.offline:
+        open3dhub.set_offline()
+        exit_if_missing(parser, missing_cache_keys(tag_index))
+    
+    with telemetry.stage('models'):
+        models = get_models(tag_index)
+    
+    placer = None
+    if options.seed is not None:
+        random.seed(options.seed)
+        placer = placement.Placer(options.seed, scene.terrain_transform(terrain), options.workers)
+    
+    try:
+        # stages are generators of candidate groups, consumed in order;
+        # roads is the only output a later stage needs. Stages that don't
+        # place models over map centers belong to the first shard.
+        roads = [] if shard is None or shard[0] == 0 else None
+        stages = [end_stage('road objects', generate_roads(models, terrain, map, roads, shard)),
+                  generate_houses_and_trees(models, terrain, map, placer, shard)]
+        if roads is not None:
+            stages += [end_stage('winter objects', generate_winter(models, terrain, map)),
+                       end_stage('vehicles', generate_vehicles(models, terrain, map, roads)),
+                       end_stage('flying objects', generate_flying(models, terrain, map)),
+                       end_stage('boat objects', generate_boats(models, terrain, map))]
+        groups = itertools.chain(*stages)
+        
+        if shard is not None:
+            shard_name = '%s.%dof%d.shard' % ((options.outname,) + shard)
+            with telemetry.stage('candidates'):
+                fingerprint = placement.run_fingerprint(models, fname)
+                count = placement.write_candidates(shard_name, options.seed, shard, fingerprint, groups)
+            print 'Wrote %d candidate models to %s' % (count, shard_name)
+        else:
+            write_scene(options, terrain, groups)
+    except:
+        # drop the centers already queued to the workers rather than
+        # waiting for them to be placed
+        exc_info = sys.exc_info()
+        if placer is not None:
+            placer.close(abort=True)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    if placer is not None:
+        placer.close()
+    
+    write_telemetry(options)
 
-if __name__ == '__main__':
-    main()
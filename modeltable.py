@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""Columnar table of per-model properties for vectorized filtering
+
+A ModelTable has one row per catalog model. The row number is the
+model's path id. Columns are numpy arrays: tag bitsets, bounds and the
+cost metrics of the model's optimized type. A table is saved as a
+directory of .npy files plus a JSON file of paths and tag names, and is
+loaded memory-mapped, so opening even a large catalog is cheap::
+
+    table = ModelTable.load('catalog.table')
+    mask = table.tag_mask('plant') & ~table.tag_mask('tree')
+    mask &= table.num_triangles < 40000
+    paths = table.sample(mask, 100, weights=1.0 / table.size_gzip)
+
+Missing numbers are stored as -1 and missing bounds as NaN.
+has_optimized is 1 for models with an optimized type and 0 otherwise.
+"""
+
+import os
+import sys
+import json
+import collections
+from optparse import OptionParser
+
+import numpy
+
+from open3dhub import model_tags
+
+INT_COLUMNS = ['num_triangles', 'num_draw_calls', 'size_gzip', 'texture_ram', 'has_optimized']
+FLOAT_COLUMNS = ['bounds_min', 'bounds_max', 'center', 'center_farthest_distance']
+INDEX_FILE = 'index.json'
+
+def _optimized_numbers(item):
+    optimized = item.get('metadata', {}).get('types', {}).get('optimized')
+    has_optimized = optimized is not None
+    if optimized is None:
+        optimized = {}
+    info = optimized.get('metadata', {})
+    # summed as in open3dhub.AdmissionPolicy, and missing only if both are
+    size_gzip = None
+    if 'size_gzip' in optimized or 'subfile_sizes_gzip' in optimized:
+        size_gzip = optimized.get('size_gzip', 0) + sum(optimized.get('subfile_sizes_gzip', {}).values())
+    return {'num_triangles': info.get('num_triangles'),
+            'num_draw_calls': info.get('num_draw_calls'),
+            'size_gzip': size_gzip,
+            'texture_ram': info.get('texture_ram_usage'),
+            'has_optimized': int(has_optimized)}
+
+class ModelTable(object):
+    """paths and tags are lists; tag_bits is an (N, W) uint64 array whose
+    bit t is set when the model has tags[t]; the other columns are the
+    arrays named in INT_COLUMNS and FLOAT_COLUMNS"""
+
+    def __init__(self, paths, tags, tag_bits, columns):
+        self.paths = paths
+        self.tags = tags
+        self.tag_bits = tag_bits
+        for name in INT_COLUMNS + FLOAT_COLUMNS:
+            setattr(self, name, columns[name])
+        self._path_ids = None
+        self._tag_ids = dict((t, i) for i, t in enumerate(tags))
+
+    def __len__(self):
+        return len(self.paths)
+
+    @staticmethod
+    def build(items, bounds=None):
+        """Builds a table from catalog items, with one row per path from
+        the last item of that path. bounds, if given, is called with each
+        path and returns a bounds info dict or None."""
+        latest = collections.OrderedDict()
+        for item in items:
+            latest[item['full_path']] = item
+        items = latest.values()
+        n = len(items)
+
+        tags = sorted(set(t for item in items for t in model_tags(item)))
+        tag_ids = dict((t, i) for i, t in enumerate(tags))
+        tag_bits = numpy.zeros((n, max(1, (len(tags) + 63) // 64)), dtype=numpy.uint64)
+
+        columns = {}
+        for name in INT_COLUMNS:
+            columns[name] = numpy.empty(n, dtype=numpy.int64)
+            columns[name].fill(-1)
+        for name in ['bounds_min', 'bounds_max', 'center']:
+            columns[name] = numpy.empty((n, 3), dtype=numpy.float32)
+            columns[name].fill(numpy.nan)
+        columns['center_farthest_distance'] = numpy.empty(n, dtype=numpy.float32)
+        columns['center_farthest_distance'].fill(numpy.nan)
+
+        paths = []
+        for row, item in enumerate(items):
+            paths.append(item['full_path'])
+            for tag in model_tags(item):
+                t = tag_ids[tag]
+                tag_bits[row, t // 64] |= numpy.uint64(1 << (t % 64))
+            for name, value in _optimized_numbers(item).iteritems():
+                if value is not None:
+                    columns[name][row] = value
+            if bounds is not None:
+                info = bounds(item['full_path'])
+                if info is not None:
+                    columns['bounds_min'][row], columns['bounds_max'][row] = info['bounds']
+                    columns['center'][row] = info['center']
+                    columns['center_farthest_distance'][row] = info['center_farthest_distance']
+
+        return ModelTable(paths, tags, tag_bits, columns)
+
+    def save(self, dirname):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        numpy.save(os.path.join(dirname, 'tag_bits.npy'), self.tag_bits)
+        for name in INT_COLUMNS + FLOAT_COLUMNS:
+            numpy.save(os.path.join(dirname, name + '.npy'), getattr(self, name))
+        with open(os.path.join(dirname, INDEX_FILE), 'w') as f:
+            json.dump({'paths': self.paths, 'tags': self.tags}, f)
+
+    @staticmethod
+    def load(dirname, mmap=True):
+        """Loads a saved table. With mmap the columns are read-only
+        memory-mapped arrays that are paged in on demand."""
+        mode = 'r' if mmap else None
+        with open(os.path.join(dirname, INDEX_FILE)) as f:
+            index = json.load(f)
+        tag_bits = numpy.load(os.path.join(dirname, 'tag_bits.npy'), mmap_mode=mode)
+        columns = dict((name, numpy.load(os.path.join(dirname, name + '.npy'), mmap_mode=mode))
+                       for name in INT_COLUMNS + FLOAT_COLUMNS)
+        return ModelTable(index['paths'], index['tags'], tag_bits, columns)
+
+    def _path_id_map(self):
+        if self._path_ids is None:
+            self._path_ids = dict((p, i) for i, p in enumerate(self.paths))
+        return self._path_ids
+
+    def path_id(self, path):
+        return self._path_id_map()[path]
+
+    def tag_mask(self, tag):
+        """Returns a boolean array of the rows that have tag"""
+        t = self._tag_ids.get(tag)
+        if t is None:
+            return numpy.zeros(len(self), dtype=bool)
+        word = self.tag_bits[:, t // 64]
+        return (word & numpy.uint64(1 << (t % 64))) != 0
+
+    def admission_mask(self, policy):
+        """Returns a boolean array of the rows that an
+        open3dhub.AdmissionPolicy admits. Like the policy, it counts
+        missing numbers as within every limit."""
+        mask = self.has_optimized == 1
+        for limit, column in [(policy.max_size_gzip, self.size_gzip),
+                              (policy.max_triangles, self.num_triangles),
+                              (policy.max_texture_ram, self.texture_ram)]:
+            if limit is not None:
+                mask &= (column < 0) | (column <= limit)
+        for paths, admitted in [(policy.denied, False), (policy.exempt, True)]:
+            rows = [self.path_id(p) for p in paths if p in self._path_id_map()]
+            mask[rows] = admitted
+        return mask
+
+    def admission_mismatches(self, items, policy):
+        """Returns the paths of items, the ones the table was built from,
+        where admission_mask disagrees with policy.reject_reason. Like
+        build, it checks the last item of each path."""
+        mask = self.admission_mask(policy)
+        latest = dict((item['full_path'], item) for item in items)
+        return [path for path, item in sorted(latest.iteritems())
+                if mask[self.path_id(path)] != policy.admits(item)]
+
+    def has_bounds(self):
+        return ~numpy.isnan(self.center_farthest_distance)
+
+    def sirikata_bounds(self):
+        """Returns (minpts, maxpts), the bounds of every row centered and
+        scaled to unit distance to the farthest point, as in
+        scene.sirikata_bounds"""
+        scale = self.center_farthest_distance[:, None]
+        return ((self.bounds_min - self.center) / scale,
+                (self.bounds_max - self.center) / scale)
+
+    def select(self, mask):
+        """Returns the paths of the rows selected by mask"""
+        return [self.paths[i] for i in numpy.flatnonzero(mask)]
+
+    def sample(self, mask, n, weights=None, rng=numpy.random):
+        """Returns n paths chosen with replacement from the rows selected
+        by mask, with probability proportional to weights if given"""
+        rows = numpy.flatnonzero(mask)
+        if len(rows) == 0:
+            return []
+        p = None
+        if weights is not None:
+            p = numpy.asarray(weights, dtype=numpy.float64)[rows]
+            p = p / p.sum()
+        return [self.paths[i] for i in rng.choice(rows, size=n, p=p)]
+
+    def subset(self, rows):
+        """Returns a new in-memory table with only the given rows"""
+        rows = numpy.asarray(rows)
+        columns = dict((name, numpy.array(getattr(self, name)[rows]))
+                       for name in INT_COLUMNS + FLOAT_COLUMNS)
+        return ModelTable([self.paths[i] for i in rows], list(self.tags),
+                          numpy.array(self.tag_bits[rows]), columns)
+
+def main():
+    parser = OptionParser(usage="Usage: modeltable.py [--bounds] catalog.jsonl|index.db outdir",
+                          description="Builds a columnar model property table from a catalog snapshot or tag index")
+    parser.add_option("--bounds", dest="bounds", action="store_true", default=False,
+                      help="include bounds from the cache, computing missing ones")
+    parser.add_option("--check-admission", dest="check_admission", action="store_true", default=False,
+                      help="check the table's admission mask against the admission policy for every model")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        parser.exit(1, "Wrong number of arguments.\n")
+
+    import tagindex
+    import open3dhub
+    source, outdir = args
+    if source.endswith('.db'):
+        items = tagindex.TagIndex(source).query()
+    else:
+        items = list(tagindex.read_snapshot(source))
+
+    bounds = None
+    if options.bounds:
+        import cache
+        def bounds(path):
+            try:
+                return cache.get_bounds(path)
+            except open3dhub.ModelRejected:
+                return None
+            except (IOError, cache.CacheMiss), ex:
+                print >> sys.stderr, 'No bounds for %s: %s' % (path, ex)
+                return None
+
+    table = ModelTable.build(items, bounds)
+    table.save(outdir)
+    print 'Wrote %d models with %d tags to %s' % (len(table), len(table.tags), outdir)
+
+    if options.check_admission:
+        mismatched = table.admission_mismatches(items, open3dhub.ADMISSION_POLICY)
+        for path in mismatched:
+            print 'MISMATCH %s' % path
+        print 'Checked admission of %d models: %d mismatched' % (len(table), len(mismatched))
+        if len(mismatched) > 0:
+            sys.exit(2)
+
+if __name__ == '__main__':
+    main()
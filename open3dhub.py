@@ -7,8 +7,11 @@ import math
 import os
 import requests
 import pickle
+import sys
+import threading
 import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 
 import numpy
 import collada
@@ -17,32 +20,218 @@ from meshtool.filters.panda_filters import pdae_utils
 from meshtool.filters.simplify_filters import add_back_pm
 from panda3d.core import GeomNode, NodePath, Mat4
 
-BASE_URL = 'http://open3dhub.com'
+import telemetry
+
+def set_base_url(base_url):
+    """Points all API and download URLs at base_url, e.g. a local fakehub"""
+    global BASE_URL, BROWSE_URL, DOWNLOAD_URL, DNS_URL, MODELINFO_URL, SEARCH_URL
+    BASE_URL = base_url.rstrip('/')
+    BROWSE_URL = BASE_URL + '/api/browse'
+    DOWNLOAD_URL = BASE_URL + '/download'
+    DNS_URL = BASE_URL + '/dns'
+    MODELINFO_URL = BASE_URL + '/api/modelinfo/%(path)s'
+    SEARCH_URL = BASE_URL + '/api/search?q=%(q)s&start=%(start)d&rows=%(rows)d'
+
 # 'http://singular.stanford.edu'
-BROWSE_URL = BASE_URL + '/api/browse'
-DOWNLOAD_URL = BASE_URL + '/download'
-DNS_URL = BASE_URL + '/dns'
-MODELINFO_URL = BASE_URL + '/api/modelinfo/%(path)s'
-SEARCH_URL = BASE_URL + '/api/search?q=%(q)s&start=%(start)d&rows=%(rows)d'
+set_base_url(os.environ.get('OPEN3DHUB_URL', 'http://open3dhub.com'))
 
 PANDA3D = False
 
 PROGRESSIVE_CHUNK_SIZE = 2 * 1024 * 1024 # 2 MB
 
-# blacklist some models that are TOO BIG and make cassandra die because thrift doesn't support streaming
-BLACKLIST = set(['/kittyvision/tree/straight.dae/0',
-                 '/kittyvision/tree/willow.dae/0',
-                 '/kittyvision/tree/leaning.dae/0',
-                 '/kittyvision/tree/leafy.dae/0',
-                 '/kittyvision/tree/jaccaranda.dae/0',
-                 '/kittyvision/tree/densemaple.dae/0',
-                 '/kittyvision/tree/mango.dae/0'])
+# number of times to retry a request that fails to connect
+URLFETCH_RETRIES = 0
+
+# maximum number of threads used to decode one mesh's textures
+TEXTURE_WORKERS = 8
+
+# when set, requests raise OfflineError instead of using the network
+OFFLINE = False
+
+class OfflineError(IOError):
+    """Raised for a request made in offline mode"""
+    def __init__(self, url):
+        IOError.__init__(self, 'offline, not fetching %s' % url)
+        self.url = url
+
+def set_offline(offline=True):
+    """Turns offline mode on or off. The cache raises cache.CacheMiss for
+    entries it would have to fetch."""
+    global OFFLINE
+    OFFLINE = offline
+
+def check_online(url):
+    if OFFLINE:
+        raise OfflineError(url)
+
+class HTTPError(IOError):
+    """Raised for a response that is not 2xx or 304 Not Modified. It is an
+    IOError, so like a failed connection it is treated as transient."""
+    def __init__(self, url, status):
+        IOError.__init__(self, 'HTTP %d fetching %s' % (status, url))
+        self.url = url
+        self.status = status
+
+def check_status(url, resp):
+    """Raises HTTPError unless resp is a success or 304 Not Modified"""
+    if not (200 <= resp.status_code < 300 or resp.status_code == 304):
+        raise HTTPError(url, resp.status_code)
+
+class ModelRejected(Exception):
+    """Raised for a model that is over the admission budget or has
+    previously failed to load"""
+    def __init__(self, path, reason):
+        Exception.__init__(self, '%s: %s' % (path, reason))
+        self.path = path
+        self.reason = reason
+
+class AdmissionPolicy(object):
+    """Decides whether a model is small enough to download, based on the
+    size and complexity numbers in the metadata of its optimized type.
+    
+    max_size_gzip limits the compressed download size of the mesh and its
+    textures in bytes, max_triangles the triangle count and
+    max_texture_ram the decoded texture size in bytes. A limit of None
+    means unlimited. Paths in denied are always rejected and paths in
+    exempt always admitted, whatever their metadata says."""
+    def __init__(self, max_size_gzip=None, max_triangles=None, max_texture_ram=None,
+                 denied=(), exempt=()):
+        self.max_size_gzip = max_size_gzip
+        self.max_triangles = max_triangles
+        self.max_texture_ram = max_texture_ram
+        self.denied = frozenset(denied)
+        self.exempt = frozenset(exempt)
+    
+    def reject_reason(self, item):
+        """Returns why a search result or modelinfo item is over budget,
+        or None if it is admitted"""
+        path = item.get('full_path')
+        if path in self.exempt:
+            return None
+        if path in self.denied:
+            return 'denied'
+        
+        optimized = item['metadata']['types'].get('optimized')
+        if optimized is None:
+            return 'no optimized version'
+        
+        size_gzip = optimized.get('size_gzip', 0) + sum(optimized.get('subfile_sizes_gzip', {}).values())
+        if self.max_size_gzip is not None and size_gzip > self.max_size_gzip:
+            return 'download size %d > %d bytes' % (size_gzip, self.max_size_gzip)
+        
+        info = optimized.get('metadata', {})
+        triangles = info.get('num_triangles', 0)
+        if self.max_triangles is not None and triangles > self.max_triangles:
+            return '%d triangles > %d' % (triangles, self.max_triangles)
+        
+        texture_ram = info.get('texture_ram_usage', 0)
+        if self.max_texture_ram is not None and texture_ram > self.max_texture_ram:
+            return 'texture RAM %d > %d bytes' % (texture_ram, self.max_texture_ram)
+        
+        return None
+    
+    def admits(self, item):
+        return self.reject_reason(item) is None
+    
+    def filter(self, items, deferred=None):
+        """Returns the admitted items. Rejected items are appended to
+        deferred if it is given."""
+        admitted = []
+        for item in items:
+            if self.admits(item):
+                admitted.append(item)
+            elif deferred is not None:
+                deferred.append(item)
+        return admitted
+
+# admits everything, for callers that want unfiltered results
+ADMIT_ALL = AdmissionPolicy()
+
+# some models are TOO BIG: they make cassandra die because thrift doesn't
+# support streaming, and take forever to load even when they do download.
+# These were blacklisted by hand before the limits existed; their metadata
+# has not been checked against the limits, so they stay denied.
+DENIED_PATHS = frozenset(['/kittyvision/tree/straight.dae/0',
+                          '/kittyvision/tree/willow.dae/0',
+                          '/kittyvision/tree/leaning.dae/0',
+                          '/kittyvision/tree/leafy.dae/0',
+                          '/kittyvision/tree/jaccaranda.dae/0',
+                          '/kittyvision/tree/densemaple.dae/0',
+                          '/kittyvision/tree/mango.dae/0'])
+
+ADMISSION_POLICY = AdmissionPolicy(max_size_gzip=10 * 1024 * 1024,
+                                   max_triangles=500000,
+                                   max_texture_ram=256 * 1024 * 1024,
+                                   denied=DENIED_PATHS)
+
+def set_admission_policy(policy):
+    """Sets the policy used by default by get_search_list and the cache"""
+    global ADMISSION_POLICY
+    ADMISSION_POLICY = policy
 
 CURDIR = os.path.dirname(__file__)
 TEMPDIR = os.path.join(CURDIR, '.temp_models')
 
 REQUESTS_SESSION = requests.session()
 
+def reset_session():
+    """Replaces the module's requests session with a new one. Forked
+    workers call it so they don't share the parent's keep-alive sockets."""
+    global REQUESTS_SESSION
+    REQUESTS_SESSION = requests.session()
+
+class _FlightCall(object):
+    """A pending call that other callers can wait on"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key so that only the first
+    caller does the work and later callers wait on its pending result"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        """Returns the pending call for key, or None if there isn't one"""
+        with self._lock:
+            return self._calls.get(key)
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _FlightCall()
+                self._calls[key] = call
+
+        if not leader:
+            return call.wait()
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except:
+            call.exc_info = sys.exc_info()
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.wait()
+
+# one group per kind of request so keys from different namespaces can't collide
+_hash_flights = SingleFlight()
+_url_flights = SingleFlight()
+_mesh_flights = SingleFlight()
+
 class PathInfo(object):
     """Helper class for dealing with CDN paths"""
     def __init__(self, filename):
@@ -78,6 +267,50 @@ class PathInfo(object):
     def __repr__(self):
         return str(self)
 
+def model_tags(info):
+    """Returns the list of tags of a modelinfo or search result item"""
+    metadata = info.get('metadata', {})
+    return metadata.get('labels') or metadata.get('tags') or []
+
+def endpoint_name(url):
+    """Returns the name of the API endpoint a URL belongs to, e.g. 'download'"""
+    parts = urlparse.urlparse(url).path.strip('/').split('/')
+    if parts[0] == 'api' and len(parts) > 1:
+        return parts[1]
+    return parts[0]
+
+def record_fetch(url, start, resp, retries=0):
+    """Records telemetry for a completed request started at time start"""
+    if not telemetry.is_enabled():
+        return
+    content_length = resp.headers.get('content-length')
+    decoded_bytes = len(resp.content)
+    telemetry.record('http', endpoint_name(url), start, time.time() - start,
+                     url=url,
+                     status=resp.status_code,
+                     wire_bytes=int(content_length) if content_length else decoded_bytes,
+                     decoded_bytes=decoded_bytes,
+                     retries=retries)
+
+def _get(url, headers):
+    """GETs url, retrying failed connections, and records telemetry.
+    Raises HTTPError for error responses."""
+    check_online(url)
+    start = time.time()
+    retries = 0
+    while True:
+        try:
+            resp = REQUESTS_SESSION.get(url, headers=headers)
+            break
+        except requests.exceptions.ConnectionError:
+            if retries >= URLFETCH_RETRIES:
+                raise
+            retries += 1
+    
+    record_fetch(url, start, resp, retries)
+    check_status(url, resp)
+    return resp
+
 def urlfetch(url, httprange=None):
     """Fetches the given URL and returns data from it.
     Will take care of gzip if enabled on server."""
@@ -87,45 +320,112 @@ def urlfetch(url, httprange=None):
         offset, length = httprange
         headers['Range'] = 'bytes=%d-%d' % (offset, offset+length-1)
     
-    resp = REQUESTS_SESSION.get(url, headers=headers)
+    return _get(url, headers).content
+
+def validated_fetch(url, validators=None):
+    """Fetches the given URL, conditionally if validators returned by an
+    earlier validated_fetch of it are given. Returns (data, validators),
+    where data is None if the server answered 304 Not Modified. Error
+    responses raise HTTPError, so they never replace cached data."""
     
-    return resp.content
+    headers = {}
+    if validators is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    
+    resp = _get(url, headers)
+    if resp.status_code == 304:
+        return None, validators
+    
+    return resp.content, {'url': url,
+                          'etag': resp.headers.get('etag'),
+                          'last_modified': resp.headers.get('last-modified')}
     
 def json_fetch(url):
     return json.loads(urlfetch(url))
 
 def hashfetch(dlhash, httprange=None):
-    """Fetches the given hash and returns data from it."""
-    return urlfetch(DOWNLOAD_URL + '/' + dlhash, httprange)
+    """Fetches the given hash and returns data from it.
+    Concurrent fetches of the same hash and range share one download."""
+    key = (dlhash, httprange)
+    return _hash_flights.do(key, urlfetch, DOWNLOAD_URL + '/' + dlhash, httprange)
 
 def get_subfile_hash(subfile_path):
     subfile_url = DNS_URL + subfile_path
-    subfile_json = json.loads(urlfetch(subfile_url))
+    subfile_json = _url_flights.do(subfile_url, json_fetch, subfile_url)
     subfile_hash = subfile_json['Hash']
     return subfile_hash
 
-def get_search_list(q):
+def search_page_url(q, start, rows=100):
+    return SEARCH_URL % {'q': q,
+                         'start': start,
+                         'rows': rows}
+
+def parse_search_page(response):
+    """Given a decoded search response, returns (items, next_start) where
+    next_start is None on the last page"""
+    items = response['content_items']
+    
+    try:
+        next_start = int(response['next_start'])
+    except (ValueError, TypeError):
+        next_start = None
+    
+    return items, next_start
+
+def get_search_list(q, policy=None, deferred=None):
+    """Returns the search results for q that policy admits, by default
+    ADMISSION_POLICY. Over-budget results are appended to deferred if it
+    is given."""
+    if policy is None:
+        policy = ADMISSION_POLICY
     start = 0
     
     all_items = []
     while start is not None:
-        to_search = SEARCH_URL % {'q': q,
-                                  'start': start,
-                                  'rows': 100}
-        response = json_fetch(to_search)
-        
-        for item in response['content_items']:
-            if item['full_path'] in BLACKLIST:
-                continue
-            all_items.append(item)
-        
-        try:
-            start = int(response['next_start'])
-        except (ValueError, TypeError):
-            start = None
+        response = json_fetch(search_page_url(q, start))
+        items, start = parse_search_page(response)
+        all_items.extend(policy.filter(items, deferred))
     
     return all_items
 
+def get_search_list_validated(q):
+    """Like get_search_list, but returns (items, validators) where
+    validators is a list with the validators of each result page. The
+    items are not filtered by an admission policy."""
+    start = 0
+    
+    all_items = []
+    all_validators = []
+    while start is not None:
+        data, validators = validated_fetch(search_page_url(q, start))
+        items, start = parse_search_page(json.loads(data))
+        all_items.extend(items)
+        all_validators.append(validators)
+    
+    return all_items, all_validators
+
+def search_list_changed(page_validators):
+    """Checks each page of a search with a conditional request and
+    returns True as soon as one of them has changed"""
+    for validators in page_validators:
+        data, validators = validated_fetch(validators['url'], validators)
+        if data is not None:
+            return True
+    return False
+
+def iter_catalog():
+    """Yields the JSON of every model in the catalog, one browse page at
+    a time"""
+    next_start = ''
+    while next_start is not None:
+        models_js = json_fetch(BROWSE_URL + '/' + str(next_start))
+        next_start = models_js['next_start']
+        for model_js in models_js['content_items']:
+            yield model_js
+
 def get_list(limit=20):
     """Returns a list of dictionaries containing model JSON"""
     
@@ -206,6 +506,7 @@ def get_hash_sizes(items):
         if hash in hash_cache:
             hash_sizes[hash] = hash_cache[hash]
         else:
+            check_online(DOWNLOAD_URL + '/' + hash)
             resp = REQUESTS_SESSION.get(DOWNLOAD_URL + '/' + hash)
             hash_sizes[hash] = {'size': len(resp.content),
                                 'gzip_size': int(resp.headers['content-length'])}
@@ -215,25 +516,61 @@ def get_hash_sizes(items):
     
     return hash_sizes
 
-def load_mesh(mesh_data, subfiles):
-    """Given a downloaded mesh, return a collada instance"""
+def _decode_image(img):
+    img.data
+    img.pilimage
+
+def decode_textures(mesh, workers=TEXTURE_WORKERS):
+    """Loads and decodes all of a mesh's images. PIL releases the GIL
+    while decoding, so images are decoded in parallel on a thread pool."""
+    images = list(mesh.images)
+    if len(images) <= 1:
+        for img in images:
+            _decode_image(img)
+        return
+    
+    pool = ThreadPool(min(workers, len(images)))
+    try:
+        pool.map(telemetry.bind(_decode_image), images)
+    finally:
+        pool.close()
+        pool.join()
+
+def load_mesh(mesh_data, subfiles, textures='eager'):
+    """Given a downloaded mesh, return a collada instance.
+    
+    With textures='eager' all textures are decoded before returning. With
+    textures='lazy' each texture is only loaded and decoded when it is
+    first accessed, which is much faster for callers that only need
+    geometry or bounds."""
     
     def inline_loader(filename):
         return subfiles[posixpath.basename(filename)]
     
     mesh = collada.Collada(StringIO(mesh_data), aux_file_loader=inline_loader)
     
-    #this will force loading of the textures too
-    for img in mesh.images:
-        img.data
+    if textures == 'eager':
+        decode_textures(mesh)
     
     return mesh
 
 def get_single_metadata(path):
     pathinfo = PathInfo(path)
-    metadata = json_fetch(MODELINFO_URL % {'path': pathinfo.normpath})
+    url = MODELINFO_URL % {'path': pathinfo.normpath}
+    metadata = _url_flights.do(url, json_fetch, url)
     return metadata
 
+def get_single_metadata_validated(path, validators=None):
+    """Fetches metadata for path, conditionally if validators from an
+    earlier call are given. Returns (metadata, validators), where metadata
+    is None if it has not changed."""
+    pathinfo = PathInfo(path)
+    url = MODELINFO_URL % {'path': pathinfo.normpath}
+    data, validators = validated_fetch(url, validators)
+    if data is None:
+        return None, validators
+    return json.loads(data), validators
+
 _mesh_cache = {}
 def _make_aux_file_loader(metadata):
 
@@ -254,17 +591,41 @@ def _make_aux_file_loader(metadata):
 
     return aux_file_loader
 
-def path_to_mesh(path, cache=False):
+def parse_mesh(metadata, mesh_data):
+    """Parses downloaded mesh data into a collada instance whose subfiles
+    are fetched on demand"""
+    return collada.Collada(StringIO(mesh_data), aux_file_loader=_make_aux_file_loader(metadata))
+
+def path_to_mesh_data(path):
+    """Returns (metadata, mesh_data) for the given path without parsing
+    the mesh or fetching its subfiles"""
+    metadata = get_single_metadata(path)
+    typedata = metadata['metadata']['types']['optimized']
+    mesh_hash = typedata['hash']
+    mesh_data = hashfetch(mesh_hash)
+    return (metadata, mesh_data)
+
+def _fetch_mesh(path):
+    metadata, mesh_data = path_to_mesh_data(path)
+    mesh = parse_mesh(metadata, mesh_data)
+    return (metadata, mesh)
+
+def path_to_mesh(path, cache=False, textures='lazy'):
+    """Returns (metadata, mesh) for the given path. Callers asking for the
+    same path while it is being loaded wait for and share that load.
+    
+    Textures are downloaded when first accessed unless textures='eager',
+    in which case they are all downloaded and decoded in parallel."""
     if path not in _mesh_cache:
-        metadata = get_single_metadata(path)
-        typedata = metadata['metadata']['types']['optimized']
-        mesh_hash = typedata['hash']
-        mesh_data = hashfetch(mesh_hash)
-        mesh = collada.Collada(StringIO(mesh_data), aux_file_loader=_make_aux_file_loader(metadata))
-        if not cache:
-            return (metadata, mesh)
-        _mesh_cache[path] = (metadata, mesh)
-    return _mesh_cache[path]
+        result = _mesh_flights.do(path, _fetch_mesh, path)
+        if cache:
+            _mesh_cache[path] = result
+    else:
+        result = _mesh_cache[path]
+    
+    if textures == 'eager':
+        decode_textures(result[1])
+    return result
 
 def load_into_bamfile(meshdata, subfiles, model):
     """Uses pycollada and panda3d to load meshdata and subfiles and
@@ -293,8 +654,18 @@ def load_into_bamfile(meshdata, subfiles, model):
                 raise
 
     print 'loading into bamfile', model_name, mesh
+    flatten = model.model_type != 'optimized_unflattened' and model.model_type != 'progressive'
+    mesh_to_bamfile(mesh, model_name, model.bam_file, flatten=flatten)
+    print 'saved', model_name, mesh
+    
+    return model.bam_file
+
+def mesh_to_bamfile(mesh, model_name, bam_file, flatten=True):
+    """Converts a collada instance to a centered and scaled panda3d node
+    and writes it to bam_file. The file is written under a temporary name
+    and renamed into place, so a bam file that exists is always complete."""
+    
     scene_members = pandacore.getSceneMembers(mesh)
-    print 'got scene members', model_name, mesh
     
     rotateNode = GeomNode("rotater")
     rotatePath = NodePath(rotateNode)
@@ -314,21 +685,16 @@ def load_into_bamfile(meshdata, subfiles, model):
             node.setGeomState(0, renderstate)
         geomPath = rotatePath.attachNewNode(node)
         geomPath.setMat(mat4)
-        
-    print 'created np', model_name, mesh
-
-    if model.model_type != 'optimized_unflattened' and model.model_type != 'progressive':
-        print 'ABOUT TO FLATTEN'
+    
+    if flatten:
         rotatePath.flattenStrong()
-        print 'DONE FLATTENING'
-        
-    print 'flattened', model_name, mesh
     
     wrappedNode = pandacore.centerAndScale(rotatePath)
     wrappedNode.setName(model_name)
-
-    wrappedNode.writeBamFile(model.bam_file)
-    print 'saved', model_name, mesh
-    wrappedNode = None
     
-    return model.bam_file
+    root, ext = os.path.splitext(bam_file)
+    temp_file = '%s.%d.tmp%s' % (root, os.getpid(), ext)
+    wrappedNode.writeBamFile(temp_file)
+    os.rename(temp_file, bam_file)
+    
+    return bam_file
@@ -0,0 +1,274 @@
+"""Placement of models over the triangles of map centers
+
+Each center's polygon is split into triangles between its center and
+corners. Points are poisson disk sampled over each triangle's bounding
+box and put on the triangle's plane.
+
+A Placer also draws each point's model and scale. It uses a random
+number generator seeded from a run seed, the stage name and the center
+id, so a center's placements do not depend on which process handles
+it, or on what came before it. Centers are handed out in chunks to a
+process pool::
+
+    placer = placement.Placer(seed, scene.terrain_transform(terrain), workers=4)
+    for points, scales, choices in placer.place('Dense Forest', centers, map, 2, 6, len(trees), (3.0, 10.0)):
+        ...
+    placer.close()
+
+For runs split over machines, shard_of assigns each center to one of N
+shards by a hash of its id. write_candidates saves the candidate models
+a shard generated, in the order generated, and merge_candidates merges
+the files of all shards back into that order. Shard files carry the
+run_fingerprint of the catalog and map they came from, so files of
+different inputs aren't merged.
+"""
+
+import json
+import heapq
+import random
+import hashlib
+import itertools
+import multiprocessing
+
+import numpy
+
+import poisson_disk
+from mapgen2 import Z_SCALE
+
+# centers sent to a worker at a time
+CHUNK_SIZE = 16
+
+SHARD_VERSION = 2
+
+class ShardError(Exception):
+    pass
+
+def center_triangles(center, map):
+    """Returns a (K, 3, 3) float64 array of the mapgen coordinates of the
+    triangles of a center's polygon"""
+    tris = []
+    for edge in center.edges:
+        corner0 = edge.corner0
+        corner1 = edge.corner1
+        center0 = edge.center0
+        center1 = edge.center1
+        if corner0 is None or corner1 is None:
+            continue
+
+        if center.id == center0.id:
+            tri = (map.corners[corner1.id], map.corners[corner0.id], map.centers[center0.id])
+        elif center.id == center1.id:
+            tri = (map.centers[center1.id], map.corners[corner0.id], map.corners[corner1.id])
+        else:
+            continue
+
+        tris.append([(v.x, v.y, v.elevation * Z_SCALE) for v in tri])
+    return numpy.array(tris, dtype=numpy.float64).reshape(-1, 3, 3)
+
+def plane_from_points(v1, v2, v3):
+    """Computes the best fit plane through a set of points.
+
+    Returns
+      (n, d) where n in the normal of the plane, d is the scalar offset
+    """
+
+    vec1 = v1 - v2
+    vec2 = v1 - v3
+    norm = numpy.cross(vec1, vec2)
+    d = numpy.dot(norm, v3)
+    return (norm, d)
+
+def iterate_triangle_samples(triangles, radius, num_samples):
+    """Yields an (N, 3) float32 array of the mapgen coordinates of up to
+    num_samples poisson disk samples in each triangle, drawing from the
+    random module"""
+    for tri in triangles:
+        minx, miny = tri[:, :2].min(axis=0).tolist()
+        maxx, maxy = tri[:, :2].max(axis=0).tolist()
+        width = int(maxx - minx)
+        height = int(maxy - miny)
+
+        samples = poisson_disk.sample_poisson_uniform(width, height, radius, num_samples)
+        samples = [(x+minx, y+miny) for x,y in samples]
+
+        random.shuffle(samples)
+        samples = samples[:num_samples]
+
+        if len(samples) == 0:
+            continue
+
+        pts = tri.astype(numpy.float32)
+        n, d = plane_from_points(*pts)
+        a, b, c = n
+
+        batch = numpy.empty((len(samples), 3), dtype=numpy.float32)
+        xy = numpy.array(samples, dtype=numpy.float64)
+        batch[:, :2] = xy
+        # ax + by + cz = d
+        # z = (d - ax - by)/c
+        batch[:, 2] = (d - a*xy[:, 0] - b*xy[:, 1]) / c
+
+        yield batch
+
+def center_seed(seed, name, center_id):
+    """Returns the random seed of a center in a stage of a run"""
+    key = '%s:%s:%s' % (seed, name, center_id)
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+# terrain transform of the placements of this process
+_transform = None
+
+def _init(transform):
+    global _transform
+    _transform = transform
+
+def _place_center(task):
+    """Returns (points, scales, choices) of a center, from the random
+    module seeded by the task and restored afterwards"""
+    seed, triangles, radius, num_samples, num_choices, scale_range = task
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        points = list(iterate_triangle_samples(triangles, radius, num_samples))
+        points = numpy.concatenate(points) if len(points) > 0 else numpy.empty((0, 3), dtype=numpy.float32)
+        _transform.transform(points, out=points)
+        scales = numpy.array([random.uniform(*scale_range) for _ in xrange(len(points))])
+        choices = numpy.array([random.randrange(num_choices) for _ in xrange(len(points))], dtype=numpy.int32)
+    finally:
+        random.setstate(state)
+    return points, scales, choices
+
+class Placer(object):
+    """Places models over map centers with per-center seeds, in a pool of
+    worker processes if workers is more than one. The results are the
+    same for any number of workers."""
+
+    def __init__(self, seed, transform, workers=1):
+        self.seed = seed
+        self.workers = workers
+        self._pool = None
+        if workers > 1:
+            self._pool = multiprocessing.Pool(workers, initializer=_init, initargs=(transform,))
+        else:
+            _init(transform)
+
+    def place(self, name, centers, map, radius, num_samples, num_choices, scale_range):
+        """Yields, for each center in order, (points, scales, choices): the
+        (N, 3) float32 sirikata coordinates of its samples, a scale drawn
+        from scale_range for each and the index of one of num_choices
+        models for each"""
+        tasks = ((center_seed(self.seed, name, center.id), center_triangles(center, map),
+                  radius, num_samples, num_choices, scale_range)
+                 for center in centers)
+        if self._pool is None:
+            return itertools.imap(_place_center, tasks)
+        return self._pool.imap(_place_center, tasks, chunksize=CHUNK_SIZE)
+
+    def close(self, abort=False):
+        """Shuts down the workers, after they finish the centers handed
+        out, or, with abort, at once"""
+        if self._pool is not None:
+            if abort:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+def shard_of(center_id, num_shards):
+    """Returns the shard that owns a center, from a hash of its id that is
+    the same on every machine"""
+    return int(hashlib.md5(str(center_id)).hexdigest()[:8], 16) % num_shards
+
+def run_fingerprint(models, map_fname):
+    """Returns a dict identifying the inputs of a run: the sha1 of the
+    ordered full paths of each category of the catalog items models, and
+    the sha1 of the map file"""
+    fingerprint = {}
+    for category, items in models.iteritems():
+        paths = '\n'.join(item['full_path'] for item in items)
+        fingerprint[category] = hashlib.sha1(paths.encode('utf-8')).hexdigest()
+    sha1 = hashlib.sha1()
+    with open(map_fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            sha1.update(chunk)
+    return {'catalogs': fingerprint, 'map': sha1.hexdigest()}
+
+def write_candidates(fname, seed, shard, fingerprint, groups):
+    """Writes groups of (stage name, center index, SceneModelArray) as JSON
+    lines after a header line for shard (i, N) of a run with seed and the
+    run_fingerprint of its inputs, skipping the groups with no
+    SceneModelArray that end a stage. Returns the number of models
+    written."""
+    count = 0
+    with open(fname, 'w') as f:
+        f.write(json.dumps({'version': SHARD_VERSION, 'seed': seed,
+                            'shard': shard[0], 'shards': shard[1],
+                            'fingerprint': fingerprint}) + '\n')
+        for stage, index, models in groups:
+            if models is None:
+                continue
+            f.write(json.dumps({'stage': stage,
+                                'center': index,
+                                'paths': [models.paths[i] for i in models.path_ids.tolist()],
+                                'types': [models.types[i] for i in models.type_ids.tolist()],
+                                'positions': models.positions.tolist(),
+                                'scales': models.scales.tolist(),
+                                'orientations': models.orientations.tolist()}) + '\n')
+            count += len(models)
+    return count
+
+def read_candidates(fname):
+    """Returns (header, groups) of a file written by write_candidates,
+    where groups yields (stage name, center index, SceneModelArray)"""
+    f = open(fname)
+    header = json.loads(f.readline())
+    if header.get('version') != SHARD_VERSION:
+        raise ShardError('%s is not a shard file of version %d' % (fname, SHARD_VERSION))
+
+    def groups():
+        import scene
+        with f:
+            for line in f:
+                group = json.loads(line)
+                yield group['stage'], group['center'], scene.SceneModelArray.from_columns(
+                    group['paths'], group['positions'], group['scales'], group['types'],
+                    group['orientations'], dtype=numpy.float64)
+    return header, groups()
+
+def candidate_paths(fnames):
+    """Returns the sorted paths of the candidate models in shard files"""
+    paths = set()
+    for fname in fnames:
+        header, groups = read_candidates(fname)
+        for stage, index, models in groups:
+            paths.update(models.paths)
+    return sorted(paths)
+
+def merge_candidates(fnames, stage_order):
+    """Merges the shard files of one run into the order a single run
+    generates its candidates in, given the index of each stage name in
+    stage_order. Returns (header, groups)."""
+    headers = []
+    streams = []
+    for fname in fnames:
+        header, groups = read_candidates(fname)
+        headers.append(header)
+        streams.append(groups)
+
+    first = headers[0]
+    shards = sorted(h['shard'] for h in headers)
+    if any(h['seed'] != first['seed'] or h['shards'] != first['shards'] for h in headers):
+        raise ShardError('shard files are from different runs')
+    if any(h['fingerprint'] != first['fingerprint'] for h in headers):
+        raise ShardError('shard files were generated from different catalogs or maps')
+    if shards != range(first['shards']):
+        raise ShardError('expected shards 0 to %d, got %s' % (first['shards'] - 1, shards))
+
+    def keyed(shard, groups):
+        for number, (stage, index, models) in enumerate(groups):
+            yield (stage_order[stage], index, shard, number), (stage, index, models)
+
+    merged = heapq.merge(*[keyed(h['shard'], stream) for h, stream in zip(headers, streams)])
+    return ({'seed': first['seed'], 'shards': first['shards'], 'fingerprint': first['fingerprint']},
+            (group for key, group in merged))
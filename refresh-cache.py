@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+import sys
+from optparse import OptionParser
+
+import cache
+
+def main():
+    parser = OptionParser(usage="Usage: refresh-cache.py [-j jobs]",
+                          description="Revalidates cached tag and metadata entries with conditional requests")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=16,
+                      help="number of requests to run in parallel (default 16)")
+    (options, args) = parser.parse_args()
+    
+    if len(args) != 0:
+        parser.print_help()
+        parser.exit(1, "Wrong number of arguments.\n")
+    
+    counts = cache.revalidate(workers=options.jobs)
+    print 'Revalidated %d entries: %d unchanged, %d updated, %d failed' % \
+            (sum(counts.values()), counts['unchanged'], counts['updated'], counts['failed'])
+    
+    if counts['failed'] > 0:
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,6 @@
 
 import os
 import sys
-import json
 from optparse import OptionParser
 
 import numpy
@@ -14,7 +13,7 @@ import meshtool.filters.panda_filters.pandacontrols as controls
 import meshtool.filters.print_filters.print_bounds as print_bounds
 
 import cache
-import scene
+import scenefile
 
 def centerAndScale(nodePath, boundsInfo):
     wrapNode = None
@@ -106,8 +105,8 @@ class SceneRenderer(ShowBase.ShowBase):
         
 
 def main():
-    parser = OptionParser(usage="Usage: renderscene.py scene.json",
-                          description="Renders a JSON scene file")
+    parser = OptionParser(usage="Usage: renderscene.py scene.json|scene.scene",
+                          description="Renders a JSON or binary scene file")
     (options, args) = parser.parse_args()
     
     if len(args) != 1:
@@ -119,10 +118,8 @@ def main():
         parser.exit(1, "Input file '%s' is not a valid file.\n" % args[0])
         
     fname = args[0]
-    json_data = json.load(open(fname))
-    
     print 'Fetching models'
-    models = [scene.SceneModel.from_json(j) for j in json_data]
+    models = list(scenefile.iter_models(fname))
     
     print 'Starting scene'
     r = SceneRenderer(models)
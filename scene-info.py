@@ -2,13 +2,13 @@
 
 import os
 import sys
-import json
 import locale
 import math
 from optparse import OptionParser
 from clint.textui import indent, puts, puts_err
 
 import cache
+import scenefile
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -32,8 +32,8 @@ def humanize_bytes(bytes, precision=1):
     return '%.*f %s' % (precision, bytes / factor, suffix)
 
 def main():
-    parser = OptionParser(usage="Usage: scene-info.py [--missing-to file.txt] scene.json",
-                          description="Prints information about a JSON scene file.")
+    parser = OptionParser(usage="Usage: scene-info.py [--missing-to file.txt] scene.json|scene.scene",
+                          description="Prints information about a JSON or binary scene file.")
     parser.add_option("-m", "--missing-to", dest="missing_to",
                           help="Write a list of paths missing progressive info to file", metavar="MISSING_TO")
     (options, args) = parser.parse_args()
@@ -51,7 +51,8 @@ def main():
         missing_to = open(options.missing_to, 'w')
     
     fname = args[0]
-    json_data = json.load(open(fname))
+    # per-model totals are counted once per unique path times its count
+    path_counts = scenefile.path_counts(fname)
     
     total_triangles = 0
     total_draw_calls = 0
@@ -76,23 +77,23 @@ def main():
     too_big = set()
     
     
-    for m in json_data:
-        metadata = cache.get_metadata(m['path'])
+    for path, count in path_counts.iteritems():
+        metadata = cache.get_metadata(path)
         
         if 'progressive' not in metadata['metadata']['types']:
-            missing_progressive.add(m['path'])
+            missing_progressive.add(path)
         else:
             progressive = metadata['metadata']['types']['progressive']
             if 'metadata' not in progressive:
-                missing_metadata.add(m['path'])
+                missing_metadata.add(path)
             else:
-                total_base_tris += min(progressive['metadata']['num_triangles'], 40000)
-                total_base_mesh_bytes[m['path']] = progressive['size_gzip']
-                total_base_stream_bytes[m['path']] = progressive.get('progressive_stream_size_gzip', 0)
-                total_full_tris += progressive['metadata']['num_triangles']
+                total_base_tris += min(progressive['metadata']['num_triangles'], 40000) * count
+                total_base_mesh_bytes[path] = progressive['size_gzip']
+                total_base_stream_bytes[path] = progressive.get('progressive_stream_size_gzip', 0)
+                total_full_tris += progressive['metadata']['num_triangles'] * count
                 
                 if progressive['metadata']['num_triangles'] > 40000:
-                    too_big.add(m['path'])
+                    too_big.add(path)
                 
                 for mapname, mapinfo in progressive['mipmaps'].iteritems():
                     byte_ranges = mapinfo['byte_ranges']
@@ -103,25 +104,25 @@ def main():
                             ram_size = width * height * 4
                             byte_size = levelinfo['length']
                             break
-                    base_ram_cache[m['path']] = ram_size
-                    total_base_texture_bytes[m['path']] = byte_size
+                    base_ram_cache[path] = ram_size
+                    total_base_texture_bytes[path] = byte_size
                     
                     if len(byte_ranges) > 0:
                         full_res = byte_ranges[-1]
                         width, height = full_res['width'], full_res['height']
-                        full_ram_cache[m['path']] = width * height * 4
+                        full_ram_cache[path] = width * height * 4
                 
-                    total_texture_sum[m['path']] = sum([l['length'] for l in byte_ranges])
+                    total_texture_sum[path] = sum([l['length'] for l in byte_ranges])
                 
-                total_base_draw_calls += progressive['metadata']['num_draw_calls']
-                total_full_draw_calls += progressive['metadata']['num_draw_calls']
+                total_base_draw_calls += progressive['metadata']['num_draw_calls'] * count
+                total_full_draw_calls += progressive['metadata']['num_draw_calls'] * count
         
         optimized = metadata['metadata']['types']['optimized']
-        total_triangles += optimized['metadata']['num_triangles']
-        total_ram_cache[m['path']] = optimized['metadata']['texture_ram_usage']
-        total_draw_calls += optimized['metadata']['num_draw_calls']
-        total_mesh_size[m['path']] = optimized['size_gzip']
-        total_texture_size[m['path']] = sum(optimized['subfile_sizes_gzip'].values())
+        total_triangles += optimized['metadata']['num_triangles'] * count
+        total_ram_cache[path] = optimized['metadata']['texture_ram_usage']
+        total_draw_calls += optimized['metadata']['num_draw_calls'] * count
+        total_mesh_size[path] = optimized['size_gzip']
+        total_texture_size[path] = sum(optimized['subfile_sizes_gzip'].values())
     
     total_ram = sum(total_ram_cache.values())
     total_base_ram = sum(base_ram_cache.values())
@@ -152,8 +153,8 @@ def main():
     if len(missing_metadata) > 0:
         puts()
     
-    puts('Number of models in the scene: %s' % pretty(len(json_data)))
-    puts('Number of unique models in the scene: %s' % pretty(len(set(m['path'] for m in json_data))))
+    puts('Number of models in the scene: %s' % pretty(sum(path_counts.values())))
+    puts('Number of unique models in the scene: %s' % pretty(len(path_counts)))
     puts()
     
     puts("Type 'optimized'")
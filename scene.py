@@ -25,16 +25,138 @@ def height_offset(boundsInfo):
     height_range = (maxpt[2] - minpt[2])
     return height_range / 2.0
 
+def rotation_matrices(orientations):
+    """Returns the (N, 3, 3) rotation matrices of (N, 4) unit quaternions
+    stored as x, y, z, w"""
+    x, y, z, w = numpy.asarray(orientations, dtype=numpy.float64).reshape(-1, 4).T
+    return numpy.stack([1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w),
+                        2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w),
+                        2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)], axis=-1).reshape(-1, 3, 3)
+
+class BoundsTable(object):
+    """Normalized bounds, as returned by sirikata_bounds, and height
+    offsets of meshes, computed once per path from cache.get_bounds.
+    Paths get row ids in the order they are first seen; minpts and maxpts
+    are (N, 3) float32 arrays and heights an (N,) array."""
+    def __init__(self):
+        self.paths = []
+        self._ids = {}
+        self._minpts = numpy.empty((64, 3), dtype=numpy.float32)
+        self._maxpts = numpy.empty((64, 3), dtype=numpy.float32)
+        self._heights = numpy.empty(64, dtype=numpy.float64)
+
+    def __len__(self):
+        return len(self.paths)
+
+    minpts = property(lambda s: s._minpts[:len(s.paths)])
+    maxpts = property(lambda s: s._maxpts[:len(s.paths)])
+    heights = property(lambda s: s._heights[:len(s.paths)])
+
+    def path_id(self, path):
+        path_id = self._ids.get(path)
+        if path_id is not None:
+            return path_id
+
+        minpt, maxpt = sirikata_bounds(cache.get_bounds(path))
+        path_id = len(self.paths)
+        if path_id == len(self._heights):
+            capacity = 2 * path_id
+            self._minpts = numpy.resize(self._minpts, (capacity, 3))
+            self._maxpts = numpy.resize(self._maxpts, (capacity, 3))
+            self._heights = numpy.resize(self._heights, capacity)
+        self._minpts[path_id] = minpt
+        self._maxpts[path_id] = maxpt
+        self._heights[path_id] = (maxpt[2] - minpt[2]) / 2.0
+
+        self.paths.append(path)
+        self._ids[path] = path_id
+        return path_id
+
+    def path_ids(self, paths):
+        return numpy.array([self.path_id(path) for path in paths], dtype=numpy.int32)
+
+    def bounds(self, path):
+        """Returns read-only (minpt, maxpt) of the normalized bounds"""
+        path_id = self.path_id(path)
+        minpt = self._minpts[path_id]
+        maxpt = self._maxpts[path_id]
+        minpt.flags.writeable = False
+        maxpt.flags.writeable = False
+        return minpt, maxpt
+
+    def height_offset(self, path):
+        return self._heights[self.path_id(path)]
+
+    def world_bounds(self, ids, positions, scales, orientations=None):
+        """Returns (minpts, maxpts), (N, 3) float32 arrays of the bounds
+        of the meshes with row ids placed at positions with scales, in
+        sirikata coordinates. If (N, 4) orientations are given, the
+        bounds are those of each mesh's box rotated by its orientation."""
+        scales = numpy.asarray(scales, dtype=numpy.float32)[:, None]
+        positions = numpy.asarray(positions, dtype=numpy.float32).reshape(-1, 3)
+        minpts = self._minpts[ids] * scales + positions
+        maxpts = self._maxpts[ids] * scales + positions
+        if orientations is None:
+            return minpts, maxpts
+
+        orientations = numpy.asarray(orientations, dtype=numpy.float64).reshape(-1, 4)
+        rows = numpy.flatnonzero((orientations[:, :3] != 0).any(axis=1))
+        if len(rows) > 0:
+            ids = numpy.asarray(ids)[rows]
+            row_scales = scales[rows].astype(numpy.float64)
+            center = (self._minpts[ids] + self._maxpts[ids]).astype(numpy.float64) / 2.0 * row_scales
+            half = (self._maxpts[ids] - self._minpts[ids]).astype(numpy.float64) / 2.0 * row_scales
+            matrices = rotation_matrices(orientations[rows])
+            center = numpy.einsum('nij,nj->ni', matrices, center) + positions[rows]
+            half = numpy.einsum('nij,nj->ni', numpy.abs(matrices), half)
+            minpts[rows] = center - half
+            maxpts[rows] = center + half
+        return minpts, maxpts
+
+# shared by all scene models
+BOUNDS = BoundsTable()
+
+def sirikata_uri(metadata):
+    return 'meerkat:///' + \
+            metadata['basepath'] + '/' + \
+            'optimized' + '/' + \
+            metadata['version'] + '/' + \
+            metadata['basename']
+
+class TerrainTransform(object):
+    """Maps mapgen coordinates onto a terrain model in sirikata
+    coordinates. The terrain's bounds are looked up once, so points can
+    be transformed in bulk."""
+    def __init__(self, terrain):
+        self.center = terrain.center
+        self.distance = terrain.boundsInfo['center_farthest_distance']
+        self.scale = terrain.scale
+        self.height = BOUNDS.height_offset(terrain.path) * terrain.scale
+
+    def transform(self, points, out=None):
+        """Transforms a point or an (N, 3) array of points. The result is
+        written to out if given, which may be points itself."""
+        # mapgen starts at 0,0,0 as the corner, but terrain gets centered at 0,0,0
+        out = numpy.subtract(points, self.center, out=out)
+        # scale the coordinates to the scaled coordinates of the terrain mesh
+        out /= self.distance
+        # then scale back by the terrain's scale
+        out *= self.scale
+        # adjust the height by how much the terrain is offset, adding in
+        # double precision like the scalar code this replaced
+        z = out[..., 2]
+        numpy.add(z, self.height, out=z, dtype=numpy.float64)
+        return out
+
+def terrain_transform(terrain):
+    """Returns the TerrainTransform of a terrain SceneModel, computing it
+    on first use"""
+    if terrain._terrain_transform is None:
+        terrain._terrain_transform = TerrainTransform(terrain)
+    return terrain._terrain_transform
+
 def mapgen_coords_to_sirikata(loc, terrain):
-    # mapgen starts at 0,0,0 as the corner, but terrain gets centered at 0,0,0
-    loc = loc - terrain.center
-    # scale the coordinates to the scaled coordinates of the terrain mesh
-    loc /= terrain.boundsInfo['center_farthest_distance']
-    # then scale back by the terrain's scale
-    loc *= terrain.scale
-    # adjust the height by how much the terrain is offset
-    loc[2] += height_offset(terrain.boundsInfo) * terrain.scale
-    return loc
+    return terrain_transform(terrain).transform(loc)
 
 class SceneModel(object):
     def __init__(self, path, x, y, z, scale, model_type,
@@ -56,6 +178,7 @@ class SceneModel(object):
         self._metadata = None
         self._mesh = None
         self._boundsInfo = None
+        self._terrain_transform = None
         
     def _load_mesh(self):
         if self._mesh is None:
@@ -85,14 +208,10 @@ class SceneModel(object):
     
     v3 = property(lambda s: numpy.array([s.x, s.y, s.z], dtype=numpy.float32))
     
-    sirikata_uri = property(lambda s: 'meerkat:///' +
-                                        s.metadata['basepath'] + '/' +
-                                        'optimized' + '/' +
-                                        s.metadata['version'] + '/' + 
-                                        s.metadata['basename'])
+    sirikata_uri = property(lambda s: sirikata_uri(s.metadata))
     
     def to_json(self):
-        z = self.z + height_offset(self.boundsInfo) * self.scale
+        z = self.z + BOUNDS.height_offset(self.path) * self.scale
         
         # below swaps from z-up to y-up
         return {
@@ -129,3 +248,168 @@ class SceneModel(object):
                        orient_w=j['orient_w'])
         
         return m
+
+def _encode(values):
+    """Returns (vocabulary, ids) with values[i] == vocabulary[ids[i]]"""
+    vocabulary = []
+    index = {}
+    ids = numpy.empty(len(values), dtype=numpy.int32)
+    for i, value in enumerate(values):
+        value_id = index.get(value)
+        if value_id is None:
+            value_id = index[value] = len(vocabulary)
+            vocabulary.append(value)
+        ids[i] = value_id
+    return vocabulary, ids
+
+class SceneModelArray(object):
+    """A list of scene models stored as columns instead of SceneModel
+    objects. Paths and types are kept once each in the paths and types
+    lists and referenced by the path_ids and type_ids arrays; positions
+    (N, 3), scales (N,) and orientations (N, 4, as x, y, z, w) use z-up
+    sirikata coordinates like SceneModel.
+
+    The default float32 columns take about 40 bytes per model. With
+    dtype=numpy.float64, to_json gives the same values as
+    SceneModel.to_json."""
+
+    def __init__(self, paths, path_ids, positions, scales, orientations, types, type_ids):
+        self.paths = paths
+        self.path_ids = path_ids
+        self.positions = positions
+        self.scales = scales
+        self.orientations = orientations
+        self.types = types
+        self.type_ids = type_ids
+
+    def __len__(self):
+        return len(self.path_ids)
+
+    def __getitem__(self, i):
+        x, y, z = self.positions[i].tolist()
+        orient_x, orient_y, orient_z, orient_w = self.orientations[i].tolist()
+        return SceneModel(self.paths[self.path_ids[i]], x, y, z,
+                          float(self.scales[i]), self.types[self.type_ids[i]],
+                          orient_x=orient_x, orient_y=orient_y,
+                          orient_z=orient_z, orient_w=orient_w)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.path_ids, self.positions, self.scales,
+                                      self.orientations, self.type_ids])
+
+    @staticmethod
+    def from_columns(paths, positions, scales, types, orientations=None, dtype=numpy.float32):
+        """Builds an array from a path and a type per model, an (N, 3)
+        array of positions, N scales and optionally (N, 4) orientations,
+        which default to the identity"""
+        paths, path_ids = _encode(paths)
+        types, type_ids = _encode(types)
+        positions = numpy.asarray(positions, dtype=dtype).reshape(-1, 3)
+        scales = numpy.asarray(scales, dtype=dtype)
+        if orientations is None:
+            orientations = numpy.zeros((len(positions), 4), dtype=dtype)
+            orientations[:, 3] = 1
+        orientations = numpy.asarray(orientations, dtype=dtype).reshape(-1, 4)
+        return SceneModelArray(paths, path_ids, positions, scales, orientations, types, type_ids)
+
+    @staticmethod
+    def from_models(models, dtype=numpy.float32):
+        return SceneModelArray.from_columns(
+            [m.path for m in models],
+            [(m.x, m.y, m.z) for m in models],
+            [m.scale for m in models],
+            [m.model_type for m in models],
+            [(m.orient_x, m.orient_y, m.orient_z, m.orient_w) for m in models],
+            dtype=dtype)
+
+    @staticmethod
+    def from_json(json_data, dtype=numpy.float32):
+        """Inverse of to_json, converting like SceneModel.from_json"""
+        values = numpy.array([(j['x'], j['y'], j['z'], j['scale'],
+                               j['orient_x'], j['orient_y'], j['orient_z'], j['orient_w'])
+                              for j in json_data], dtype=numpy.float64).reshape(-1, 8)
+
+        # swap from y-up to z-up
+        positions = numpy.empty((len(values), 3), dtype=dtype)
+        positions[:, 0] = values[:, 0]
+        positions[:, 1] = -values[:, 2]
+        positions[:, 2] = values[:, 1]
+        orientations = numpy.empty((len(values), 4), dtype=dtype)
+        orientations[:, 0] = values[:, 4]
+        orientations[:, 1] = -values[:, 6]
+        orientations[:, 2] = values[:, 5]
+        orientations[:, 3] = values[:, 7]
+
+        return SceneModelArray.from_columns([j['path'] for j in json_data], positions, values[:, 3],
+                                            [j['type'] for j in json_data], orientations, dtype=dtype)
+
+    @staticmethod
+    def concatenate(arrays):
+        """Joins SceneModelArrays into one, merging their vocabularies"""
+        paths, path_ids = _encode([a.paths[i] for a in arrays for i in a.path_ids])
+        types, type_ids = _encode([a.types[i] for a in arrays for i in a.type_ids])
+        return SceneModelArray(paths, path_ids,
+                               numpy.concatenate([a.positions for a in arrays]),
+                               numpy.concatenate([a.scales for a in arrays]),
+                               numpy.concatenate([a.orientations for a in arrays]),
+                               types, type_ids)
+
+    def height_offsets(self):
+        """Returns the height offset of each model's mesh, per model"""
+        ids = BOUNDS.path_ids(self.paths)
+        return BOUNDS.heights[ids][self.path_ids]
+
+    def world_bounds(self):
+        """Returns (minpts, maxpts) of the placed and rotated models, as in
+        BoundsTable.world_bounds"""
+        ids = BOUNDS.path_ids(self.paths)
+        return BOUNDS.world_bounds(ids[self.path_ids], self.positions, self.scales, self.orientations)
+
+    def placed_bounds(self):
+        """Returns (minpts, maxpts) of the models as written to a scene,
+        raised by their height offsets"""
+        minpts, maxpts = self.world_bounds()
+        # scaled in float32 like world_bounds, whatever the dtype
+        lift = (self.height_offsets() * self.scales.astype(numpy.float32)).astype(numpy.float32)
+        minpts[:, 2] += lift
+        maxpts[:, 2] += lift
+        return minpts, maxpts
+
+    def subset(self, rows):
+        """Returns the models selected by an index or boolean array"""
+        return SceneModelArray(self.paths, self.path_ids[rows], self.positions[rows],
+                               self.scales[rows], self.orientations[rows],
+                               self.types, self.type_ids[rows])
+
+    def to_json(self):
+        """Returns the list of dicts that SceneModel.to_json would give for
+        each model"""
+        uris = [sirikata_uri(cache.get_metadata(path)) for path in self.paths]
+
+        # below swaps from z-up to y-up
+        y_col = self.positions[:, 2] + self.height_offsets() * self.scales
+        z_col = -1.0 * self.positions[:, 1]
+        orient_z_col = -1.0 * self.orientations[:, 1]
+
+        columns = zip(self.path_ids.tolist(),
+                      self.positions[:, 0].tolist(), y_col.tolist(), z_col.tolist(),
+                      self.orientations[:, 0].tolist(), self.orientations[:, 2].tolist(),
+                      orient_z_col.tolist(), self.orientations[:, 3].tolist(),
+                      self.scales.tolist(), self.type_ids.tolist())
+        return [{'path': self.paths[path_id],
+                 'sirikata_uri': uris[path_id],
+                 'x': x,
+                 'y': y,
+                 'z': z,
+                 'orient_x': ox,
+                 'orient_y': oy,
+                 'orient_z': oz,
+                 'orient_w': ow,
+                 'scale': scale,
+                 'type': self.types[type_id]}
+                for path_id, x, y, z, ox, oy, oz, ow, scale, type_id in columns]
@@ -0,0 +1,344 @@
+"""Binary scene files
+
+A binary scene holds the same records as a JSON scene written by
+generate-scene.py, in a layout that can be memory-mapped:
+
+    magic 'SCNB', uint32 version, uint32 header length
+    header: JSON with the record count, float type, string table, type
+            names and the offset and length of each type's row list
+    records: packed array of RECORD_FIELDS, padded to 8 bytes
+    type rows: uint32 record numbers of each type, grouped by type
+
+Paths and sirikata URIs are stored once in the string table and records
+refer to them by index. Coordinates are kept in the y-up convention of
+the JSON schema. Files written with float64 records convert back to the
+same values as the JSON they came from; compact files use float32.
+"""
+
+import re
+import json
+import struct
+from collections import OrderedDict
+
+import numpy
+
+MAGIC = 'SCNB'
+VERSION = 1
+_PREAMBLE = struct.Struct('<4sII')
+
+# bytes read at a time by the streaming JSON reader
+CHUNK_SIZE = 1 << 20
+
+# records per batch yielded by the batch readers
+BATCH_SIZE = 4096
+
+FLOAT_FIELDS = ['x', 'y', 'z', 'orient_x', 'orient_y', 'orient_z', 'orient_w', 'scale']
+
+class FormatError(Exception):
+    pass
+
+def record_dtype(float_type='<f8'):
+    return numpy.dtype([('path', '<u4'), ('uri', '<u4'), ('type', '<u2')] +
+                       [(name, float_type) for name in FLOAT_FIELDS])
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+class _Vocabulary(object):
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+
+    def id(self, value):
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+def write(fname, json_data, compact=False):
+    """Writes a list of JSON scene records to a binary scene file. With
+    compact, coordinates are stored as float32."""
+    float_type = '<f4' if compact else '<f8'
+    records = numpy.empty(len(json_data), dtype=record_dtype(float_type))
+
+    strings = _Vocabulary()
+    types = _Vocabulary()
+    records['path'] = [strings.id(j['path']) for j in json_data]
+    records['uri'] = [strings.id(j['sirikata_uri']) for j in json_data]
+    records['type'] = [types.id(j['type']) for j in json_data]
+    for name in FLOAT_FIELDS:
+        records[name] = [j[name] for j in json_data]
+
+    _write(fname, records, float_type, strings.values, types.values)
+
+def _write(fname, records, float_type, strings, types):
+    # stable, so rows of a type stay in scene order
+    order = numpy.argsort(records['type'], kind='mergesort').astype('<u4')
+    counts = numpy.bincount(records['type'], minlength=len(types))
+    starts = numpy.concatenate([[0], numpy.cumsum(counts)[:-1]]) if len(types) > 0 else []
+
+    header = json.dumps({'count': len(records),
+                         'float': float_type,
+                         'strings': strings,
+                         'types': types,
+                         'type_rows': dict((t, [int(start), int(count)])
+                                           for t, start, count in zip(types, starts, counts))})
+
+    records_offset = _align(_PREAMBLE.size + len(header))
+    rows_offset = _align(records_offset + records.nbytes)
+    with open(fname, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.write('\0' * (records_offset - f.tell()))
+        f.write(records.tostring())
+        f.write('\0' * (rows_offset - f.tell()))
+        f.write(order.tostring())
+
+def is_binary(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+class SceneFile(object):
+    """Memory-mapped reader of a binary scene file. records is a read-only
+    structured array of RECORD_FIELDS; its path and uri fields index
+    strings and its type field indexes types."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            preamble = f.read(_PREAMBLE.size)
+            if len(preamble) != _PREAMBLE.size:
+                raise FormatError('%s is too short to be a binary scene' % fname)
+            magic, version, header_length = _PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise FormatError('%s is not a binary scene' % fname)
+            if version != VERSION:
+                raise FormatError('%s has unsupported version %d' % (fname, version))
+            header = json.loads(f.read(header_length))
+
+        self.strings = header['strings']
+        self.types = header['types']
+        self._type_rows = header['type_rows']
+        self.dtype = record_dtype(header['float'])
+
+        count = header['count']
+        records_offset = _align(_PREAMBLE.size + header_length)
+        rows_offset = _align(records_offset + count * self.dtype.itemsize)
+        if count > 0:
+            self.records = numpy.memmap(fname, dtype=self.dtype, mode='r',
+                                        offset=records_offset, shape=(count,))
+            self._rows = numpy.memmap(fname, dtype='<u4', mode='r',
+                                      offset=rows_offset, shape=(count,))
+        else:
+            self.records = numpy.empty(0, dtype=self.dtype)
+            self._rows = numpy.empty(0, dtype='<u4')
+
+    def __len__(self):
+        return len(self.records)
+
+    def rows_of_type(self, model_type):
+        """Returns the record numbers of the models of a type, in order"""
+        if model_type not in self._type_rows:
+            return self._rows[:0]
+        start, count = self._type_rows[model_type]
+        return self._rows[start:start + count]
+
+    def paths(self):
+        """Returns the path of every record"""
+        strings = self.strings
+        return [strings[i] for i in self.records['path'].tolist()]
+
+    def path_counts(self):
+        """Returns an ordered dict of each path to its number of models"""
+        counts = numpy.bincount(self.records['path'], minlength=len(self.strings))
+        return OrderedDict((self.strings[i], int(counts[i])) for i in numpy.flatnonzero(counts))
+
+    def to_json(self, rows=None):
+        """Returns the records, or those numbered in rows, as JSON scene
+        dicts"""
+        records = self.records if rows is None else self.records[rows]
+        strings = self.strings
+        types = self.types
+        columns = zip(*([records['path'].tolist(), records['uri'].tolist(), records['type'].tolist()] +
+                        [records[name].tolist() for name in FLOAT_FIELDS]))
+        return [{'path': strings[path],
+                 'sirikata_uri': strings[uri],
+                 'type': types[model_type],
+                 'x': x, 'y': y, 'z': z,
+                 'orient_x': ox, 'orient_y': oy, 'orient_z': oz, 'orient_w': ow,
+                 'scale': scale}
+                for path, uri, model_type, x, y, z, ox, oy, oz, ow, scale in columns]
+
+def _dumps(json_data, compact=False):
+    if compact:
+        return json.dumps(json_data, separators=(',', ':'))
+    return json.dumps(json_data, indent=2)
+
+def write_json(fname, json_data, compact=False):
+    """Writes JSON scene records the way generate-scene.py does. With
+    compact, the JSON has no whitespace."""
+    with open(fname, 'w') as f:
+        f.write(_dumps(json_data, compact))
+
+def write_em(fname, json_data, compact=False):
+    """Writes JSON scene records as an Emerson script defining OBJECTS"""
+    with open(fname, 'w') as f:
+        f.write('var OBJECTS = ')
+        f.write(_dumps(json_data, compact))
+        f.write(';\n')
+
+class SceneWriter(object):
+    """Writes JSON scene records to {outname}.json and the Emerson script
+    {outname}.em as they arrive, encoding each record once for both. The
+    files are the same as write_json and write_em of the whole list would
+    give, without the list ever being held in memory."""
+
+    def __init__(self, outname, compact=False):
+        self.compact = compact
+        self.count = 0
+        self._json = open(outname + '.json', 'w')
+        self._em = open(outname + '.em', 'w')
+        self._em.write('var OBJECTS = ')
+        self._write('[')
+
+    def _write(self, data):
+        self._json.write(data)
+        self._em.write(data)
+
+    def write(self, records):
+        """Writes an iterable of JSON scene records and returns how many
+        there were"""
+        start = self.count
+        for j in records:
+            if self.compact:
+                self._write((',' if self.count > 0 else '') + _dumps(j, True))
+            else:
+                # the records of json.dumps(list, indent=2) are indented one
+                # level further and separated by ', '
+                self._write((', \n  ' if self.count > 0 else '\n  ') +
+                            _dumps(j).replace('\n', '\n  '))
+            self.count += 1
+        return self.count - start
+
+    def close(self):
+        if self._json is None:
+            return
+        self._write('\n]' if self.count > 0 and not self.compact else ']')
+        self._em.write(';\n')
+        self._json.close()
+        self._em.close()
+        self._json = self._em = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_json(fname):
+    """Returns the JSON scene records of a JSON or binary scene file"""
+    if is_binary(fname):
+        return SceneFile(fname).to_json()
+    with open(fname) as f:
+        return json.load(f)
+
+_SPACE = re.compile(r'\s*')
+
+def _iter_json_array(f, chunk_size):
+    """Yields the objects of the JSON array in file f, reading chunk_size
+    bytes at a time"""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    need_comma = False
+    count = 0
+    while True:
+        pos = _SPACE.match(buf, pos).end()
+        if pos < len(buf):
+            char = buf[pos]
+            if not started:
+                if char != '[':
+                    raise ValueError('JSON scene does not start with an array')
+                started = True
+                pos += 1
+                continue
+            if char == ']' and (need_comma or count == 0):
+                return
+            if need_comma:
+                if char != ',':
+                    raise ValueError('expected , in JSON scene at %r' % buf[pos:pos + 20])
+                need_comma = False
+                pos += 1
+                continue
+            if char != '{':
+                raise ValueError('expected an object in JSON scene at %r' % buf[pos:pos + 20])
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the object continues past the end of the buffer
+                if eof:
+                    raise
+            else:
+                yield obj
+                need_comma = True
+                count += 1
+                continue
+        elif eof:
+            raise ValueError('unexpected end of JSON scene')
+
+        chunk = f.read(chunk_size)
+        eof = len(chunk) == 0
+        buf = buf[pos:] + chunk
+        pos = 0
+
+def iter_json(fname, chunk_size=CHUNK_SIZE):
+    """Yields the JSON scene records of a JSON or binary scene file one at
+    a time, without loading the whole file"""
+    for batch in iter_json_batches(fname, chunk_size=chunk_size):
+        for j in batch:
+            yield j
+
+def iter_json_batches(fname, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE):
+    """Yields lists of up to batch_size JSON scene records of a JSON or
+    binary scene file"""
+    if is_binary(fname):
+        scene_file = SceneFile(fname)
+        for start in xrange(0, len(scene_file), batch_size):
+            yield scene_file.to_json(slice(start, start + batch_size))
+        return
+
+    batch = []
+    with open(fname, 'rb') as f:
+        for j in _iter_json_array(f, chunk_size):
+            batch.append(j)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+def iter_models(fname):
+    """Yields the models of a JSON or binary scene file as SceneModels"""
+    import scene
+    for j in iter_json(fname):
+        yield scene.SceneModel.from_json(j)
+
+def iter_model_batches(fname, batch_size=BATCH_SIZE, dtype=numpy.float32):
+    """Yields the models of a JSON or binary scene file as
+    SceneModelArrays of up to batch_size models"""
+    import scene
+    for batch in iter_json_batches(fname, batch_size):
+        yield scene.SceneModelArray.from_json(batch, dtype=dtype)
+
+def path_counts(fname):
+    """Returns an ordered dict of each path in a JSON or binary scene file
+    to its number of models"""
+    if is_binary(fname):
+        return SceneFile(fname).path_counts()
+    counts = OrderedDict()
+    for j in iter_json(fname):
+        counts[j['path']] = counts.get(j['path'], 0) + 1
+    return counts
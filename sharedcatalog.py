@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""Read-only bounds and metadata of a set of models for worker processes
+
+publish() copies the bounds and metadata a job needs from the cache into
+a directory of flat files: the bounds as numpy arrays and the metadata
+as concatenated JSON documents with an array of offsets. SharedCatalog
+memory-maps those files, so any number of processes opening the same
+directory share one copy in the page cache instead of each unpickling
+its own from the shelf. A process pool attaches its workers with::
+
+    pool = multiprocessing.Pool(initializer=sharedcatalog.attach,
+                                initargs=('job.catalog',))
+
+after which cache.get_bounds and cache.get_metadata answer published
+paths from the shared files.
+"""
+
+import os
+import json
+import mmap
+from optparse import OptionParser
+
+import numpy
+
+INDEX_FILE = 'index.json'
+METADATA_FILE = 'metadata.json'
+
+# columns of points.npy: bounds min, bounds max, center, center_farthest
+POINT_COLUMNS = ['min', 'max', 'center', 'center_farthest']
+
+def publish(paths, dirname, get_bounds=None, get_metadata=None):
+    """Writes the bounds and metadata of paths to dirname and returns the
+    number of models with bounds. get_bounds and get_metadata default to
+    the cache functions. Models whose bounds raise open3dhub.ModelRejected
+    are published with metadata only."""
+    import cache
+    import open3dhub
+    if get_bounds is None:
+        get_bounds = cache.get_bounds
+    if get_metadata is None:
+        get_metadata = cache.get_metadata
+
+    seen = set()
+    paths = [p for p in paths if not (p in seen or seen.add(p))]
+    n = len(paths)
+
+    points = numpy.empty((n, len(POINT_COLUMNS), 3), dtype=numpy.float32)
+    points.fill(numpy.nan)
+    distances = numpy.empty(n, dtype=numpy.float64)
+    distances.fill(numpy.nan)
+    offsets = numpy.zeros(n + 1, dtype=numpy.int64)
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    with_bounds = 0
+    with open(os.path.join(dirname, METADATA_FILE), 'wb') as f:
+        for row, path in enumerate(paths):
+            blob = json.dumps(get_metadata(path))
+            f.write(blob)
+            offsets[row + 1] = offsets[row] + len(blob)
+
+            try:
+                info = get_bounds(path)
+            except open3dhub.ModelRejected:
+                continue
+            points[row] = [info['bounds'][0], info['bounds'][1],
+                           info['center'], info['center_farthest']]
+            distances[row] = info['center_farthest_distance']
+            with_bounds += 1
+
+    numpy.save(os.path.join(dirname, 'points.npy'), points)
+    numpy.save(os.path.join(dirname, 'distances.npy'), distances)
+    numpy.save(os.path.join(dirname, 'offsets.npy'), offsets)
+    # written last so a reader never sees an index for missing arrays
+    with open(os.path.join(dirname, INDEX_FILE), 'w') as f:
+        json.dump({'paths': paths}, f)
+
+    return with_bounds
+
+class SharedCatalog(object):
+    """Memory-mapped view of a directory written by publish()"""
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, INDEX_FILE)) as f:
+            self.paths = json.load(f)['paths']
+        self._rows = dict((p, i) for i, p in enumerate(self.paths))
+
+        self.points = numpy.load(os.path.join(dirname, 'points.npy'), mmap_mode='r')
+        self.distances = numpy.load(os.path.join(dirname, 'distances.npy'), mmap_mode='r')
+        self.offsets = numpy.load(os.path.join(dirname, 'offsets.npy'), mmap_mode='r')
+
+        self._metadata = None
+        if self.offsets[-1] > 0:
+            with open(os.path.join(dirname, METADATA_FILE), 'rb') as f:
+                self._metadata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self._rows
+
+    def get_bounds(self, path):
+        """Returns the bounds info of path in the form of cache.get_bounds,
+        or None if path was not published with bounds"""
+        row = self._rows.get(path)
+        if row is None or numpy.isnan(self.distances[row]):
+            return None
+        minpt, maxpt, center, farthest = numpy.array(self.points[row])
+        return {'bounds': (minpt, maxpt),
+                'center': center,
+                'center_farthest': farthest,
+                'center_farthest_distance': float(self.distances[row])}
+
+    def get_metadata(self, path):
+        """Returns the metadata of path, or None if it was not published"""
+        row = self._rows.get(path)
+        if row is None:
+            return None
+        return json.loads(self._metadata[int(self.offsets[row]):int(self.offsets[row + 1])])
+
+    def close(self):
+        if self._metadata is not None:
+            self._metadata.close()
+            self._metadata = None
+
+def attach(dirname):
+    """Opens the catalog in dirname and attaches it to the cache module of
+    this process. Suitable as a multiprocessing.Pool initializer."""
+    import cache
+    cache.attach_shared(SharedCatalog(dirname))
+
+def main():
+    parser = OptionParser(usage="Usage: sharedcatalog.py -o outdir [-t tag] [-f paths.txt] [path ...]",
+                          description="Publishes cached bounds and metadata of models for worker processes to memory-map")
+    parser.add_option("-o", "--outdir", dest="outdir",
+                      help="write the shared catalog to OUTDIR", metavar="OUTDIR")
+    parser.add_option("-t", "--tag", dest="tags", action="append", default=[],
+                      help="publish every model with TAG (may be repeated)", metavar="TAG")
+    parser.add_option("-f", "--file", dest="pathfile",
+                      help="publish the model paths listed in FILE, one per line", metavar="FILE")
+    (options, args) = parser.parse_args()
+
+    if options.outdir is None:
+        parser.print_help()
+        parser.exit(1, "Must specify an output directory.\n")
+
+    paths = list(args)
+    if options.pathfile is not None:
+        with open(options.pathfile) as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    if len(options.tags) > 0:
+        import cache
+        for tag in options.tags:
+            paths.extend(m['full_path'] for m in cache.get_tag(tag))
+
+    if len(paths) == 0:
+        parser.print_help()
+        parser.exit(1, "No models to publish.\n")
+
+    with_bounds = publish(paths, options.outdir)
+    catalog = SharedCatalog(options.outdir)
+    print 'Published %d models (%d with bounds) to %s' % (len(catalog), with_bounds, options.outdir)
+
+if __name__ == '__main__':
+    main()
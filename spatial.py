@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""Bounding volume hierarchy over the world bounds of scene models
+
+A BVH is stored as flat arrays: node boxes, the index of each internal
+node's first child (its second child follows it) and each leaf's range
+of the item order. Queries take batches and walk the tree one level at a
+time for all queries together, so their cost is a few array operations
+per level rather than Python work per node::
+
+    bvh = BVH.from_models(scenefile.iter_model_batches('scene.json'))
+    hits = bvh.query_boxes(minpts, maxpts)      # a list of item id arrays
+    ids, dists = bvh.nearest(points, k=4)
+    bvh.save('scene.bvh.npz')
+
+Boxes are inclusive, like the overlap test of generate-scene.py. Items
+are numbered in the order they were given, so for a scene they are the
+record numbers.
+"""
+
+import heapq
+from optparse import OptionParser
+
+import numpy
+
+# maximum number of items in a leaf
+LEAF_SIZE = 8
+
+ARRAYS = ['node_min', 'node_max', 'node_child', 'node_start', 'node_count',
+          'order', 'item_min', 'item_max']
+
+def _expand_leaves(queries, starts, counts, order):
+    """Returns (queries, items) pairing each query with every item of the
+    leaf range it reached"""
+    total = counts.sum()
+    ends = numpy.cumsum(counts)
+    offsets = numpy.arange(total) - numpy.repeat(ends - counts, counts)
+    return numpy.repeat(queries, counts), order[numpy.repeat(starts, counts) + offsets]
+
+def _group(queries, items, num_queries):
+    """Splits item ids into a sorted array per query"""
+    order = numpy.lexsort((items, queries))
+    queries, items = queries[order], items[order]
+    bounds = numpy.searchsorted(queries, numpy.arange(num_queries + 1))
+    return [items[bounds[i]:bounds[i + 1]] for i in xrange(num_queries)]
+
+def _box_distance2(points, minpts, maxpts):
+    """Squared distances from points to boxes, zero inside"""
+    nearest = numpy.minimum(numpy.maximum(points, minpts), maxpts)
+    diff = nearest - points
+    return numpy.einsum('ij,ij->i', diff, diff)
+
+class BVH(object):
+    def __init__(self, node_min, node_max, node_child, node_start, node_count,
+                 order, item_min, item_max):
+        self.node_min = node_min
+        self.node_max = node_max
+        self.node_child = node_child
+        self.node_start = node_start
+        self.node_count = node_count
+        self.order = order
+        self.item_min = item_min
+        self.item_max = item_max
+
+    def __len__(self):
+        return len(self.order)
+
+    @staticmethod
+    def build(minpts, maxpts, leaf_size=LEAF_SIZE):
+        """Builds a BVH over (N, 3) arrays of box corners by splitting each
+        node at the median centroid along its longest axis"""
+        item_min = numpy.asarray(minpts, dtype=numpy.float32).reshape(-1, 3)
+        item_max = numpy.asarray(maxpts, dtype=numpy.float32).reshape(-1, 3)
+        centers = (item_min + item_max) / 2
+        order = numpy.arange(len(item_min), dtype=numpy.int32)
+
+        node_min, node_max, node_child, node_start, node_count = [], [], [], [], []
+        def add_node(start, count):
+            node_min.append(None)
+            node_max.append(None)
+            node_child.append(-1)
+            node_start.append(start)
+            node_count.append(count)
+            return len(node_start) - 1
+
+        stack = [add_node(0, len(order))]
+        while len(stack) > 0:
+            node = stack.pop()
+            start, count = node_start[node], node_count[node]
+            items = order[start:start + count]
+            if count > 0:
+                node_min[node] = item_min[items].min(axis=0)
+                node_max[node] = item_max[items].max(axis=0)
+            else:
+                node_min[node] = numpy.zeros(3, dtype=numpy.float32)
+                node_max[node] = numpy.zeros(3, dtype=numpy.float32)
+            if count <= leaf_size:
+                continue
+
+            item_centers = centers[items]
+            axis = (item_centers.max(axis=0) - item_centers.min(axis=0)).argmax()
+            half = count // 2
+            order[start:start + count] = items[numpy.argpartition(item_centers[:, axis], half)]
+
+            node_child[node] = add_node(start, half)
+            add_node(start + half, count - half)
+            stack.extend([node_child[node], node_child[node] + 1])
+
+        return BVH(numpy.array(node_min, dtype=numpy.float32).reshape(-1, 3),
+                   numpy.array(node_max, dtype=numpy.float32).reshape(-1, 3),
+                   numpy.array(node_child, dtype=numpy.int32),
+                   numpy.array(node_start, dtype=numpy.int32),
+                   numpy.array(node_count, dtype=numpy.int32),
+                   order, item_min, item_max)
+
+    @staticmethod
+    def from_models(model_arrays, leaf_size=LEAF_SIZE):
+        """Builds a BVH over the world bounds of one or more
+        scene.SceneModelArrays"""
+        import scene
+        if isinstance(model_arrays, scene.SceneModelArray):
+            model_arrays = [model_arrays]
+        minpts, maxpts = [], []
+        for models in model_arrays:
+            lo, hi = models.world_bounds()
+            minpts.append(lo)
+            maxpts.append(hi)
+        if len(minpts) == 0:
+            return BVH.build(numpy.empty((0, 3)), numpy.empty((0, 3)), leaf_size)
+        return BVH.build(numpy.concatenate(minpts), numpy.concatenate(maxpts), leaf_size)
+
+    def _query(self, num_queries, test):
+        """Walks the tree for num_queries queries at once. test(queries,
+        minpts, maxpts) returns which of the (query, box) pairs to keep.
+        Returns a list of item id arrays, one per query."""
+        found_queries = []
+        found_items = []
+        queries = numpy.arange(num_queries, dtype=numpy.int32)
+        nodes = numpy.zeros(num_queries, dtype=numpy.int32)
+        if len(self) == 0:
+            queries = nodes = queries[:0]
+
+        while len(queries) > 0:
+            keep = test(queries, self.node_min[nodes], self.node_max[nodes])
+            queries, nodes = queries[keep], nodes[keep]
+
+            children = self.node_child[nodes]
+            leaf = children < 0
+            if leaf.any():
+                leaf_queries, items = _expand_leaves(queries[leaf], self.node_start[nodes[leaf]],
+                                                     self.node_count[nodes[leaf]], self.order)
+                keep = test(leaf_queries, self.item_min[items], self.item_max[items])
+                found_queries.append(leaf_queries[keep])
+                found_items.append(items[keep])
+
+            inner = ~leaf
+            queries = numpy.repeat(queries[inner], 2)
+            nodes = numpy.repeat(children[inner], 2)
+            nodes[1::2] += 1
+
+        if len(found_queries) == 0:
+            return [numpy.empty(0, dtype=numpy.int32) for _ in xrange(num_queries)]
+        return _group(numpy.concatenate(found_queries), numpy.concatenate(found_items), num_queries)
+
+    def query_boxes(self, minpts, maxpts):
+        """Returns, for each box given by rows of minpts and maxpts, the ids
+        of the items whose boxes overlap it"""
+        minpts = numpy.asarray(minpts, dtype=numpy.float32).reshape(-1, 3)
+        maxpts = numpy.asarray(maxpts, dtype=numpy.float32).reshape(-1, 3)
+        def test(queries, lo, hi):
+            return ((lo <= maxpts[queries]) & (hi >= minpts[queries])).all(axis=1)
+        return self._query(len(minpts), test)
+
+    def query_spheres(self, centers, radii):
+        """Returns, for each sphere, the ids of the items whose boxes it
+        touches"""
+        centers = numpy.asarray(centers, dtype=numpy.float32).reshape(-1, 3)
+        radii2 = numpy.square(numpy.broadcast_to(numpy.asarray(radii, dtype=numpy.float32),
+                                                 (len(centers),)))
+        def test(queries, lo, hi):
+            return _box_distance2(centers[queries], lo, hi) <= radii2[queries]
+        return self._query(len(centers), test)
+
+    def query_frustums(self, planes):
+        """Returns, for each frustum, the ids of the items whose boxes are
+        not entirely outside one of its planes. planes is a (Q, K, 4)
+        array of K planes a, b, c, d per frustum whose inside has
+        ax + by + cz + d >= 0. Like most frustum culling, boxes near a
+        corner outside the frustum can be reported too."""
+        planes = numpy.asarray(planes, dtype=numpy.float32)
+        if planes.ndim == 2:
+            planes = planes[None, :, :]
+        normals = planes[:, :, :3]
+        offsets = planes[:, :, 3]
+        def test(queries, lo, hi):
+            n = normals[queries]
+            # the corner of each box farthest along each plane's normal
+            corner = numpy.where(n >= 0, hi[:, None, :], lo[:, None, :])
+            return ((n * corner).sum(axis=2) + offsets[queries] >= 0).all(axis=1)
+        return self._query(len(planes), test)
+
+    def nearest(self, points, k=1):
+        """Returns (ids, distances), (Q, k) arrays of the k items whose
+        boxes are nearest each point, padded with -1 and inf"""
+        points = numpy.asarray(points, dtype=numpy.float32).reshape(-1, 3)
+        ids = numpy.empty((len(points), k), dtype=numpy.int32)
+        ids.fill(-1)
+        dists = numpy.empty((len(points), k), dtype=numpy.float64)
+        dists.fill(numpy.inf)
+        if len(self) == 0:
+            return ids, dists
+
+        for q, point in enumerate(points):
+            best = []   # max-heap of (-distance2, item) of the k nearest so far
+            heap = [(float(_box_distance2(point[None], self.node_min[:1], self.node_max[:1])[0]), 0)]
+            while len(heap) > 0:
+                dist2, node = heapq.heappop(heap)
+                if len(best) == k and dist2 > -best[0][0]:
+                    break
+                child = self.node_child[node]
+                if child >= 0:
+                    pair = [child, child + 1]
+                    child_dists = _box_distance2(point[None], self.node_min[pair], self.node_max[pair])
+                    for c, d in zip(pair, child_dists.tolist()):
+                        heapq.heappush(heap, (d, c))
+                    continue
+                start = self.node_start[node]
+                items = self.order[start:start + self.node_count[node]]
+                item_dists = _box_distance2(point[None], self.item_min[items], self.item_max[items])
+                for item, d in zip(items.tolist(), item_dists.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-d, item))
+                    elif d < -best[0][0]:
+                        heapq.heapreplace(best, (-d, item))
+
+            best.sort(reverse=True)
+            for i, (neg_dist2, item) in enumerate(best):
+                ids[q, i] = item
+                dists[q, i] = numpy.sqrt(-neg_dist2)
+        return ids, dists
+
+    def save(self, fname):
+        numpy.savez(fname, **dict((name, getattr(self, name)) for name in ARRAYS))
+
+    @staticmethod
+    def load(fname):
+        data = numpy.load(fname)
+        return BVH(*[data[name] for name in ARRAYS])
+
+def main():
+    parser = OptionParser(usage="Usage: spatial.py scene.json|scene.scene scene.bvh.npz",
+                          description="Builds a bounding volume hierarchy over the models of a scene")
+    parser.add_option("--leaf-size", dest="leaf_size", type="int", default=LEAF_SIZE,
+                      help="maximum number of models per leaf (default %d)" % LEAF_SIZE)
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        parser.exit(1, "Wrong number of arguments.\n")
+
+    import scenefile
+    bvh = BVH.from_models(scenefile.iter_model_batches(args[0]), leaf_size=options.leaf_size)
+    bvh.save(args[1])
+    print 'Indexed %d models in %d nodes to %s' % (len(bvh), len(bvh.node_count), args[1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""Local full-text index of the open3dhub catalog
+
+A catalog snapshot is a file with the JSON of one model per line, as
+returned by the browse API. TagIndex loads a snapshot into an SQLite
+database with an FTS4 table over tags and titles plus the size and
+complexity numbers of each model's optimized type, and answers boolean
+tag queries with numeric filters locally::
+
+    index = TagIndex('catalog.db')
+    shrubs = index.query('plant AND NOT tree', max_num_triangles=40000)
+
+Query syntax: tags are bare words or "quoted phrases", combined with
+AND, OR, NOT and parentheses; AND binds tighter than OR and juxtaposed
+terms are ANDed. A tag matches whole tags only, ignoring case, like the
+tags:"..." search of the API, so tree does not match a model tagged
+"palm tree". word:tree matches words inside tags and title:word matches
+words in the title instead.
+"""
+
+import re
+import sys
+import json
+import sqlite3
+from optparse import OptionParser
+
+from open3dhub import model_tags
+
+# numeric columns that queries can filter on with min_<col>/max_<col>
+NUMERIC_COLUMNS = ['size_gzip', 'subfiles_size_gzip', 'num_triangles',
+                   'num_draw_calls', 'texture_ram']
+
+# placed between tags so a phrase query can't match across two tags
+TAG_SEPARATOR = ' xxtagxx '
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    id INTEGER PRIMARY KEY,
+    full_path TEXT UNIQUE NOT NULL,
+    title TEXT,
+    size_gzip INTEGER,
+    subfiles_size_gzip INTEGER,
+    num_triangles INTEGER,
+    num_draw_calls INTEGER,
+    texture_ram INTEGER,
+    item TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS model_text USING fts4(tags, title);
+CREATE TABLE IF NOT EXISTS model_tags (
+    model_id INTEGER NOT NULL,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS model_tags_tag ON model_tags (tag);
+"""
+
+class QueryError(Exception):
+    pass
+
+def write_snapshot(items, fname):
+    """Writes an iterable of catalog items to a snapshot file and returns
+    the number written"""
+    count = 0
+    with open(fname, 'w') as f:
+        for item in items:
+            f.write(json.dumps(item))
+            f.write('\n')
+            count += 1
+    return count
+
+def read_snapshot(fname):
+    with open(fname) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def normalize_tag(tag):
+    """Returns tag lowercased with runs of whitespace made single spaces"""
+    return ' '.join(tag.lower().split())
+
+def _numbers(item):
+    optimized = item.get('metadata', {}).get('types', {}).get('optimized', {})
+    info = optimized.get('metadata', {})
+    return (optimized.get('size_gzip'),
+            sum(optimized.get('subfile_sizes_gzip', {}).values()),
+            info.get('num_triangles'),
+            info.get('num_draw_calls'),
+            info.get('texture_ram_usage'))
+
+_TOKEN_RE = re.compile(r'\s*(?:(\()|(\))|"([^"]*)"|([^\s()"]+))')
+
+def _tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        match = _TOKEN_RE.match(expr, pos)
+        if match is None:
+            raise QueryError('could not parse query at: %s' % expr[pos:])
+        lparen, rparen, phrase, word = match.groups()
+        if lparen:
+            tokens.append(('(', None))
+        elif rparen:
+            tokens.append((')', None))
+        elif phrase is not None:
+            tokens.append(('term', phrase))
+        elif word in ('AND', 'OR', 'NOT'):
+            tokens.append((word, None))
+        else:
+            tokens.append(('term', word))
+        pos = match.end()
+    return tokens
+
+class _QueryParser(object):
+    """Translates a boolean query into an SQL condition on models.id"""
+    def __init__(self, expr):
+        self.tokens = _tokenize(expr)
+        self.pos = 0
+        self.params = []
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self, kind):
+        if self.peek() != kind:
+            raise QueryError('expected %s in query' % kind)
+        self.pos += 1
+        return self.tokens[self.pos - 1][1]
+
+    def parse(self):
+        sql = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise QueryError('unexpected %s in query' % self.peek())
+        return sql, self.params
+
+    def parse_or(self):
+        parts = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.take('OR')
+            parts.append(self.parse_and())
+        return parts[0] if len(parts) == 1 else '(%s)' % ' OR '.join(parts)
+
+    def parse_and(self):
+        parts = [self.parse_not()]
+        while self.peek() in ('AND', 'NOT', 'term', '('):
+            if self.peek() == 'AND':
+                self.take('AND')
+            parts.append(self.parse_not())
+        return parts[0] if len(parts) == 1 else '(%s)' % ' AND '.join(parts)
+
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.take('NOT')
+            return '(NOT %s)' % self.parse_not()
+        if self.peek() == '(':
+            self.take('(')
+            sql = self.parse_or()
+            self.take(')')
+            return sql
+        return self.term(self.take('term'))
+
+    def term(self, text):
+        column = None
+        for prefix, prefix_column in (('title:', 'title'), ('word:', 'tags')):
+            if text.startswith(prefix):
+                column, text = prefix_column, text[len(prefix):]
+        if column is None:
+            tag = normalize_tag(text)
+            if not tag:
+                raise QueryError('empty term in query')
+            self.params.append(tag)
+            return 'models.id IN (SELECT model_id FROM model_tags WHERE tag = ?)'
+        words = re.findall(r'\w+', text.lower())
+        if len(words) == 0:
+            raise QueryError('empty term in query')
+        self.params.append('"%s"' % ' '.join(words))
+        return 'models.id IN (SELECT docid FROM model_text WHERE %s MATCH ?)' % column
+
+class TagIndex(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.db = sqlite3.connect(fname)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM models').fetchone()[0]
+
+    def build(self, items):
+        """Replaces the contents of the index with an iterable of catalog
+        items and returns the number of models indexed"""
+        count = 0
+        with self.db:
+            self.db.execute('DELETE FROM models')
+            self.db.execute('DELETE FROM model_text')
+            self.db.execute('DELETE FROM model_tags')
+            for item in items:
+                title = item.get('metadata', {}).get('title', '')
+                cur = self.db.execute(
+                    'INSERT OR REPLACE INTO models (full_path, title, size_gzip, subfiles_size_gzip,'
+                    ' num_triangles, num_draw_calls, texture_ram, item) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (item['full_path'], title) + _numbers(item) + (json.dumps(item),))
+                self.db.execute('INSERT INTO model_text (docid, tags, title) VALUES (?, ?, ?)',
+                                (cur.lastrowid, TAG_SEPARATOR.join(model_tags(item)), title))
+                self.db.executemany('INSERT INTO model_tags (model_id, tag) VALUES (?, ?)',
+                                    [(cur.lastrowid, tag) for tag in
+                                     set(normalize_tag(t) for t in model_tags(item))])
+                count += 1
+            # drop text and tag rows of paths that appeared twice in the snapshot
+            self.db.execute('DELETE FROM model_text WHERE docid NOT IN (SELECT id FROM models)')
+            self.db.execute('DELETE FROM model_tags WHERE model_id NOT IN (SELECT id FROM models)')
+            self.db.execute("INSERT INTO model_text(model_text) VALUES('optimize')")
+        return count
+
+    def _where(self, expr, limits):
+        conditions = []
+        params = []
+        if expr is not None and expr.strip():
+            sql, expr_params = _QueryParser(expr).parse()
+            conditions.append(sql)
+            params.extend(expr_params)
+
+        for key, value in limits.iteritems():
+            if value is None:
+                continue
+            bound, _, column = key.partition('_')
+            if bound not in ('min', 'max') or column not in NUMERIC_COLUMNS:
+                raise QueryError('unknown filter %s' % key)
+            conditions.append('%s %s ?' % (column, '>=' if bound == 'min' else '<='))
+            params.append(value)
+
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return where, params
+
+    def query_paths(self, expr=None, **limits):
+        """Returns the sorted full paths of models matching the boolean tag
+        query expr and min_<column>/max_<column> limits, where column is
+        one of NUMERIC_COLUMNS"""
+        where, params = self._where(expr, limits)
+        rows = self.db.execute('SELECT full_path FROM models' + where + ' ORDER BY full_path', params)
+        return [row[0] for row in rows]
+
+    def query(self, expr=None, **limits):
+        """Like query_paths, but returns the catalog items, in the same
+        form as cache.get_tag"""
+        where, params = self._where(expr, limits)
+        rows = self.db.execute('SELECT item FROM models' + where + ' ORDER BY full_path', params)
+        return [json.loads(row[0]) for row in rows]
+
+def main():
+    parser = OptionParser(usage="Usage: tagindex.py snapshot catalog.jsonl\n"
+                                "       tagindex.py build catalog.jsonl index.db\n"
+                                "       tagindex.py query index.db 'house AND NOT tree'",
+                          description="Builds and queries a local full-text index of the open3dhub catalog")
+    for column in NUMERIC_COLUMNS:
+        parser.add_option("--min-" + column.replace('_', '-'), dest="min_" + column, type="int",
+                          help="only models with %s >= N" % column, metavar="N")
+        parser.add_option("--max-" + column.replace('_', '-'), dest="max_" + column, type="int",
+                          help="only models with %s <= N" % column, metavar="N")
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.print_help()
+        parser.exit(1, "Wrong number of arguments.\n")
+
+    command = args[0]
+    if command == 'snapshot' and len(args) == 2:
+        import open3dhub
+        count = write_snapshot(open3dhub.iter_catalog(), args[1])
+        print 'Wrote %d models to %s' % (count, args[1])
+    elif command == 'build' and len(args) == 3:
+        index = TagIndex(args[2])
+        count = index.build(read_snapshot(args[1]))
+        print 'Indexed %d models into %s' % (count, args[2])
+    elif command == 'query' and len(args) in (2, 3):
+        limits = dict((key, getattr(options, key)) for key in
+                      ['min_' + c for c in NUMERIC_COLUMNS] + ['max_' + c for c in NUMERIC_COLUMNS])
+        index = TagIndex(args[1])
+        try:
+            paths = index.query_paths(args[2] if len(args) == 3 else None, **limits)
+        except QueryError, ex:
+            parser.exit(1, "%s\n" % ex)
+        for path in paths:
+            print path
+        sys.stderr.write('%d models\n' % len(paths))
+    else:
+        parser.print_help()
+        parser.exit(1, "Unknown command or wrong number of arguments.\n")
+
+if __name__ == '__main__':
+    main()
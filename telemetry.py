@@ -0,0 +1,171 @@
+"""Timing and transfer statistics for network fetches and cache lookups
+
+Recording is off until enable() is called, so the instrumented code pays
+only a flag check by default. Every event is tagged with the calling
+stage, set with::
+
+    with telemetry.stage('roads'):
+        ...
+
+Stages are kept per thread. Work handed to a pool thread should be
+wrapped with bind(), so it is tagged with the stage it was submitted
+from::
+
+    pool.imap_unordered(telemetry.bind(fetch), urls)
+
+Events can be aggregated into a summary table with format_summary() or
+written as a Chrome trace (load it in chrome://tracing or Perfetto) with
+write_chrome_trace().
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_local = threading.local()
+_events = []
+_enabled = False
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    with _lock:
+        del _events[:]
+
+def events():
+    with _lock:
+        return list(_events)
+
+def _stages():
+    stack = getattr(_local, 'stages', None)
+    if stack is None:
+        stack = _local.stages = []
+    return stack
+
+def current_stage():
+    stack = _stages()
+    return stack[-1] if stack else None
+
+def bind(fn):
+    """Returns fn wrapped to tag the events it records, on whatever thread
+    it runs, with the stage current when bind was called"""
+    name = current_stage()
+    def bound(*args, **kwargs):
+        stack = _stages()
+        stack.append(name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stack.pop()
+    return bound
+
+@contextmanager
+def stage(name):
+    """Tags events recorded by this thread inside the block with name"""
+    stack = _stages()
+    stack.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        stack.pop()
+        record('stage', name, start, time.time() - start)
+
+def record(kind, name, start, duration, **fields):
+    """Records an event of the given kind (e.g. 'http' or 'cache') that
+    started at time start and took duration seconds. Extra fields such as
+    wire_bytes, decoded_bytes, retries and hit are kept with the event."""
+    if not _enabled:
+        return
+    event = {'kind': kind,
+             'name': name,
+             'stage': current_stage(),
+             'start': start,
+             'duration': duration,
+             'thread': threading.current_thread().ident}
+    event.update(fields)
+    with _lock:
+        _events.append(event)
+
+def summarize():
+    """Aggregates events by (stage, kind, name) and returns a list of row
+    dicts sorted by total time"""
+    groups = {}
+    for e in events():
+        if e['kind'] == 'stage':
+            continue
+        groups.setdefault((e['stage'] or '-', e['kind'], e['name']), []).append(e)
+
+    rows = []
+    for (stage_name, kind, name), group in groups.iteritems():
+        durations = sorted(e['duration'] for e in group)
+        rows.append({'stage': stage_name,
+                     'kind': kind,
+                     'name': name,
+                     'count': len(group),
+                     'hits': sum(1 for e in group if e.get('hit') is True),
+                     'misses': sum(1 for e in group if e.get('hit') is False),
+                     'retries': sum(e.get('retries', 0) for e in group),
+                     'total': sum(durations),
+                     'mean': sum(durations) / len(durations),
+                     'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+                     'wire_bytes': sum(e.get('wire_bytes', 0) for e in group),
+                     'decoded_bytes': sum(e.get('decoded_bytes', 0) for e in group)})
+    rows.sort(key=lambda r: r['total'], reverse=True)
+    return rows
+
+def format_summary():
+    """Returns the summary as a printable table, followed by the wall time
+    spent in each stage"""
+    header = ('stage', 'kind', 'name', 'count', 'hit', 'miss', 'retry',
+              'total s', 'mean ms', 'p95 ms', 'wire KB', 'decoded KB')
+    lines = [header]
+    for r in summarize():
+        lines.append((r['stage'], r['kind'], r['name'], str(r['count']),
+                      str(r['hits']), str(r['misses']), str(r['retries']),
+                      '%.2f' % r['total'],
+                      '%.1f' % (r['mean'] * 1000),
+                      '%.1f' % (r['p95'] * 1000),
+                      '%.1f' % (r['wire_bytes'] / 1024.0),
+                      '%.1f' % (r['decoded_bytes'] / 1024.0)))
+
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    out = ['  '.join(col.ljust(w) for col, w in zip(line, widths)) for line in lines]
+
+    stages = [e for e in events() if e['kind'] == 'stage']
+    if len(stages) > 0:
+        out.append('')
+        for e in stages:
+            out.append('stage %s: %.2f s' % (e['name'], e['duration']))
+
+    return '\n'.join(out)
+
+def write_chrome_trace(fname):
+    """Writes all events as complete events in Chrome trace JSON format"""
+    evts = events()
+    epoch = min(e['start'] for e in evts) if len(evts) > 0 else 0
+    pid = os.getpid()
+
+    trace = []
+    for e in evts:
+        args = dict((k, v) for k, v in e.iteritems()
+                    if k not in ('kind', 'name', 'start', 'duration', 'thread'))
+        trace.append({'name': e['name'],
+                      'cat': e['kind'],
+                      'ph': 'X',
+                      'ts': (e['start'] - epoch) * 1e6,
+                      'dur': e['duration'] * 1e6,
+                      'pid': pid,
+                      'tid': e['thread'],
+                      'args': args})
+
+    with open(fname, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
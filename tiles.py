@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""Tiled scene output
+
+Splits the models of a scene into tiles over the horizontal (x, z) plane
+of the JSON scene's y-up coordinates, using either a regular grid or a
+quadtree that splits tiles holding more than a given number of models.
+Each tile is written as its own JSON file and Emerson script, and
+manifest.json (and manifest.em, as var TILES) lists every tile with its
+region, the bounds of its models' meshes and its model count, so a
+client can load only the tiles near it. A model belongs to the tile its
+position falls in, so a tile's bounds can reach past its region.
+
+Models of the types in GLOBAL_TYPES, such as the terrain, span the whole
+scene and go into a tile named 'global' with no region.
+"""
+
+import os
+import json
+from optparse import OptionParser
+
+import numpy
+
+import scenefile
+
+GLOBAL_TYPES = ['terrain']
+
+MANIFEST_VERSION = 1
+
+def _split_global(json_data):
+    """Returns (global rows, other rows, (N, 2) x, z positions)"""
+    is_global = numpy.array([j['type'] in GLOBAL_TYPES for j in json_data], dtype=bool)
+    positions = numpy.array([(j['x'], j['z']) for j in json_data], dtype=numpy.float64).reshape(-1, 2)
+    return numpy.flatnonzero(is_global), numpy.flatnonzero(~is_global), positions
+
+def _extent(points):
+    if len(points) == 0:
+        return numpy.zeros(2), numpy.zeros(2)
+    return points.min(axis=0), points.max(axis=0)
+
+def grid_tiles(positions, rows, size):
+    """Partitions rows into a size x size grid over the extent of their
+    positions. Returns a list of (tile id, ((x0, z0), (x1, z1)), rows),
+    leaving out empty cells."""
+    lo, hi = _extent(positions[rows])
+    cell = numpy.maximum((hi - lo) / size, 1e-9)
+    cells = numpy.clip(((positions[rows] - lo) // cell).astype(numpy.int64), 0, size - 1)
+    keys = cells[:, 0] * size + cells[:, 1]
+
+    tiles = []
+    order = numpy.argsort(keys, kind='mergesort')
+    unique, starts = numpy.unique(keys[order], return_index=True)
+    ends = list(starts[1:]) + [len(order)]
+    for key, start, end in zip(unique.tolist(), starts.tolist(), ends):
+        i, k = divmod(key, size)
+        x0, z0 = lo + cell * (i, k)
+        tiles.append(('x%d_z%d' % (i, k),
+                      ((x0, z0), (x0 + cell[0], z0 + cell[1])),
+                      rows[order[start:end]]))
+    return tiles
+
+def quadtree_tiles(positions, rows, max_models, max_depth=10):
+    """Partitions rows with a quadtree over the square around their
+    positions, splitting tiles with more than max_models models. Returns
+    a list of (tile id, ((x0, z0), (x1, z1)), rows), leaving out empty
+    tiles."""
+    lo, hi = _extent(positions[rows])
+    side = max((hi - lo).max(), 1e-9)
+
+    tiles = []
+    stack = [('q', lo, side, rows)]
+    while len(stack) > 0:
+        tile_id, corner, side, tile_rows = stack.pop()
+        if len(tile_rows) == 0:
+            continue
+        if len(tile_rows) <= max_models or len(tile_id) - 1 >= max_depth:
+            tiles.append((tile_id, (tuple(corner), tuple(corner + side)), tile_rows))
+            continue
+
+        half = side / 2.0
+        upper = positions[tile_rows] >= corner + half
+        for quadrant, (ux, uz) in enumerate([(False, False), (False, True), (True, False), (True, True)]):
+            mask = (upper[:, 0] == ux) & (upper[:, 1] == uz)
+            stack.append((tile_id + str(quadrant), corner + half * numpy.array([ux, uz]),
+                           half, tile_rows[mask]))
+
+    tiles.sort(key=lambda t: t[0])
+    return tiles
+
+def _bounds(tile_data):
+    """Returns the [min, max] corners, in the scene's y-up coordinates,
+    of the scaled and rotated mesh boxes of the records"""
+    import scene
+    minpts, maxpts = scene.SceneModelArray.from_json(tile_data, dtype=numpy.float64).world_bounds()
+    # back from z-up to y-up, where z is the negated z-up y
+    lo = numpy.column_stack([minpts[:, 0], minpts[:, 2], -maxpts[:, 1]]).min(axis=0)
+    hi = numpy.column_stack([maxpts[:, 0], maxpts[:, 2], -minpts[:, 1]]).max(axis=0)
+    return [lo.astype(numpy.float64).tolist(), hi.astype(numpy.float64).tolist()]
+
+def write_tiles(dirname, json_data, grid=None, quadtree=None, compact=False):
+    """Writes the JSON scene records json_data as tiles into dirname, on a
+    grid x grid grid or a quadtree of at most quadtree models per tile.
+    With compact, tiles are written without whitespace. Returns the
+    manifest."""
+    if (grid is None) == (quadtree is None):
+        raise ValueError('exactly one of grid and quadtree must be given')
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    global_rows, rows, positions = _split_global(json_data)
+    if grid is not None:
+        scheme = {'scheme': 'grid', 'size': grid}
+        tiles = grid_tiles(positions, rows, grid)
+    else:
+        scheme = {'scheme': 'quadtree', 'max_models': quadtree}
+        tiles = quadtree_tiles(positions, rows, quadtree)
+    if len(global_rows) > 0:
+        tiles.insert(0, ('global', None, global_rows))
+
+    manifest_tiles = []
+    for tile_id, region, tile_rows in tiles:
+        tile_data = [json_data[i] for i in tile_rows]
+        json_name = 'tile_%s.json' % tile_id
+        em_name = 'tile_%s.em' % tile_id
+        scenefile.write_json(os.path.join(dirname, json_name), tile_data, compact)
+        scenefile.write_em(os.path.join(dirname, em_name), tile_data, compact)
+        manifest_tiles.append({'id': tile_id,
+                               'json': json_name,
+                               'em': em_name,
+                               'region': None if region is None else [list(region[0]), list(region[1])],
+                               'bounds': _bounds(tile_data),
+                               'count': len(tile_data)})
+
+    manifest = {'version': MANIFEST_VERSION,
+                'count': len(json_data),
+                'tiles': manifest_tiles}
+    manifest.update(scheme)
+
+    manifest_str = json.dumps(manifest, indent=2)
+    with open(os.path.join(dirname, 'manifest.json'), 'w') as f:
+        f.write(manifest_str)
+    with open(os.path.join(dirname, 'manifest.em'), 'w') as f:
+        f.write('var TILES = ')
+        f.write(manifest_str)
+        f.write(';\n')
+
+    return manifest
+
+def main():
+    parser = OptionParser(usage="Usage: tiles.py (--grid N | --quadtree N) scene.json|scene.scene outdir",
+                          description="Splits a scene into tiles with a manifest")
+    parser.add_option("--grid", dest="grid", type="int",
+                      help="split into an N x N grid", metavar="N")
+    parser.add_option("--quadtree", dest="quadtree", type="int",
+                      help="split with a quadtree of at most N models per tile", metavar="N")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_help()
+        parser.exit(1, "Wrong number of arguments.\n")
+    if (options.grid is None) == (options.quadtree is None):
+        parser.print_help()
+        parser.exit(1, "Must specify one of --grid or --quadtree.\n")
+    if (options.grid if options.grid is not None else options.quadtree) < 1:
+        parser.print_help()
+        parser.exit(1, "N must be at least 1.\n")
+
+    manifest = write_tiles(args[1], scenefile.read_json(args[0]),
+                           grid=options.grid, quadtree=options.quadtree)
+    print 'Wrote %d models in %d tiles to %s' % (manifest['count'], len(manifest['tiles']), args[1])
+
+if __name__ == '__main__':
+    main()